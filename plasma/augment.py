@@ -35,6 +35,9 @@ class ByShotAugmentator(object):
     def set_inference_mode(self, is_inference):
         self.normalizer.set_inference_mode(is_inference)
 
+    def get_output_length(self, length):
+        return self.normalizer.get_output_length(length)
+
 
 class AbstractAugmentator(object):
     def __init__(self, normalizer, is_inference, conf):
@@ -58,6 +61,9 @@ class AbstractAugmentator(object):
     def set_inference_mode(self, is_inference):
         self.normalizer.set_inference_mode(is_inference)
 
+    def get_output_length(self, length):
+        return self.normalizer.get_output_length(length)
+
     @abc.abstractmethod
     def apply(self, shot):
         pass
@@ -0,0 +1,77 @@
+"""
+Benchmark of the resampling of all signals of a shot onto the common time
+grid: the per-signal path (cut_and_resample_signal) against the vectorized
+one (resample_signals). Run as
+
+    python benchmark_processing.py [num_signals] [num_samples] [num_repeats]
+"""
+
+from __future__ import print_function
+import sys
+import time
+
+import numpy as np
+
+from processing import cut_and_resample_signal, resample_signals
+
+
+def make_shot(num_signals, num_samples, seed=0):
+    """Synthetic raw signals in the layout of Shot.get_signals_and_times_from_file:
+    a mix of scalar and profile signals, some sharing a time base and one
+    stored out of order."""
+    rng = np.random.RandomState(seed)
+    time_bases = [
+        np.sort(rng.uniform(0.0, 5.0, num_samples)),
+        np.linspace(0.0, 5.0, num_samples // 4),
+        np.linspace(0.0, 5.0, num_samples * 2),
+    ]
+    time_arrays = []
+    signal_arrays = []
+    for i in range(num_signals):
+        t = time_bases[i % len(time_bases)]
+        if i == 1:
+            t = t[rng.permutation(len(t))]
+        num_channels = 64 if i % 4 == 3 else 1
+        time_arrays.append(t)
+        signal_arrays.append(rng.randn(len(t), num_channels).astype("float32"))
+    return time_arrays, signal_arrays
+
+
+def resample_per_signal(time_arrays, signal_arrays, t_min, t_max, dt, floatx):
+    sigs = []
+    for (t, sig) in zip(time_arrays, signal_arrays):
+        tr, sigr = cut_and_resample_signal(t, sig, t_min, t_max, dt, floatx)
+        sigs.append(sigr)
+    return tr, np.column_stack(sigs)
+
+
+def best_time(fn, num_repeats):
+    times = []
+    for _ in range(num_repeats):
+        start = time.time()
+        result = fn()
+        times.append(time.time() - start)
+    return min(times), result
+
+
+def main(num_signals=14, num_samples=100000, num_repeats=5):
+    t_min, t_max, dt, floatx = 0.1, 4.9, 0.001, "float32"
+    time_arrays, signal_arrays = make_shot(num_signals, num_samples)
+    args = (time_arrays, signal_arrays, t_min, t_max, dt, floatx)
+    t_old, (tr_old, sig_old) = best_time(
+        lambda: resample_per_signal(*args), num_repeats
+    )
+    t_new, (tr_new, sig_new) = best_time(lambda: resample_signals(*args), num_repeats)
+    assert np.array_equal(tr_old, tr_new)
+    assert np.array_equal(sig_old, sig_new), "resampled signals differ"
+    print(
+        "{} signals, {} channels, {} timesteps".format(
+            num_signals, sig_new.shape[1], sig_new.shape[0]
+        )
+    )
+    print("per signal: {:.4f} s".format(t_old))
+    print("vectorized: {:.4f} s ({:.1f}x)".format(t_new, t_old / t_new))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,173 @@
+"""
+#########################################################
+This file contains reusable batch buffers. Batch generators fill arrays in
+the buffers and hand them to the consumer without copying; a buffer is
+reused only once nothing references the arrays handed out from it.
+#########################################################
+"""
+
+from __future__ import print_function
+import sys
+
+import numpy as np
+
+# consumers that keep more batches than this must copy the arrays they keep
+MAX_BATCH_SLOTS = 8
+
+
+class BatchSlots(object):
+    """Slots of buffers for the arrays of the batches of a generator.
+
+    acquire(shapes) returns C-contiguous arrays of the given shapes, with the
+    dtypes passed to the constructor, in a free slot. The consumer owns them
+    for as long as it references them or any array or tensor sharing their
+    memory; the slot is free again once all such references are gone. While
+    the consumer holds on to a batch, the next one is filled into another
+    slot, so batches are double or triple buffered, and more slots are only
+    allocated if the consumer keeps more batches, up to max_slots.
+
+    allocate(size, dtype) returns a flat buffer, e.g. one in pinned memory.
+    """
+
+    def __init__(self, dtypes, allocate=np.empty, max_slots=MAX_BATCH_SLOTS):
+        self.dtypes = [np.dtype(dtype) for dtype in dtypes]
+        self.allocate = allocate
+        self.max_slots = max_slots
+        self.slots = []
+
+    def acquire(self, shapes):
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        free = [slot for slot in range(len(self.slots)) if not self.in_use(slot)]
+        if len(free) > 0:
+            buffers = self.slots[free[0]]
+        else:
+            if len(self.slots) >= self.max_slots:
+                raise RuntimeError(
+                    "all {} batch slots are referenced; copy the batch arrays "
+                    "that are kept".format(len(self.slots))
+                )
+            buffers = [None] * len(self.dtypes)
+            self.slots.append(buffers)
+        for (k, size) in enumerate(sizes):
+            if buffers[k] is None or buffers[k].size < size:
+                buffers[k] = self.allocate(size, self.dtypes[k])
+        return tuple(
+            buffers[k][:size].reshape(shape)
+            for (k, (size, shape)) in enumerate(zip(sizes, shapes))
+        )
+
+    def in_use(self, slot):
+        # a free buffer is referenced by its slot and by the argument of
+        # getrefcount only; every array handed out from it adds a reference
+        return any(
+            sys.getrefcount(self.slots[slot][k]) > 2 for k in range(len(self.dtypes))
+        )
+
+    def __len__(self):
+        return len(self.slots)
+
+
+class LaneRing(object):
+    """Circular buffers of the timesteps of num_lanes lanes, one row per lane.
+
+    The arrays of a lane, e.g. signals and targets, share a read cursor and a
+    count of unread timesteps, so they are read and written in lockstep. write
+    appends timesteps behind the unread ones of a lane, wrapping around the
+    end of its row, and read copies the next timesteps of all lanes into the
+    given arrays. Only the chunks that wrap are copied in two pieces. A lane
+    that runs out of space at least doubles the capacity of all rows.
+    """
+
+    def __init__(self, num_lanes, feature_shapes, dtypes, capacity=1):
+        self.buffers = [
+            np.zeros((num_lanes, capacity) + tuple(shape), dtype=dtype)
+            for (shape, dtype) in zip(feature_shapes, dtypes)
+        ]
+        self.starts = np.zeros(num_lanes, dtype=np.int64)
+        self.counts = np.zeros(num_lanes, dtype=np.int64)
+
+    def get_capacity(self):
+        return self.buffers[0].shape[1]
+
+    def write(self, lane, *arrays):
+        num = arrays[0].shape[0]
+        if self.counts[lane] + num > self.get_capacity():
+            self.grow(max(2 * self.get_capacity(), self.counts[lane] + num))
+        capacity = self.get_capacity()
+        pos = (self.starts[lane] + self.counts[lane]) % capacity
+        first = min(num, capacity - pos)
+        for (buff, arr) in zip(self.buffers, arrays):
+            buff[lane, pos : pos + first] = arr[:first]
+            buff[lane, : num - first] = arr[first:]
+        self.counts[lane] += num
+
+    def read(self, num, *outs):
+        assert np.all(self.counts >= num)
+        capacity = self.get_capacity()
+        for lane in range(len(self.starts)):
+            start = self.starts[lane]
+            first = min(num, capacity - start)
+            for (buff, out) in zip(self.buffers, outs):
+                out[lane, :first] = buff[lane, start : start + first]
+                out[lane, first:num] = buff[lane, : num - first]
+        self.starts = (self.starts + num) % capacity
+        self.counts -= num
+
+    def grow(self, capacity):
+        """Move the unread timesteps of every lane to the front of new rows of
+        the given capacity."""
+        old_capacity = self.get_capacity()
+        buffers = [
+            np.zeros((buff.shape[0], capacity) + buff.shape[2:], dtype=buff.dtype)
+            for buff in self.buffers
+        ]
+        for lane in range(len(self.starts)):
+            idx = (self.starts[lane] + np.arange(self.counts[lane])) % old_capacity
+            for (new_buff, buff) in zip(buffers, self.buffers):
+                new_buff[lane, : len(idx)] = buff[lane, idx]
+        self.buffers = buffers
+        self.starts[:] = 0
+
+
+class ShuffleBuffer(object):
+    """Bounded buffer of items of arrays, e.g. the signal and target patches
+    of shots, which are taken out in random order.
+
+    put copies one item of every array into a free row of the buffer, and
+    take copies a uniformly drawn item into the given arrays and frees its
+    row. Taking an item whenever the buffer is full, and all remaining ones
+    once the input is exhausted, shuffles a stream of items in memory bounded
+    by the capacity of the buffer. Items are not moved within the buffer.
+    """
+
+    def __init__(self, capacity, item_shapes, dtypes):
+        self.buffers = [
+            np.empty((capacity,) + tuple(shape), dtype=dtype)
+            for (shape, dtype) in zip(item_shapes, dtypes)
+        ]
+        self.used_rows = []
+        self.free_rows = list(range(capacity - 1, -1, -1))
+
+    def get_capacity(self):
+        return self.buffers[0].shape[0]
+
+    def is_full(self):
+        return len(self.free_rows) == 0
+
+    def put(self, *items):
+        row = self.free_rows.pop()
+        for (buff, item) in zip(self.buffers, items):
+            buff[row] = item
+        self.used_rows.append(row)
+
+    def take(self, *outs):
+        pos = np.random.randint(len(self.used_rows))
+        row = self.used_rows[pos]
+        self.used_rows[pos] = self.used_rows[-1]
+        self.used_rows.pop()
+        for (buff, out) in zip(self.buffers, outs):
+            out[...] = buff[row]
+        self.free_rows.append(row)
+
+    def __len__(self):
+        return len(self.used_rows)
@@ -98,6 +98,10 @@ def parameters(input_file):
         params["paths"]["processed_prepath"] = (
             output_path + "/processed_shots_torch/" + "signal_group_{}/".format(h)
         )
+        # resampled signals, shared by all signal groups
+        params["paths"]["processed_signal_prepath"] = (
+            output_path + "/processed_signals_torch/"
+        )
         # ensure shallow model has +1 -1 target.
         if params["model"]["shallow"] or params["target"] == "hinge":
             params["data"]["target"] = HingeTarget
@@ -4,11 +4,10 @@ import sys
 import os
 import re
 
-from scipy.interpolate import UnivariateSpline
-
-from processing import get_individual_shot_file
+from processing import get_individual_shot_file, remap_profiles
 from downloading import get_missing_value_array
 from hashing import myhash
+from storage import open_existing_store, get_packed_signal_prepath
 
 # class SignalCollection:
 #   """GA Data Obj"""
@@ -74,6 +73,52 @@ class Signal(object):
         print(file_path)
         return os.path.isfile(file_path)
 
+    def get_packed_store(self, prepath, machine):
+        packed_prepath = get_packed_signal_prepath(prepath)
+        return open_existing_store(
+            os.path.dirname(self.get_file_path(packed_prepath, machine, 0))
+        )
+
+    def load_raw_data(self, prepath, shot, dtype="float32"):
+        """Load the raw two-column data of a shot, preferring the packed
+        binary store written by storage.pack_signal_prepath and falling back
+        to the individual text file. The text file is also used if it was
+        written, e.g. downloaded again, after the shot was packed."""
+        store = self.get_packed_store(prepath, shot.machine)
+        if store is not None:
+            record = store.get_record(shot.number)
+            file_path = self.get_file_path(prepath, shot.machine, shot.number)
+            if record is not None and not (
+                os.path.isfile(file_path)
+                and os.path.getmtime(file_path) > record["stamp"]
+            ):
+                return self.load_data_from_store(store, shot, dtype)
+        return self.load_data_from_txt_safe(prepath, shot, dtype)
+
+    def load_data_from_store(self, store, shot, dtype="float32"):
+        data = store.get(shot.number).astype(dtype, copy=False)
+        if not self.is_valid_raw_data(data, shot):
+            return None, False
+        return data, True
+
+    def is_valid_raw_data(self, data, shot):
+        """Check the raw data of a shot, from a text file or the packed store,
+        reporting why it is unusable."""
+        if np.all(data == get_missing_value_array()):
+            print(
+                "Signal {}, shot {} contains no data".format(
+                    self.description, shot.number
+                )
+            )
+            return False
+        if data.size == 0 or data.ndim not in (1, 2) or data.shape[-1] < 2:
+            print(
+                "Signal {}, shot {} ".format(self.description, shot.number),
+                "has no (time, value) rows, shape {}".format(data.shape),
+            )
+            return False
+        return True
+
     def load_data_from_txt_safe(self, prepath, shot, dtype="float32"):
         file_path = self.get_file_path(prepath, shot.machine, shot.number)
         if not self.is_saved(prepath, shot):
@@ -93,13 +138,6 @@ class Signal(object):
             return None, False
         try:
             data = np.loadtxt(file_path, dtype=dtype)
-            if np.all(data == get_missing_value_array()):
-                print(
-                    "Signal {}, shot {} contains no data".format(
-                        self.description, shot.number
-                    )
-                )
-                return None, False
         except Exception as e:
             print(e)
             print(
@@ -109,11 +147,12 @@ class Signal(object):
             )
             os.remove(file_path)
             return None, False
-
+        if not self.is_valid_raw_data(data, shot):
+            return None, False
         return data, True
 
     def load_data(self, prepath, shot, dtype="float32"):
-        data, succ = self.load_data_from_txt_safe(prepath, shot)
+        data, succ = self.load_raw_data(prepath, shot)
         if not succ:
             return None, None, False
 
@@ -161,7 +200,9 @@ class Signal(object):
 
         return t, sig, True
 
-    def fetch_data_basic(self, machine, shot_num, c, path=None):
+    def fetch_data_basic(self, machine, shot_num, c, path=None, raise_errors=False):
+        """Fetch the signal through connection c. Errors raised by the fetch,
+        e.g. of a broken connection, count as no data unless raise_errors."""
         if path is None:
             path = self.get_path(machine)
         success = False
@@ -169,6 +210,8 @@ class Signal(object):
         try:
             time, data, mapping, success = machine.fetch_data_fn(path, shot_num, c)
         except Exception as e:
+            if raise_errors:
+                raise
             print(e)
             sys.stdout.flush()
 
@@ -178,8 +221,8 @@ class Signal(object):
         time = np.array(time) + 1e-3 * self.get_causal_shift(machine)
         return time, np.array(data), mapping, success
 
-    def fetch_data(self, machine, shot_num, c):
-        return self.fetch_data_basic(machine, shot_num, c)
+    def fetch_data(self, machine, shot_num, c, raise_errors=False):
+        return self.fetch_data_basic(machine, shot_num, c, raise_errors=raise_errors)
 
     def is_defined_on_machine(self, machine):
         return machine in self.machines
@@ -214,19 +257,33 @@ class Signal(object):
     def description_plus_paths(self):
         return self.description + " " + " ".join(self.paths)
 
+    def get_key(self):
+        # signals are used as dict keys in every per-shot operation, so the
+        # identifying string and its hash are computed once. Signals
+        # unpickled from before this cache existed compute it on first use.
+        key = self.__dict__.get("_key")
+        if key is None:
+            key = self.description_plus_paths()
+            self._key = key
+            self._hash = myhash(key)
+        return key
+
     def __eq__(self, other):
         if other is None:
             return False
-        return self.description_plus_paths().__eq__(other.description_plus_paths())
+        if self is other:
+            return True
+        return self.get_key().__eq__(other.get_key())
 
     def __ne__(self, other):
-        return self.description_plus_paths().__ne__(other.description_plus_paths())
+        return not self.__eq__(other)
 
     def __lt__(self, other):
-        return self.description_plus_paths().__lt__(other.description_plus_paths())
+        return self.get_key().__lt__(other.get_key())
 
     def __hash__(self):
-        return myhash(self.description_plus_paths())
+        self.get_key()
+        return self._hash
 
     def __str__(self):
         return self.description
@@ -264,7 +321,7 @@ class ProfileSignal(Signal):
         self.num_channels = num_channels
 
     def load_data(self, prepath, shot, dtype="float32"):
-        data, succ = self.load_data_from_txt_safe(prepath, shot)
+        data, succ = self.load_raw_data(prepath, shot)
         if not succ:
             return None, None, False
 
@@ -299,27 +356,22 @@ class ProfileSignal(Signal):
             )
             return None, None, False
 
-        timesteps = len(t)
-        sig_interp = np.zeros((timesteps, self.num_channels))
-        for i in range(timesteps):
-            # make sure the mapping is ordered and unique
-            _, order = np.unique(mapping[i, :], return_index=True)
-            if sig[i, order].shape[0] > 2:
-                # ext = 0 is extrapolation, ext = 3 is boundary value.
-                f = UnivariateSpline(mapping[i, order], sig[i, order], s=0, k=1, ext=3)
-                sig_interp[i, :] = f(remapping)
-            else:
-                print(
-                    "Signal {}, shot {} ".format(self.description, shot.number),
-                    "has insufficient points for linear interpolation. ",
-                    "dfitpack.error: (m>k) failed for hidden m: fpcurf0:m=1",
-                )
-                return None, None, False
+        # linear in between the mapped points, boundary values outside
+        sig_interp = remap_profiles(mapping, sig, remapping)
+        if sig_interp is None:
+            print(
+                "Signal {}, shot {} ".format(self.description, shot.number),
+                "has insufficient points for linear interpolation. ",
+                "dfitpack.error: (m>k) failed for hidden m: fpcurf0:m=1",
+            )
+            return None, None, False
 
         return t, sig_interp, True
 
-    def fetch_data(self, machine, shot_num, c):
-        time, data, mapping, success = self.fetch_data_basic(machine, shot_num, c)
+    def fetch_data(self, machine, shot_num, c, raise_errors=False):
+        time, data, mapping, success = self.fetch_data_basic(
+            machine, shot_num, c, raise_errors=raise_errors
+        )
         path = self.get_path(machine)
         mapping_path = self.get_mapping_path(machine)
 
@@ -331,7 +383,7 @@ class ProfileSignal(Signal):
         if mapping_path is not None:
             # fetch the mapping separately
             (time_map, data_map, mapping_map, success_map) = self.fetch_data_basic(
-                machine, shot_num, c, path=mapping_path
+                machine, shot_num, c, path=mapping_path, raise_errors=raise_errors
             )
             success = success and success_map
             if not success:
@@ -402,8 +454,10 @@ class ChannelSignal(Signal):
         idx = self.get_idx(machine)
         return self.channel_nums[idx]
 
-    def fetch_data(self, machine, shot_num, c):
-        time, data, mapping, success = self.fetch_data_basic(machine, shot_num, c)
+    def fetch_data(self, machine, shot_num, c, raise_errors=False):
+        time, data, mapping, success = self.fetch_data_basic(
+            machine, shot_num, c, raise_errors=raise_errors
+        )
         mapping = None  # we are not interested in the whole profile
         channel_num = self.get_channel_num(machine)
         if channel_num is not None and success:
@@ -428,6 +482,67 @@ class ChannelSignal(Signal):
         )
 
 
+class SignalRegistry(object):
+    """Integer ids and column slices of an ordered list of signals.
+
+    The signals of a shot are stored side by side in one dense
+    (T, num_channels) array; signal i occupies the columns slices[i].
+    """
+
+    def __init__(self, signals):
+        self.signals = list(signals)
+        self.ids = dict()
+        self.slices = []
+        curr_idx = 0
+        for (i, sig) in enumerate(self.signals):
+            self.ids[sig] = i
+            self.slices.append(slice(curr_idx, curr_idx + sig.num_channels))
+            curr_idx += sig.num_channels
+        self.num_channels = curr_idx
+        self._columns = dict()
+
+    def __len__(self):
+        return len(self.signals)
+
+    def get_id(self, sig):
+        return self.ids[sig]
+
+    def get_slice(self, sig):
+        return self.slices[self.ids[sig]]
+
+    def get_columns(self, signals):
+        """Columns of the given signals, in their order, as a slice if they
+        are contiguous and as an index array otherwise."""
+        signals = tuple(signals)
+        columns = self._columns.get(signals)
+        if columns is None:
+            indices = np.concatenate(
+                [np.arange(self.num_channels)[self.get_slice(sig)] for sig in signals]
+                + [np.zeros(0, dtype=int)]
+            )
+            if len(indices) > 0 and np.array_equal(
+                indices, np.arange(indices[0], indices[0] + len(indices))
+            ):
+                columns = slice(int(indices[0]), int(indices[0]) + len(indices))
+            else:
+                columns = indices
+            self._columns[signals] = columns
+        return columns
+
+
+_signal_registries = dict()
+
+
+def get_signal_registry(signals):
+    """Return the (per process cached) SignalRegistry of a list of signals."""
+    signals = tuple(signals)
+    registry = _signal_registries.get(signals)
+    if registry is None:
+        registry = SignalRegistry(signals)
+        _signal_registries[signals] = registry
+    return registry
+
+
 class Machine(object):
     def __init__(self, name, server, fetch_data_fn, max_cores=8, current_threshold=0):
         self.name = name
@@ -1,9 +1,11 @@
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import errno
 import os
-from functools import partial
-import multiprocessing as mp
+import queue
+import sqlite3
 import sys
+import threading
 import time
 import numpy as np
 
@@ -72,129 +74,382 @@ def format_save_path(prepath, signal_path, shot_num):
     return prepath + signal_path + "/{}.txt".format(shot_num)
 
 
-def save_shot(shot_num_queue, c, signals, save_prepath, machine, sentinel=-1):
-    missing_values = 0
-    # if machine == 'd3d':
-    #   reload(gadata) #reloads Gadata object with connection
-    while True:
-        shot_num = shot_num_queue.get()
-        if shot_num == sentinel:
+class ConnectionPool(object):
+    """A bounded pool of connections to the data server of a machine.
+
+    At most max_size connections are checked out at any time; idle ones are
+    reused. connection_factory(server) creates a new connection and defaults
+    to the MDSplus Connection, so a local stand-in can be used for testing.
+    """
+
+    def __init__(self, server, max_size, connection_factory=None):
+        self.server = server
+        self.max_size = max_size
+        if connection_factory is None:
+            connection_factory = Connection
+        self.connection_factory = connection_factory
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max_size)
+
+    def get(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.connection_factory(self.server)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def put(self, c, discard=False):
+        # connections that raised are dropped and lazily replaced
+        if not discard:
+            self.idle.put(c)
+        self.slots.release()
+
+
+class DownloadManifest(object):
+    """Persistent record of the download status of every (machine, signal,
+    shot) item, kept in an SQLite database next to the downloaded data.
+
+    Each item holds its status ("ok" or "missing"), the size of the saved
+    file in bytes, the number of rows fetched, the time it was written and the
+    last error. Only the thread that opened the manifest may use it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        makedirdepth_process_safe(path)
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "machine TEXT, signal TEXT, shot INTEGER, status TEXT, "
+            "bytes INTEGER, rows INTEGER, timestamp REAL, error TEXT, "
+            "PRIMARY KEY (machine, signal, shot))"
+        )
+        self.db.commit()
+
+    def get_statuses(self, machine):
+        """Return a dict from (signal, shot) to the status of the item."""
+        cursor = self.db.execute(
+            "SELECT signal, shot, status FROM items WHERE machine = ?",
+            (str(machine),),
+        )
+        return {(signal, shot): status for (signal, shot, status) in cursor}
+
+    def record(self, machine, signal, shot, result):
+        status, num_bytes, num_rows, error = result
+        self.db.execute(
+            "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                str(machine),
+                signal,
+                int(shot),
+                status,
+                num_bytes,
+                num_rows,
+                time.time(),
+                error,
+            ),
+        )
+
+    def commit(self):
+        self.db.commit()
+
+    def get_incomplete_shots(self, machine=None):
+        """Return a dict from (machine, shot) to the list of signals of the
+        shot that are not available, with their errors."""
+        query = "SELECT machine, shot, signal, error FROM items WHERE status != 'ok'"
+        args = ()
+        if machine is not None:
+            query += " AND machine = ?"
+            args = (str(machine),)
+        incomplete = {}
+        for (machine_name, shot, signal, error) in self.db.execute(
+            query + " ORDER BY machine, shot, signal", args
+        ):
+            incomplete.setdefault((machine_name, shot), []).append((signal, error))
+        return incomplete
+
+    def report(self, machine=None):
+        query = "SELECT machine, status, COUNT(*), SUM(bytes) FROM items"
+        args = ()
+        if machine is not None:
+            query += " WHERE machine = ?"
+            args = (str(machine),)
+        print("Download manifest {}".format(self.path))
+        for (machine_name, status, count, num_bytes) in self.db.execute(
+            query + " GROUP BY machine, status", args
+        ):
+            print(
+                "{}: {} signals {} ({} bytes)".format(
+                    machine_name, count, status, num_bytes
+                )
+            )
+        incomplete = self.get_incomplete_shots(machine)
+        print("{} incomplete shots".format(len(incomplete)))
+        for ((machine_name, shot), signals) in sorted(incomplete.items()):
+            print(
+                "{} shot {}: {}".format(
+                    machine_name,
+                    shot,
+                    ", ".join(
+                        "{} ({})".format(signal, error) for (signal, error) in signals
+                    ),
+                )
+            )
+        return incomplete
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def get_manifest_path(save_prepath):
+    return os.path.join(save_prepath, "download_manifest.db")
+
+
+def get_signal_key(signal, machine):
+    """Name of a signal in the manifest: its data directory below the
+    machine's directory."""
+    dirname = os.path.dirname(signal.get_file_path("", machine, 0))
+    return os.path.normpath(dirname).strip("/")
+
+
+def signal_previously_downloaded(signal, machine, shot_num, save_prepath):
+    save_path_full = signal.get_file_path(save_prepath, machine, shot_num)
+    if os.path.isfile(save_path_full):
+        if os.path.getsize(save_path_full) > 0:
+            return True
+        print(
+            "Signal {}, shot {} ".format(signal.get_path(machine), shot_num),
+            "was downloaded incorrectly (empty file). ",
+            "Redownloading.",
+        )
+    return False
+
+
+def is_missing_value_file(path):
+    """Whether the file at path holds the missing value array, which is saved
+    for signals without data."""
+    # the missing value array takes a few bytes; any real signal is larger
+    if os.path.getsize(path) > 64:
+        return False
+    try:
+        data = np.loadtxt(path, ndmin=1)
+    except ValueError:
+        return False
+    return np.array_equal(data, get_missing_value_array())
+
+
+def fetch_signal(signal, machine, shot_num, c):
+    """Fetch one signal of a shot as the array stored on disk, or None if the
+    server has no data for it. Errors of the connection are raised."""
+    time, data, mapping, success = signal.fetch_data(
+        machine, shot_num, c, raise_errors=True
+    )
+    if not success:
+        return None
+    data_two_column = np.vstack((np.atleast_2d(time), np.atleast_2d(data))).transpose()
+    if mapping is not None:
+        mapping_two_column = np.vstack(
+            (np.atleast_2d(time), np.atleast_2d(mapping))
+        ).transpose()
+        data_two_column = np.vstack((mapping_two_column, data_two_column))
+    return data_two_column
+
+
+def save_signal(signal, machine, shot_num, save_prepath, data_two_column):
+    save_path_full = signal.get_file_path(save_prepath, machine, shot_num)
+    makedirdepth_process_safe(save_path_full)
+    if data_two_column is None:
+        data_two_column = get_missing_value_array()
+    np.savetxt(save_path_full, data_two_column, fmt="%.5e")
+
+
+def download_signal(
+    pool,
+    signal,
+    machine,
+    shot_num,
+    save_prepath,
+    retries=2,
+    backoff=1.0,
+    check_existing=True,
+):
+    """Download and save one (shot, signal) work item.
+
+    A fetch that raised, e.g. on a broken connection, is retried up to
+    retries times, waiting backoff * 2**k seconds before the k-th retry, and
+    its connection is replaced. A signal the server has no data for is not
+    retried. If no data was fetched, the missing value array is saved. Unless
+    check_existing is False, a file already on disk is kept, except for the
+    missing value array of an earlier attempt, which is fetched again.
+
+    Returns the manifest entry (status, bytes, rows, error) of the item.
+    """
+    save_path_full = signal.get_file_path(save_prepath, machine, shot_num)
+    if (
+        check_existing
+        and signal_previously_downloaded(signal, machine, shot_num, save_prepath)
+        and not is_missing_value_file(save_path_full)
+    ):
+        return "ok", os.path.getsize(save_path_full), None, None
+    data_two_column = None
+    error = None
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        c = pool.get()
+        broken = False
+        try:
+            data_two_column = fetch_signal(signal, machine, shot_num, c)
+            error = None if data_two_column is not None else "no data"
+        except Exception as e:
+            print(
+                "Signal {}, shot {}: {}".format(signal.get_path(machine), shot_num, e)
+            )
+            error = str(e)
+            broken = True
+        finally:
+            pool.put(c, discard=broken)
+        if not broken:
             break
-        shot_complete = True
-        for signal in signals:
-            signal_path = signal.get_path(machine)
-            save_path_full = signal.get_file_path(save_prepath, machine, shot_num)
-            success = False
-            mapping = None
-            if os.path.isfile(save_path_full):
-                if os.path.getsize(save_path_full) > 0:
-                    print("-", end="")
-                    success = True
-                else:
-                    print(
-                        "Signal {}, shot {} ".format(signal_path, shot_num),
-                        "was downloaded incorrectly (empty file). ",
-                        "Redownloading.",
-                    )
-            if not success:
+    save_signal(signal, machine, shot_num, save_prepath, data_two_column)
+    num_bytes = os.path.getsize(save_path_full)
+    if data_two_column is None:
+        print("No success shot {}, signal {}".format(shot_num, signal))
+        return "missing", num_bytes, 0, error
+    return "ok", num_bytes, len(data_two_column), None
+
+
+def download_shot_numbers(
+    shot_numbers,
+    save_prepath,
+    machine,
+    signals,
+    num_connections=None,
+    retries=2,
+    backoff=1.0,
+    connection_factory=None,
+    manifest=None,
+):
+    """Download all signals of the given shots with a pool of threads.
+
+    Every (shot, signal) pair is a work item; one thread per connection works
+    through them, with at most num_connections (default machine.max_cores)
+    connections open to the server. With a DownloadManifest, items recorded as
+    ok are skipped as long as their file exists, items recorded as missing are
+    fetched again and every result is recorded. Returns the lists of complete
+    and incomplete shot numbers.
+    """
+    if num_connections is None:
+        num_connections = machine.max_cores
+    # every shot is downloaded and counted once
+    shot_numbers = list(dict.fromkeys(int(shot_num) for shot_num in shot_numbers))
+    pool = ConnectionPool(machine.server, num_connections, connection_factory)
+    statuses = {} if manifest is None else manifest.get_statuses(machine)
+    signal_keys = [get_signal_key(signal, machine) for signal in signals]
+    work_items = (
+        (shot_num, signal, key)
+        for shot_num in shot_numbers
+        for (signal, key) in zip(signals, signal_keys)
+    )
+    num_items = len(shot_numbers) * len(signals)
+    # signals still outstanding and completeness of every shot in flight
+    remaining = {}
+    complete = {}
+    complete_shots = []
+    incomplete_shots = []
+    num_done = 0
+    num_skipped = 0
+    missing_values = 0
+    start_time = time.time()
+
+    def finish(shot_num, success):
+        if not success:
+            complete[shot_num] = False
+        remaining[shot_num] -= 1
+        if remaining[shot_num] == 0:
+            del remaining[shot_num]
+            # only add shot to list if it was complete
+            if complete.pop(shot_num):
+                complete_shots.append(shot_num)
+            else:
+                print("shot {} not complete.".format(shot_num))
+                incomplete_shots.append(shot_num)
+
+    print("running in parallel on {} connections".format(num_connections))
+    with ThreadPoolExecutor(max_workers=num_connections) as executor:
+        # keep a bounded number of items in flight instead of queueing them all
+        in_flight = {}
+        max_in_flight = 4 * num_connections
+        while True:
+            for (shot_num, signal, key) in work_items:
+                remaining.setdefault(shot_num, len(signals))
+                complete.setdefault(shot_num, True)
+                status = statuses.get((key, shot_num))
+                if status == "ok" and not os.path.isfile(
+                    signal.get_file_path(save_prepath, machine, shot_num)
+                ):
+                    # removed since, e.g. by Signal.load_data_from_txt_safe
+                    status = None
+                if status == "ok":
+                    num_skipped += 1
+                    finish(shot_num, True)
+                    continue
+                future = executor.submit(
+                    download_signal,
+                    pool,
+                    signal,
+                    machine,
+                    shot_num,
+                    save_prepath,
+                    retries,
+                    backoff,
+                    status is None,
+                )
+                in_flight[future] = (shot_num, key)
+                if len(in_flight) >= max_in_flight:
+                    break
+            if len(in_flight) == 0:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                shot_num, key = in_flight.pop(future)
                 try:
-                    try:
-                        time, data, mapping, success = signal.fetch_data(
-                            machine, shot_num, c
-                        )
-                        if not success:
-                            print(
-                                "No success shot {}, signal {}".format(shot_num, signal)
-                            )
-                    except Exception as e:
-                        print(e)
-                        sys.stdout.flush()
-                        # missing_values += 1
-                        print(
-                            "Signal {}, shot {} missing. ".format(
-                                signal_path, shot_num
-                            ),
-                            "Filling with zeros.",
-                        )
-                        success = False
-
-                    if success:
-                        data_two_column = np.vstack(
-                            (np.atleast_2d(time), np.atleast_2d(data))
-                        ).transpose()
-                        if mapping is not None:
-                            mapping_two_column = np.vstack(
-                                (np.atleast_2d(time), np.atleast_2d(mapping))
-                            ).transpose()
-                            data_two_column = np.vstack(
-                                (mapping_two_column, data_two_column)
-                            )
-                    makedirdepth_process_safe(save_path_full)
-                    if success:
-                        np.savetxt(save_path_full, data_two_column, fmt="%.5e")
-                    else:
-                        np.savetxt(
-                            save_path_full, get_missing_value_array(), fmt="%.5e"
-                        )
-                    print(".", end="")
+                    result = future.result()
                 except BaseException:
-                    print(
-                        "Could not save shot {}, signal {}".format(
-                            shot_num, signal_path
-                        )
-                    )
+                    print("Could not save shot {}".format(shot_num))
                     print("Warning: Incomplete!!!")
                     raise
+                if manifest is not None:
+                    manifest.record(machine, key, shot_num, result)
+                success = result[0] == "ok"
+                if not success:
+                    missing_values += 1
+                num_done += 1
+                finish(shot_num, success)
+            if manifest is not None:
+                manifest.commit()
+            sys.stdout.write(
+                "\r{}/{} signals, {} skipped, {} shots complete, "
+                "{:.1f} signals/s".format(
+                    num_done + num_skipped,
+                    num_items,
+                    num_skipped,
+                    len(complete_shots),
+                    num_done / max(time.time() - start_time, 1e-6),
+                )
+            )
             sys.stdout.flush()
-            if not success:
-                missing_values += 1
-                shot_complete = False
-        # only add shot to list if it was complete
-        if shot_complete:
-            print("saved shot {}".format(shot_num))
-            # complete_queue.put(shot_num)
-        else:
-            print("shot {} not complete. removing from list.".format(shot_num))
-    print("Finished with {} missing values total".format(missing_values))
-    return
-
-
-def download_shot_numbers(shot_numbers, save_prepath, machine, signals):
-    max_cores = machine.max_cores
-    sentinel = -1
-    fn = partial(
-        save_shot,
-        signals=signals,
-        save_prepath=save_prepath,
-        machine=machine,
-        sentinel=sentinel,
-    )
-    # can only handle 8 connections at once :(
-    num_cores = min(mp.cpu_count(), max_cores)
-    queue = mp.Queue()
-    # complete_shots = Array('i',zeros(len(shot_numbers)))# = mp.Queue()
-
-    # mp.queue can't handle larger queues yet!
-    assert len(shot_numbers) < 32000
-    for shot_num in shot_numbers:
-        queue.put(shot_num)
-    for i in range(num_cores):
-        queue.put(sentinel)
-    connections = [Connection(machine.server) for _ in range(num_cores)]
-    processes = [
-        mp.Process(target=fn, args=(queue, connections[i])) for i in range(num_cores)
-    ]
-
-    print("running in parallel on {} processes".format(num_cores))
-
-    for p in processes:
-        p.start()
-    for p in processes:
-        p.join()
+    print("\nFinished with {} missing values total".format(missing_values))
+    return complete_shots, incomplete_shots
 
 
 def download_all_shot_numbers(prepath, save_path, shot_list_files, signals_full):
-    max_len = 30000
     machine = shot_list_files.machine
     signals = []
     for sig in signals_full:
@@ -204,16 +459,42 @@ def download_all_shot_numbers(prepath, save_path, shot_list_files, signals_full)
             signals.append(sig)
     save_prepath = prepath + save_path + "/"
     shot_numbers, _ = shot_list_files.get_shot_numbers_and_disruption_times()
-    # can only use queue of max size 30000
-    shot_numbers_chunks = [
-        shot_numbers[i : i + max_len] for i in np.xrange(0, len(shot_numbers), max_len)
-    ]
+    manifest = DownloadManifest(get_manifest_path(save_prepath))
     start_time = time.time()
-    for shot_numbers_chunk in shot_numbers_chunks:
-        download_shot_numbers(shot_numbers_chunk, save_prepath, machine, signals)
+    try:
+        complete_shots, incomplete_shots = download_shot_numbers(
+            shot_numbers, save_prepath, machine, signals, manifest=manifest
+        )
+    finally:
+        manifest.close()
 
     print(
         "Finished downloading {} shots in {} seconds".format(
             len(shot_numbers), time.time() - start_time
         )
     )
+    print("{} shots not complete.".format(len(incomplete_shots)))
+    return complete_shots, incomplete_shots
+
+
+def report_downloads(save_prepath, machine=None):
+    """Print the download summary and the incomplete shots of save_prepath."""
+    manifest_path = get_manifest_path(save_prepath)
+    if not os.path.isfile(manifest_path):
+        print("No download manifest at {}".format(manifest_path))
+        return {}
+    manifest = DownloadManifest(manifest_path)
+    try:
+        return manifest.report(machine)
+    finally:
+        manifest.close()
+
+
+if __name__ == "__main__":
+    from conf import conf
+
+    signal_prepaths = conf["paths"]["signal_prepath"]
+    if not isinstance(signal_prepaths, list):
+        signal_prepaths = [signal_prepaths]
+    for signal_prepath in signal_prepaths:
+        report_downloads(signal_prepath)
@@ -12,7 +12,20 @@ from __future__ import print_function, division
 import numpy as np
 
 from shots import Shot
-import multiprocessing as mp
+from storage import open_store
+from hashing import myhash
+from prefetch import BatchPrefetcher
+from buffers import BatchSlots, LaneRing, ShuffleBuffer
+from shot_cache import (
+    ShotCache,
+    SharedShotCache,
+    NORMALIZED_SHOT_FIELDS,
+    read_normalized_arrays,
+    append_normalized_arrays,
+)
+from functools import partial
+import itertools
+import os
 
 # import pdb
 
@@ -40,6 +53,10 @@ class Loader(object):
         self.stateful = conf["model"]["stateful"]
         self.normalizer = normalizer
         self.verbose = True
+        self.prefetcher = None
+        self.allocate_buffer = np.empty
+        self.shot_cache = None
+        self.normalized_stores = dict()
 
     def set_inference_mode(self, val):
         self.normalizer.set_inference_mode(val)
@@ -49,6 +66,13 @@ class Loader(object):
         generator with a while-loop.  It iterates indefinitely over the
         data set and returns one mini-batch of data at a time.
 
+        Every epoch, the shuffled shot list is split into sublists of
+        conf['training']['num_shots_at_once'] shots, whose patches (see
+        make_patches) are streamed into batches by patch_batch_generator.
+        Shots are loaded only as their patches are needed, so the first batch
+        of a sublist is ready once the shuffle buffer of
+        conf['training']['patch_buffer_bytes'] is full.
+
         NOTE: Can be inefficient during distributed training because one
         process loading data will cause all other processes to stall.
 
@@ -66,6 +90,9 @@ class Loader(object):
         """
         batch_size = self.conf["training"]["batch_size"]
         num_at_once = self.conf["training"]["num_shots_at_once"]
+        return_sequences = self.conf["model"]["return_sequences"]
+        floatx = self.conf["data"]["floatx"]
+        slots = BatchSlots([floatx, floatx], self.allocate_buffer)
         epoch = 0
         num_so_far = 0
         while True:
@@ -75,42 +102,136 @@ class Loader(object):
             # reused to make them equal length).
             shot_sublists = shot_list.sublists(num_at_once, equal_size=True)
             num_total = len(shot_list)
-            for (i, shot_sublist) in enumerate(shot_sublists):
-                # produce a list of equal-length chunks from this set of shots
-                X_list, y_list = self.load_as_X_y_list(shot_sublist)
-                # Each chunk will be a multiple of the batch size
-                for j, (X, y) in enumerate(zip(X_list, y_list)):
-                    num_examples = X.shape[0]
-                    assert num_examples % batch_size == 0
-                    num_chunks = num_examples // batch_size
-                    """
-                    The method produces batch-sized training data X and labels
-                    y as Numpy arrays to feed during training.
-
-                    Mini-batch dimensions are (num_examples, num_timesteps,
-                    num_dimensions_of_data) also num_examples has to be
-                    divisible by the batch_size. The i-th example and the
-                    (batchsize + 1)-th example are consecutive in time, so we
-                    do not reset the RNN internal state unless we start a new
-                    chunk.
-
-                    """
+            for shot_sublist in shot_sublists:
+                patch_len, num_det, num_rand = self.plan_patches(shot_sublist)
+                num_chunks = patch_len // self.conf["model"]["length"]
+                num_batches = (np.sum(num_det) + np.sum(num_rand)) // batch_size
+                # The i-th example of consecutive chunks of a batch continues
+                # the same patch, so we do not reset the RNN internal state
+                # unless we start a new batch.
+                for (X, Y) in self.patch_batch_generator(
+                    shot_sublist, patch_len, num_det, num_rand, slots
+                ):
                     for k in range(num_chunks):
-                        # epoch_end = (i == len(shot_sublists) - 1 and j ==
-                        # len(X_list) -1 and k == num_chunks - 1)
                         reset_states_now = k == 0
-                        start = k * batch_size
-                        end = (k + 1) * batch_size
                         num_so_far += (
-                            1.0 * len(shot_sublist) / (len(X_list) * num_chunks)
+                            1.0 * len(shot_sublist) / (num_batches * num_chunks)
                         )
-                        yield X[start:end], y[start:end], reset_states_now,
-                        num_so_far, num_total
+                        y = Y[k] if return_sequences else Y[k, :, -1]
+                        yield X[k], y, reset_states_now, num_so_far, num_total
+                        del y
+                    del X, Y
             epoch += 1
 
-    def fill_training_buffer(
-        self, Xbuff, Ybuff, end_indices, shot, is_first_fill=False
-    ):
+    def plan_patches(self, shot_list):
+        """Patch length, and the numbers of deterministic and random patches
+        of every shot of shot_list, drawn like make_patches draws them. They
+        are computed from the lengths in the metadata index, without loading
+        the shots."""
+        batch_size = self.conf["training"]["batch_size"]
+        lengths = self.get_normalized_lengths(shot_list)
+        patch_len = self.get_patch_length(lengths, self.conf["model"]["length"])
+        assert np.all(lengths >= patch_len)
+        # one patch per start in range(0, length - patch_len, patch_len) and
+        # one at the end of the shot
+        num_det = (lengths - 1) // patch_len + 1
+        num_already = int(np.sum(num_det))
+        num_additional = -(-num_already // batch_size) * batch_size - num_already
+        num_rand = np.bincount(
+            np.random.randint(len(shot_list), size=num_additional),
+            minlength=len(shot_list),
+        )
+        return patch_len, num_det, num_rand
+
+    def get_processed_lengths(self, shot_list):
+        """Lengths of the processed shots of shot_list (see
+        ShotList.get_lengths)."""
+        return shot_list.get_lengths(
+            self.conf["paths"]["processed_prepath"], self.conf["data"]["floatx"]
+        )
+
+    def get_normalized_lengths(self, shot_list):
+        """Lengths of the normalized shots of shot_list: their lengths in the
+        metadata index, as the normalizer would leave them (see
+        Normalizer.get_output_length)."""
+        lengths = self.get_processed_lengths(shot_list)
+        if self.normalizer is not None:
+            lengths = self.normalizer.get_output_length(lengths)
+        return lengths
+
+    def generate_patches(self, shot_list, patch_len, num_rand):
+        """The deterministic patches of every shot of shot_list followed by
+        num_rand[i] random patches of its i-th shot, as (signal, target)
+        views of the normalized shots. Shots are loaded one at a time."""
+        for (shot, num) in zip(shot_list, num_rand):
+            sig, res = self.get_signal_result_from_shot(shot)
+            max_start = len(sig) - patch_len
+            # a negative start would silently yield a short patch
+            assert max_start >= 0, (
+                "shot {} has {} timesteps, fewer than its planned patch "
+                "length {}".format(shot.number, len(sig), patch_len)
+            )
+            starts = list(range(0, max_start, patch_len)) + [max_start]
+            starts += list(np.random.randint(max_start + 1, size=num))
+            for start in starts:
+                yield sig[start : start + patch_len], res[start : start + patch_len]
+
+    def patch_batch_generator(self, shot_list, patch_len, num_det, num_rand, slots):
+        """Batches of the patches of shot_list (see generate_patches) in
+        random order, shuffled in a buffer of up to
+        conf['training']['patch_buffer_bytes'], but of at least one batch.
+
+        Yields X and Y of shapes (num_chunks, batch_size, length, ...) in a
+        free slot of slots, where X[k] holds the k-th chunk of model length of
+        every patch of the batch. Patches are copied into the buffer as their
+        shots are loaded and from there straight into place in the batch.
+        """
+        batch_size = self.conf["training"]["batch_size"]
+        length = self.conf["model"]["length"]
+        num_chunks = patch_len // length
+        num_patches = int(np.sum(num_det) + np.sum(num_rand))
+        buff = None
+        num_in_batch = 0
+        patches = self.generate_patches(shot_list, patch_len, num_rand)
+        for patch in itertools.chain(patches, [None]):
+            if patch is not None:
+                patch = [
+                    arr.reshape((num_chunks, length) + arr.shape[1:]) for arr in patch
+                ]
+                if buff is None:
+                    patch_bytes = sum(
+                        arr.size * np.dtype(dtype).itemsize
+                        for (arr, dtype) in zip(patch, slots.dtypes)
+                    )
+                    capacity = max(
+                        batch_size,
+                        self.conf["training"]["patch_buffer_bytes"] // patch_bytes,
+                    )
+                    buff = ShuffleBuffer(
+                        min(capacity, num_patches),
+                        [arr.shape for arr in patch],
+                        slots.dtypes,
+                    )
+                    batch_shapes = [
+                        (num_chunks, batch_size) + arr.shape[1:] for arr in patch
+                    ]
+                buff.put(*patch)
+            # take a patch whenever the buffer is full and all remaining
+            # patches once the shots are exhausted
+            while buff.is_full() or (patch is None and len(buff) > 0):
+                if num_in_batch == 0:
+                    X, Y = slots.acquire(batch_shapes)
+                buff.take(X[:, num_in_batch], Y[:, num_in_batch])
+                num_in_batch += 1
+                if num_in_batch == batch_size:
+                    yield X, Y
+                    del X, Y
+                    num_in_batch = 0
+        assert num_in_batch == 0
+
+    def fill_training_buffer(self, lanes, shot, is_first_fill=False):
+        """Write the signals and targets of shot into the first empty lane of
+        lanes and return the index of the lane."""
         sig, res = self.get_signal_result_from_shot(shot)
         length = self.conf["model"]["length"]
         if is_first_fill:  # cut signal to random position
@@ -121,40 +242,21 @@ class Loader(object):
         sig_len = res.shape[0]
         sig_len = (sig_len // length) * length  # make divisible by lenth
         assert sig_len > 0
-        batch_idx = np.where(end_indices == 0)[0][0]
-        if sig_len > Xbuff.shape[1]:
-            Xbuff = self.resize_buffer(Xbuff, sig_len + length)
-            Ybuff = self.resize_buffer(Ybuff, sig_len + length)
-        Xbuff[batch_idx, :sig_len, :] = sig[-sig_len:]
-        Ybuff[batch_idx, :sig_len, :] = res[-sig_len:]
-        end_indices[batch_idx] += sig_len
+        batch_idx = np.where(lanes.counts == 0)[0][0]
+        lanes.write(batch_idx, sig[-sig_len:], res[-sig_len:])
         # print("Filling buffer at index {}".format(batch_idx))
-        return Xbuff, Ybuff, batch_idx
+        return batch_idx
 
-    def return_from_training_buffer(self, Xbuff, Ybuff, end_indices):
+    def return_from_training_buffer(self, lanes, slots):
+        """The next model length timesteps of all lanes, in a free slot of
+        slots."""
         length = self.conf["model"]["length"]
-        end_indices -= length
-        assert np.all(end_indices >= 0)
-        X = 1.0 * Xbuff[:, :length, :]
-        Y = 1.0 * Ybuff[:, :length, :]
-        self.shift_buffer(Xbuff, length)
-        self.shift_buffer(Ybuff, length)
+        X, Y = slots.acquire(
+            [(buff.shape[0], length) + buff.shape[2:] for buff in lanes.buffers]
+        )
+        lanes.read(length, X, Y)
         return X, Y
 
-    def shift_buffer(self, buff, length):
-        buff[:, :-length, :] = buff[:, length:, :]
-
-    def resize_buffer(self, buff, new_length, dtype=None):
-        if dtype is None:
-            dtype = self.conf["data"]["floatx"]
-        old_length = buff.shape[1]
-        batch_size = buff.shape[0]
-        num_signals = buff.shape[2]
-        new_buff = np.zeros((batch_size, new_length, num_signals), dtype=dtype)
-        new_buff[:, :old_length, :] = buff
-        # print("Resizing buffer to new length {}".format(new_length))
-        return new_buff
-
     def inference_batch_generator_full_shot(self, shot_list):
         """
         The method implements a training batch generator as a Python generator
@@ -179,57 +281,32 @@ class Loader(object):
             the total dataset size as per shot_list
         """
         batch_size = self.conf["model"]["pred_batch_size"]
-        sig, res = self.get_signal_result_from_shot(shot_list.shots[0])
-        Xbuff = np.zeros((batch_size,) + sig.shape, dtype=self.conf["data"]["floatx"])
-        Ybuff = np.zeros((batch_size,) + res.shape, dtype=self.conf["data"]["floatx"])
-        Maskbuff = np.zeros(
-            (batch_size,) + res.shape, dtype=self.conf["data"]["floatx"]
-        )
-        disr = np.zeros(batch_size, dtype=bool)
-        lengths = np.zeros(batch_size, dtype=int)
-        # epoch = 0
+        _, res = self.get_signal_result_from_shot(shot_list[0])
+        # batches are padded to the longest shot so far
+        max_len = res.shape[0]
+        slots = self.make_batch_slots()
         num_total = len(shot_list)
         num_so_far = 0
-        #  returned = False
-        #  num_steps = 0
-        batch_idx = 0
+        shots = []
+        arrays = []
         np.seterr(all="raise")
-        # warmup_steps = self.conf['training']['batch_generator_warmup_steps']
-        # is_warmup_period = num_steps < warmup_steps
-        # is_first_fill = num_steps < batch_size
         while True:
             # the list of all shots
             # shot_list.shuffle()
             for i in range(num_total):
-                shot = shot_list.shots[i]
-                sig, res = self.get_signal_result_from_shot(shot)
-                sig_len = res.shape[0]
-                if sig_len > Xbuff.shape[1]:  # resize buffer if needed
-                    old_len = Xbuff.shape[1]
-                    Xbuff = self.resize_buffer(Xbuff, sig_len)
-                    Ybuff = self.resize_buffer(Ybuff, sig_len)
-                    Maskbuff = self.resize_buffer(Maskbuff, sig_len)
-                    Maskbuff[:, old_len:, :] = 0.0
-
-                Xbuff[batch_idx, :, :] = 0.0
-                Ybuff[batch_idx, :, :] = 0.0
-                Maskbuff[batch_idx, :, :] = 0.0
-                Xbuff[batch_idx, :sig_len, :] = sig
-                Ybuff[batch_idx, :sig_len, :] = res
-                Maskbuff[batch_idx, :sig_len, :] = 1.0
-                disr[batch_idx] = shot.is_disruptive_shot()
-                lengths[batch_idx] = res.shape[0]
-                batch_idx += 1
-                if batch_idx == batch_size:
+                shot = shot_list[i]
+                shots.append(shot)
+                arrays.append(self.get_signal_result_from_shot(shot))
+                max_len = max(max_len, arrays[-1][1].shape[0])
+                if len(shots) == batch_size:
                     num_so_far += batch_size
-                    x1 = 1.0 * Xbuff
-                    x2 = 1.0 * Ybuff
-                    x3 = 1.0 * Maskbuff
-                    x4 = disr & True
-                    x5 = 1 * lengths
-
-                    yield x1, x2, x3, x4, x5, num_so_far, num_total
-                    batch_idx = 0
+                    disr = np.array([s.is_disruptive_shot() for s in shots], dtype=bool)
+                    lengths = np.array([res.shape[0] for (_, res) in arrays], dtype=int)
+                    X, Y, Mask = self.fill_batch(slots, arrays, max_len)
+                    shots = []
+                    arrays = []
+                    yield X, Y, Mask, disr, lengths, num_so_far, num_total
+                    del X, Y, Mask
 
     def training_batch_generator_full_shot_partial_reset(self, shot_list):
         """
@@ -253,16 +330,13 @@ class Loader(object):
             total dataset size as per shot_list
         """
         batch_size = self.conf["training"]["batch_size"]
-        sig, res = self.get_signal_result_from_shot(shot_list.shots[0])
-        Xbuff = np.empty((batch_size,) + sig.shape, dtype=self.conf["data"]["floatx"])
-        Ybuff = np.empty((batch_size,) + res.shape, dtype=self.conf["data"]["floatx"])
-        Maskbuff = np.empty(
-            (batch_size,) + res.shape, dtype=self.conf["data"]["floatx"]
-        )
-        # epoch = 0
+        _, res = self.get_signal_result_from_shot(shot_list[0])
+        # batches are padded to the longest shot so far
+        max_len = res.shape[0]
+        slots = self.make_batch_slots()
         num_total = len(shot_list)
         num_so_far = 0
-        batch_idx = 0
+        arrays = []
         # warmup_steps = self.conf['training']['batch_generator_warmup_steps']
         # is_warmup_period = num_steps < warmup_steps
         # is_first_fill = num_steps < batch_size
@@ -271,42 +345,119 @@ class Loader(object):
             shot_list.shuffle()
             for i in range(num_total):
                 shot = self.sample_shot_from_list_given_index(shot_list, i)
-                sig, res = self.get_signal_result_from_shot(shot)
-                sig_len = res.shape[0]
-                if sig_len > Xbuff.shape[1]:  # resize buffer if needed
-                    old_len = Xbuff.shape[1]
-                    Xbuff = self.resize_buffer(Xbuff, sig_len)
-                    Ybuff = self.resize_buffer(Ybuff, sig_len)
-                    Maskbuff = self.resize_buffer(Maskbuff, sig_len)
-                    Maskbuff[:, old_len:, :] = 0.0
-
-                Xbuff[batch_idx, :, :] = 0.0
-                Ybuff[batch_idx, :, :] = 0.0
-                Maskbuff[batch_idx, :, :] = 0.0
-
-                Xbuff[batch_idx, :sig_len, :] = sig
-                Ybuff[batch_idx, :sig_len, :] = res
-                Maskbuff[batch_idx, :sig_len, :] = 1.0
-                batch_idx += 1
-                if batch_idx == batch_size:
+                arrays.append(self.get_signal_result_from_shot(shot))
+                max_len = max(max_len, arrays[-1][1].shape[0])
+                if len(arrays) == batch_size:
                     num_so_far += batch_size
-                    yield (
-                        1.0 * Xbuff,
-                        1.0 * Ybuff,
-                        1.0 * Maskbuff,
-                        num_so_far,
-                        num_total,
+                    X, Y, Mask = self.fill_batch(slots, arrays, max_len)
+                    arrays = []
+                    yield X, Y, Mask, num_so_far, num_total
+                    del X, Y, Mask
+
+    def training_batch_generator_full_shot_bucketed(self, shot_list):
+        """training_batch_generator_full_shot_partial_reset with batches of
+        shots of similar length.
+
+        The shots drawn for conf['training']['bucket_batches'] batches are
+        sorted by their processed length and split into batches, which are
+        yielded in random order. Every batch is padded only to its own longest
+        shot (see make_padded_batch). The fraction of padded timesteps is
+        printed after every epoch.
+        """
+        batch_size = self.conf["training"]["batch_size"]
+        pool_size = batch_size * self.conf["training"]["bucket_batches"]
+        # keyed by shot key, since shuffling the list reorders its rows
+        lengths = dict(
+            zip(
+                [shot.get_key() for shot in shot_list],
+                self.get_processed_lengths(shot_list),
+            )
+        )
+        slots = self.make_batch_slots()
+        num_total = len(shot_list)
+        num_so_far = 0
+        pool = []
+        num_padded = 0
+        num_unpadded = 0
+        while True:
+            shot_list.shuffle()
+            for i in range(num_total):
+                pool.append(self.sample_shot_from_list_given_index(shot_list, i))
+                if len(pool) < pool_size:
+                    continue
+                pool.sort(key=lambda shot: lengths[shot.get_key()])
+                batches = [
+                    pool[start : start + batch_size]
+                    for start in range(0, pool_size, batch_size)
+                ]
+                pool = []
+                for j in np.random.permutation(len(batches)):
+                    X, Y, Mask = self.make_padded_batch(slots, batches[j])
+                    num_so_far += batch_size
+                    num_padded += Mask.shape[0] * Mask.shape[1]
+                    num_unpadded += np.count_nonzero(Mask[:, :, 0])
+                    yield X, Y, Mask, num_so_far, num_total
+                    del X, Y, Mask
+            if num_padded > 0:
+                print(
+                    "Padding fraction of epoch: {:.2%}".format(
+                        1.0 - num_unpadded / num_padded
                     )
-                    batch_idx = 0
+                )
+                num_padded = num_unpadded = 0
+
+    def make_padded_batch(self, slots, shots):
+        """X, Y and Mask arrays of the normalized shots in a free slot of
+        slots, padded to the longest of them, rounded up to a multiple of
+        conf['model']['length'] with conf['training']['bucket_round_to_length']."""
+        arrays = [self.get_signal_result_from_shot(shot) for shot in shots]
+        max_len = self.get_padded_length(max(len(res) for (_, res) in arrays))
+        return self.fill_batch(slots, arrays, max_len)
+
+    def make_batch_slots(self):
+        """BatchSlots for the X, Y and Mask arrays of full-shot batches."""
+        floatx = self.conf["data"]["floatx"]
+        return BatchSlots([floatx, floatx, bool], self.allocate_buffer)
+
+    def set_buffer_allocator(self, allocate):
+        """Allocate the batch buffers with allocate(size, dtype), e.g. in pinned
+        memory, instead of np.empty. Prefetch workers always use np.empty."""
+        self.allocate_buffer = allocate
+
+    def fill_batch(self, slots, arrays, max_len):
+        """Write the (signal, ttd) arrays into X, Y and Mask arrays of a free
+        slot of slots, padded with zeros to max_len. Mask is True where Y
+        holds data."""
+        sig, res = arrays[0]
+        shape = (len(arrays), max_len)
+        X, Y, Mask = slots.acquire(
+            [shape + sig.shape[1:], shape + res.shape[1:], shape + res.shape[1:]]
+        )
+        for (i, (sig, res)) in enumerate(arrays):
+            sig_len = res.shape[0]
+            X[i, :sig_len, :] = sig
+            X[i, sig_len:, :] = 0.0
+            Y[i, :sig_len, :] = res
+            Y[i, sig_len:, :] = 0.0
+            Mask[i, :sig_len, :] = True
+            Mask[i, sig_len:, :] = False
+        return X, Y, Mask
+
+    def get_padded_length(self, max_len):
+        if self.conf["training"]["bucket_round_to_length"]:
+            length = self.conf["model"]["length"]
+            return length * Loader.get_num_skips(max_len, length)
+        return max_len
 
     def sample_shot_from_list_given_index(self, shot_list, i):
+        replace = not self.conf["training"]["sample_without_replacement"]
         if self.conf["training"]["ranking_difficulty_fac"] == 1.0:
             if self.conf["data"]["equalize_classes"]:
-                shot = shot_list.sample_equal_classes()
+                shot = shot_list.sample_equal_classes(replace)
             else:
-                shot = shot_list.shots[i]
+                shot = shot_list[i]
         else:  # draw the shot weighted
-            shot = shot_list.sample_weighted()
+            shot = shot_list.sample_weighted(replace)
         return shot
 
     def training_batch_generator_partial_reset(self, shot_list):
@@ -330,12 +481,14 @@ class Loader(object):
         total dataset size as per shot_list
         """
         batch_size = self.conf["training"]["batch_size"]
+        floatx = self.conf["data"]["floatx"]
         # length = self.conf['model']['length']
-        sig, res = self.get_signal_result_from_shot(shot_list.shots[0])
-        Xbuff = np.empty((batch_size,) + sig.shape, dtype=self.conf["data"]["floatx"])
-        Ybuff = np.empty((batch_size,) + res.shape, dtype=self.conf["data"]["floatx"])
-        end_indices = np.zeros(batch_size, dtype=np.int)
-        batches_to_reset = np.ones(batch_size, dtype=np.bool)
+        sig, res = self.get_signal_result_from_shot(shot_list[0])
+        lanes = LaneRing(
+            batch_size, [sig.shape[1:], res.shape[1:]], [floatx, floatx], sig.shape[0]
+        )
+        slots = BatchSlots([floatx, floatx], self.allocate_buffer)
+        batches_to_reset = np.ones(batch_size, dtype=bool)
         # epoch = 0
         num_total = len(shot_list)
         num_so_far = 0
@@ -348,18 +501,9 @@ class Loader(object):
             # the list of all shots
             shot_list.shuffle()
             for i in range(len(shot_list)):
-                if self.conf["training"]["ranking_difficulty_fac"] == 1.0:
-                    if self.conf["data"]["equalize_classes"]:
-                        shot = shot_list.sample_equal_classes()
-                    else:
-                        # TODO(KGF): test my merge of the "jdev" branch for the
-                        # following line into this set of conditionals
-                        shot = self.sample_shot_from_list_given_index(shot_list, i)
-                        # shot = shot_list.shots[i]
-                else:  # draw the shot weighted
-                    shot = shot_list.sample_weighted()
-                while not np.any(end_indices == 0):
-                    X, Y = self.return_from_training_buffer(Xbuff, Ybuff, end_indices)
+                shot = self.sample_shot_from_list_given_index(shot_list, i)
+                while not np.any(lanes.counts == 0):
+                    X, Y = self.return_from_training_buffer(lanes, slots)
                     yield (
                         X,
                         Y,
@@ -368,35 +512,104 @@ class Loader(object):
                         num_total,
                         is_warmup_period,
                     )
+                    del X, Y
                     returned = True
                     num_steps += 1
                     is_warmup_period = num_steps < warmup_steps
                     is_first_fill = num_steps < batch_size
                     batches_to_reset[:] = False
 
-                Xbuff, Ybuff, batch_idx = self.fill_training_buffer(
-                    Xbuff, Ybuff, end_indices, shot, is_first_fill
-                )
+                batch_idx = self.fill_training_buffer(lanes, shot, is_first_fill)
                 batches_to_reset[batch_idx] = True
                 if returned and not is_warmup_period:
                     num_so_far += 1
             # epoch += 1
 
-    def fill_batch_queue(self, shot_list, queue):
-        print("Starting thread to fill queue")
-        gen = self.training_batch_generator_partial_reset(shot_list)
-        while True:
-            ret = next(gen)
-            queue.put(ret, block=True, timeout=-1)
-
     def training_batch_generator_process(self, shot_list):
-        queue = mp.Queue()
-        proc = mp.Process(target=self.fill_batch_queue, args=(shot_list, queue))
-        proc.start()
-        while True:
-            yield queue.get(True)
-        proc.join()
-        queue.close()
+        """training_batch_generator_partial_reset run in a separate process,
+        which prefetches batches into conf['training']['prefetch_depth']
+        shared-memory slots. Batch arrays stay valid until the next batch
+        is drawn."""
+        batch_size = self.conf["training"]["batch_size"]
+        max_len, num_signals, num_targets = self.get_max_batch_dimensions(shot_list)
+        # the workers share the stores of a shot cache created before them
+        self.get_shot_cache()
+        prefetcher = BatchPrefetcher(
+            partial(self.training_batch_generator_shard, shot_list, partial_reset),
+            {
+                0: (batch_size * max_len * num_signals, self.conf["data"]["floatx"]),
+                1: (batch_size * max_len * num_targets, self.conf["data"]["floatx"]),
+            },
+            num_workers=1,
+            depth=self.conf["training"]["prefetch_depth"],
+            seed=np.random.randint(2 ** 31),
+        )
+        try:
+            for batch in prefetcher:
+                yield batch
+        finally:
+            prefetcher.close()
+
+    def training_batch_generator_prefetched(self, shot_list):
+        """training_batch_generator_full_shot_partial_reset run by
+        conf['training']['prefetch_workers'] processes, each on its own share
+        of shot_list, which prefetch batches into
+        conf['training']['prefetch_depth'] shared-memory slots.
+
+        Batch arrays stay valid until the next batch is drawn. The
+        prefetcher's data wait time is returned by get_data_wait_time().
+        """
+        batch_size = self.conf["training"]["batch_size"]
+        floatx = self.conf["data"]["floatx"]
+        max_len, num_signals, num_targets = self.get_max_batch_dimensions(shot_list)
+        capacity = batch_size * max_len
+        # the workers share the stores of a shot cache created before them
+        self.get_shot_cache()
+        self.prefetcher = BatchPrefetcher(
+            partial(self.training_batch_generator_shard, shot_list, full_shot),
+            {
+                0: (capacity * num_signals, floatx),
+                1: (capacity * num_targets, floatx),
+                2: (capacity * num_targets, bool),
+            },
+            num_workers=self.conf["training"]["prefetch_workers"],
+            depth=self.conf["training"]["prefetch_depth"],
+            seed=np.random.randint(2 ** 31),
+        )
+        num_total = len(shot_list)
+        num_so_far = 0
+        try:
+            for (X, Y, Mask, _, _) in self.prefetcher:
+                num_so_far += batch_size
+                yield X, Y, Mask, num_so_far, num_total
+        finally:
+            self.prefetcher.close()
+
+    def training_batch_generator_shard(
+        self, shot_list, generator_fn, worker_id, num_workers
+    ):
+        """The batch generator generator_fn(self, shard) of worker worker_id,
+        on every num_workers-th shot of shot_list."""
+        # batches are copied into the prefetcher's shared slots, so there is
+        # no use for pinned buffers, which a forked worker cannot allocate
+        self.allocate_buffer = np.empty
+        shard = shot_list[worker_id::num_workers]
+        return generator_fn(self, shard)
+
+    def get_max_batch_dimensions(self, shot_list):
+        """Upper bounds of the time, signal and target dimensions of the
+        batches drawn from shot_list, from the processed shot lengths."""
+        max_len = self.get_padded_length(
+            int(np.max(self.get_processed_lengths(shot_list)))
+        )
+        sig, res = self.get_signal_result_from_shot(shot_list[0])
+        return max_len, sig.shape[1], res.shape[1]
+
+    def get_data_wait_time(self):
+        """Seconds spent waiting for prefetched batches so far."""
+        if self.prefetcher is None:
+            return 0.0
+        return self.prefetcher.wait_time
 
     def load_as_X_y_list(self, shot_list, verbose=False, prediction_mode=False):
         """
@@ -463,8 +676,6 @@ class Loader(object):
         return X, y, shot_lengths, disruptive
 
     def get_signals_results_from_shotlist(self, shot_list, prediction_mode=False):
-        prepath = self.conf["paths"]["processed_prepath"]
-        use_signals = self.conf["paths"]["use_signals"]
         signals = []
         results = []
         disruptive = []
@@ -473,19 +684,9 @@ class Loader(object):
         for shot in shot_list:
             assert isinstance(shot, Shot)
             assert shot.valid
-            shot.restore(prepath)
-
-            if self.normalizer is not None:
-                self.normalizer.apply(shot)
-            else:
-                print(
-                    "Warning, no normalization. ",
-                    "Training data may be poorly conditioned",
-                )
-
             if self.conf["training"]["use_mock_data"]:
                 signal, ttd = self.get_mock_data()
-            ttd, signal = shot.get_data_arrays(use_signals, self.conf["data"]["floatx"])
+            ttd, signal = self.get_normalized_arrays(shot)
             if len(ttd) < self.conf["model"]["length"]:
                 print(ttd)
                 print(shot)
@@ -506,21 +707,11 @@ class Loader(object):
             return signals, results, shot_lengths, disruptive
 
     def get_signal_result_from_shot(self, shot, prediction_mode=False):
-        prepath = self.conf["paths"]["processed_prepath"]
-        use_signals = self.conf["paths"]["use_signals"]
         assert isinstance(shot, Shot)
         assert shot.valid
-        shot.restore(prepath)
-        if self.normalizer is not None:
-            self.normalizer.apply(shot)
-        else:
-            print(
-                "Warning, no normalization. ", "Training data may be poorly conditioned"
-            )
-
         if self.conf["training"]["use_mock_data"]:
             signal, ttd = self.get_mock_data()
-        ttd, signal = shot.get_data_arrays(use_signals, self.conf["data"]["floatx"])
+        ttd, signal = self.get_normalized_arrays(shot)
         if len(ttd) < self.conf["model"]["length"]:
             print(ttd)
             print(shot)
@@ -536,6 +727,131 @@ class Loader(object):
         else:
             return signal, ttd, shot.is_disruptive
 
+    def get_normalized_arrays(self, shot):
+        """Return ttd and the use_signals array of a valid shot after
+        restoring and normalizing it.
+
+        With conf['data']['cache_normalized_shots'], the arrays are read from
+        a store of normalized shots, written on first touch. They are then
+        read-only views of its memory map, with ttd as a 2D array. With
+        conf['data']['shot_cache_bytes'] > 0, they are also kept in the
+        Loader's shot cache (see get_shot_cache) and then read-only.
+        """
+        cache = self.get_shot_cache()
+        if cache is not None:
+            key = (shot.machine, shot.number, self.normalizer.inference_mode)
+            arrays = cache.get(key)
+            if arrays is not None:
+                return arrays
+        store = self.get_normalized_store(shot.machine)
+        arrays = None
+        if store is not None:
+            arrays = read_normalized_arrays(store, shot.number)
+            if arrays is None:
+                # another process may have stored the shot since the index
+                # was read
+                store.invalidate()
+                arrays = read_normalized_arrays(store, shot.number)
+        if arrays is None:
+            arrays = self.normalize_shot(shot)
+            if store is not None:
+                append_normalized_arrays(store, shot.number, *arrays)
+        if cache is not None:
+            cache.put(key, *arrays)
+        return arrays
+
+    def normalize_shot(self, shot):
+        shot.restore(
+            self.conf["paths"]["processed_prepath"], dtype=self.conf["data"]["floatx"]
+        )
+        if self.normalizer is not None:
+            self.normalizer.apply(shot)
+        else:
+            print(
+                "Warning, no normalization. ", "Training data may be poorly conditioned"
+            )
+        use_signals = self.conf["paths"]["use_signals"]
+        return shot.get_data_arrays(use_signals, self.conf["data"]["floatx"])
+
+    def get_shot_cache(self):
+        """The cache of normalized shots shared by all batch generators of
+        the Loader, holding up to conf['data']['shot_cache_bytes'], or None.
+
+        With conf['data']['shot_cache_shm'] the cache lives in shared memory,
+        where prefetch workers and the trainer see a single copy; otherwise
+        every process caches the shots it loads. Like normalized shot stores,
+        it is only used for normalizers with fingerprints.
+        """
+        if self.conf["data"]["shot_cache_bytes"] <= 0 or not hasattr(
+            self.normalizer, "get_fingerprint"
+        ):
+            return None
+        if self.shot_cache is None:
+            if self.conf["data"]["shot_cache_shm"]:
+                self.shot_cache = SharedShotCache(
+                    self.conf["data"]["shot_cache_bytes"],
+                    self.get_normalized_store,
+                    self.conf["paths"]["processed_prepath"],
+                )
+            else:
+                self.shot_cache = ShotCache(self.conf["data"]["shot_cache_bytes"])
+        return self.shot_cache
+
+    def close(self):
+        """Release the shot cache, removing its shared-memory stores."""
+        if self.shot_cache is not None:
+            self.shot_cache.close()
+            self.shot_cache = None
+        self.normalized_stores = dict()
+
+    def get_normalized_store(self, machine, prepath=None):
+        """The store of normalized shots of a machine for the current
+        normalizer, config and inference mode below prepath, or None if
+        normalized shots are not cached. Augmented shots are never cached.
+        prepath defaults to the processed_prepath, where normalized shots are
+        only stored with conf['data']['cache_normalized_shots']. The stores
+        are looked up per machine, prepath, inference mode and normalizer
+        fingerprint."""
+        if not hasattr(self.normalizer, "get_fingerprint"):
+            return None
+        conf = self.conf
+        if prepath is None:
+            if not conf["data"]["cache_normalized_shots"]:
+                return None
+            prepath = conf["paths"]["processed_prepath"]
+        key = (
+            machine,
+            prepath,
+            self.normalizer.inference_mode,
+            self.normalizer.get_fingerprint(),
+        )
+        store = self.normalized_stores.get(key)
+        if store is None:
+            store = self.open_normalized_store(machine, prepath)
+            self.normalized_stores[key] = store
+        return store
+
+    def open_normalized_store(self, machine, prepath):
+        conf = self.conf
+        name = myhash(
+            "{} {} {} {} {} {} {} {} {}".format(
+                self.normalizer.get_fingerprint(),
+                [sig.description_plus_paths() for sig in conf["paths"]["use_signals"]],
+                conf["data"]["target"].__name__,
+                conf["data"]["T_warning"],
+                conf["data"]["cut_shot_ends"],
+                conf["data"]["T_min_warn"],
+                conf["model"]["length"],
+                conf["data"]["floatx"],
+                self.normalizer.inference_mode,
+            )
+        )
+        return open_store(
+            os.path.join(prepath, "normalized_{}".format(name), machine.name),
+            dtype=conf["data"]["floatx"],
+            extra_fields=NORMALIZED_SHOT_FIELDS,
+        )
+
     def batch_output_to_array(self, output, batch_size=None):
         if batch_size is None:
             batch_size = self.conf["model"]["pred_batch_size"]
@@ -599,11 +915,12 @@ class Loader(object):
         return sig[start : start + min_len], res[start : start + min_len]
 
     def get_min_len(self, arrs, length):
-        min_len = min(
-            [len(a) for a in arrs] + [self.conf["training"]["max_patch_length"]]
-        )
+        return self.get_patch_length([len(a) for a in arrs], length)
+
+    def get_patch_length(self, lengths, length):
+        min_len = min(list(lengths) + [self.conf["training"]["max_patch_length"]])
         min_len = max(1, min_len // length) * length
-        return min_len
+        return int(min_len)
 
     def get_max_len(self, arrs, length):
         max_len = max([len(a) for a in arrs])
@@ -762,7 +1079,7 @@ class Loader(object):
         assert shot.valid
         prepath = self.conf["paths"]["processed_prepath"]
         return_sequences = self.conf["model"]["return_sequences"]
-        shot.restore(prepath)
+        shot.restore(prepath, dtype=self.conf["data"]["floatx"])
 
         if self.normalizer is not None:
             self.normalizer.apply(shot)
@@ -863,26 +1180,11 @@ class Loader(object):
         return 1 + (length - 1) // skip
 
 
-class ProcessGenerator(object):
-    def __init__(self, generator):
-        self.generator = generator
-        self.proc = mp.Process(target=self.fill_batch_queue)
-        self.queue = mp.Queue()
-        self.proc.start()
-
-    def fill_batch_queue(self):
-        print("Starting process to fetch data")
-        count = 0
-        while True:
-            self.queue.put(next(self.generator), True)
-            count += 1
-
-    def __next__(self):
-        return self.queue.get(True)
+def full_shot(loader, shot_list):
+    if loader.conf["training"]["bucket_batches"] > 0:
+        return loader.training_batch_generator_full_shot_bucketed(shot_list)
+    return loader.training_batch_generator_full_shot_partial_reset(shot_list)
 
-    def next(self):
-        return self.__next__()
 
-    def __exit__(self):
-        self.proc.terminate()
-        self.queue.close()
+def partial_reset(loader, shot_list):
+    return loader.training_batch_generator_partial_reset(shot_list)
@@ -14,12 +14,13 @@ import os
 import time
 import sys
 import abc
+import hashlib
 
 import numpy as np
-from scipy.signal import exponential, correlate
 import multiprocessing as mp
 
-from shots import ShotList, Shot
+from processing import get_exponential_window, correlate_valid, StreamingCorrelator
+from shots import ShotList, Shot, SIGNAL_STATS_COLUMNS, get_processed_store
 
 """TODO
 - incorporate stats, pass machine (perhaps save machine in stats object!)
@@ -37,6 +38,61 @@ class Stats(object):
     pass
 
 
+class NormalizationPlan(object):
+    """Per-channel normalization of a shot's whole signals array, computed
+    once per machine and signal list:
+
+        x -> clip((x - offset) / scale, lo, hi)
+
+    Positivity constraints are folded into lo, since clipping at 0 before the
+    affine map is the same as clipping at (0 - offset) / scale after it."""
+
+    def __init__(self, offset, scale, bounded, positive, bound):
+        self.offset = offset
+        self.scale = scale
+        self.bounded = bounded
+        self.positive = positive
+        self.bound = bound
+        # offset, scale, lo and hi cast to the dtype of the signals array
+        self.vectors = dict()
+
+    def get_vectors(self, dtype):
+        vectors = self.vectors.get(dtype)
+        if vectors is None:
+            offset = self.offset.astype(dtype)
+            scale = self.scale.astype(dtype)
+            lo = np.where(self.bounded, -self.bound, -np.inf).astype(dtype)
+            hi = np.where(self.bounded, self.bound, np.inf).astype(dtype)
+            lo[self.positive] = np.maximum(
+                lo[self.positive],
+                (dtype.type(0) - offset[self.positive]) / scale[self.positive],
+            )
+            vectors = (
+                offset if np.any(offset != 0) else None,
+                scale if np.any(scale != 1) else None,
+                (lo, hi)
+                if np.any(np.isfinite(lo)) or np.any(np.isfinite(hi))
+                else None,
+            )
+            self.vectors[dtype] = vectors
+        return vectors
+
+    def apply(self, shot):
+        """Normalize shot.signals_array in place, copying it first only if it
+        is read-only."""
+        arr = shot.signals_array
+        offset, scale, clip = self.get_vectors(arr.dtype)
+        out = arr if arr.flags.writeable else None
+        if offset is not None:
+            out = np.subtract(arr, offset, out=out)
+        if scale is not None:
+            out = np.divide(arr if out is None else out, scale, out=out)
+        if clip is not None:
+            out = np.clip(arr if out is None else out, clip[0], clip[1], out=out)
+        if out is not None:
+            shot.signals_array = out
+
+
 class Normalizer(object):
     def __init__(self, conf):
         self.num_processed = dict()
@@ -74,6 +130,39 @@ class Normalizer(object):
     def load_stats(self, verbose=False):
         pass
 
+    def freeze_stats(self):
+        """Precompute what apply() needs from the accumulated stats."""
+        pass
+
+    def get_fingerprint(self):
+        """Hash of the normalizer type, settings and stats, which together
+        determine the output of apply() for a given inference mode. It is
+        cached until the stats change (see invalidate_fingerprint)."""
+        fingerprint = self.__dict__.get("_fingerprint")
+        if fingerprint is None:
+            fingerprint = self.compute_fingerprint()
+            self._fingerprint = fingerprint
+        return fingerprint
+
+    def invalidate_fingerprint(self):
+        self.__dict__.pop("_fingerprint", None)
+
+    def compute_fingerprint(self):
+        md5 = hashlib.md5(
+            "{} {}".format(type(self).__name__, self.bound).encode("utf-8")
+        )
+        for machine in sorted(self.num_processed, key=lambda m: m.name):
+            if self.num_processed[machine] == 0:
+                continue
+            md5.update(machine.name.encode("utf-8"))
+            for arr in self.get_fingerprint_arrays(machine):
+                md5.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        return md5.hexdigest()
+
+    def get_fingerprint_arrays(self, machine):
+        """Arrays of the stats of a machine that apply() uses."""
+        return []
+
     def print_summary(self, action="loaded"):
         g.print_unique(
             "{} normalization data from {} shots ( {} disruptive )".format(
@@ -132,22 +221,36 @@ class Normalizer(object):
             if previously_saved:
                 self.load_stats(verbose=True)
             print("computing normalization for machines {}".format(machines_to_compute))
-            use_cores = max(1, mp.cpu_count() - 2)
-            pool = mp.Pool(use_cores)
-            print("running in parallel on {} processes".format(pool._processes))
             start_time = time.time()
-
-            for (i, stats) in enumerate(
-                pool.imap_unordered(self.train_on_single_shot, shot_list_picked)
-            ):
-                # for (i,stats) in
-                # enumerate(map(self.train_on_single_shot,shot_list_picked)):
-                if stats.machine in machines_to_compute:
+            # the signal stats saved during preprocessing suffice for most
+            # shots; only shots without them are restored
+            shots_to_restore = []
+            for shot in shot_list_picked:
+                stats = self.extract_saved_stats(shot)
+                if stats is None:
+                    shots_to_restore.append(shot)
+                elif stats.machine in machines_to_compute:
                     self.incorporate_stats(stats)
                     self.machines.add(stats.machine)
-                sys.stdout.write("\r" + "{}/{}".format(i, len(shot_list_picked)))
-            pool.close()
-            pool.join()
+            print(
+                "used saved signal stats of {}/{} shots".format(
+                    len(shot_list_picked) - len(shots_to_restore),
+                    len(shot_list_picked),
+                )
+            )
+            if len(shots_to_restore) > 0:
+                use_cores = max(1, mp.cpu_count() - 2)
+                pool = mp.Pool(use_cores)
+                print("running in parallel on {} processes".format(pool._processes))
+                for (i, stats) in enumerate(
+                    pool.imap_unordered(self.train_on_single_shot, shots_to_restore)
+                ):
+                    if stats.machine in machines_to_compute:
+                        self.incorporate_stats(stats)
+                        self.machines.add(stats.machine)
+                    sys.stdout.write("\r" + "{}/{}".format(i, len(shots_to_restore)))
+                pool.close()
+                pool.join()
             print(
                 "\nFinished Training Normalizer on ",
                 "{} files in {} seconds".format(
@@ -155,6 +258,7 @@ class Normalizer(object):
                 ),
             )
             self.save_stats(verbose=True)
+            self.freeze_stats()
         else:
             self.load_stats(verbose=verbose)
         # print representation of trained Normalizer to stdout:
@@ -162,6 +266,17 @@ class Normalizer(object):
         if verbose:
             g.print_unique(self)
 
+    def get_output_length(self, length):
+        """Number of timesteps apply() leaves of a shot of the given length
+        (an int or an array of lengths), without loading the shot.
+        Subclasses that drop further timesteps override this."""
+        # only cut shots during training
+        if self.inference_mode or not self.conf["data"]["cut_shot_ends"]:
+            return length
+        T_min_warn = self.conf["data"]["T_min_warn"]
+        cut = length - T_min_warn > max(self.conf["model"]["length"], 0)
+        return np.where(cut, length - T_min_warn, length)
+
     def cut_end_of_shot(self, shot):
         cut_shot_ends = self.conf["data"]["cut_shot_ends"]
         # only cut shots during training
@@ -173,8 +288,7 @@ class Normalizer(object):
                     "T_min_warn would be shorter than RNN length",
                 )
                 return
-            for key in shot.signals_dict:
-                shot.signals_dict[key] = shot.signals_dict[key][:-T_min_warn, :]  # noqa
+            shot.signals_array = shot.signals_array[:-T_min_warn, :]
             shot.ttd = shot.ttd[:-T_min_warn]
 
     # def apply_mask(self,shot):
@@ -188,10 +302,39 @@ class Normalizer(object):
     #     i,indices_sublist in enumerate(self.get_indices_list())])
     #     shot.signals[:,indices] = np.clip(shot.signals[:,indices],0,np.Inf)
 
+    def extract_saved_stats(self, shot):
+        """Stats of a processed shot from its metadata record and the signal
+        stats saved during preprocessing, without restoring its signals.
+        Returns None if they were not saved or the normalizer cannot use
+        them."""
+        processed_prepath = self.conf["paths"]["processed_prepath"]
+        store = get_processed_store(
+            processed_prepath, shot.machine, self.conf["data"]["floatx"]
+        )
+        record = store.get_record(shot.number)
+        if record is None:
+            return None
+        stats = Stats()
+        stats.valid = bool(record["valid"])
+        stats.machine = shot.machine
+        if not stats.valid:
+            print("Warning: shot {} not valid, omitting".format(shot.number))
+            return stats
+        signal_stats = shot.restore_signal_stats(processed_prepath)
+        if signal_stats is None:
+            return None
+        stats.is_disruptive = bool(record["is_disruptive"])
+        return self.extract_stats_from_signal_stats(stats, signal_stats)
+
+    def extract_stats_from_signal_stats(self, stats, signal_stats):
+        """Complete stats of a valid shot from its signal stats (see
+        Shot.get_signal_stats), or return None if not supported."""
+        return None
+
     def train_on_single_shot(self, shot):
         assert isinstance(shot, Shot), "should be instance of shot"
         processed_prepath = self.conf["paths"]["processed_prepath"]
-        shot.restore(processed_prepath)
+        shot.restore(processed_prepath, dtype=self.conf["data"]["floatx"])
         # print(shot)
         stats = self.extract_stats(shot)
         shot.make_light()
@@ -222,8 +365,15 @@ class Normalizer(object):
 class MeanVarNormalizer(Normalizer):
     def __init__(self, conf):
         Normalizer.__init__(self, conf)
+        # per machine, one row of per-signal means and stds for every shot
         self.means = dict()
         self.stds = dict()
+        # growable arrays backing self.means and self.stds while training
+        self.buffers = dict()
+        # per machine median means and stds, frozen by freeze_stats()
+        self.medians = dict()
+        # per (machine, signal registry) NormalizationPlan used by apply()
+        self.plans = dict()
         self.bound = np.Inf
         if "norm_stat_range" in self.conf["data"]:
             self.bound = self.conf["data"]["norm_stat_range"]
@@ -231,8 +381,7 @@ class MeanVarNormalizer(Normalizer):
     def __str__(self):
         s = ""
         for machine in self.means:
-            means = np.median(self.means[machine], axis=0)
-            stds = np.median(self.stds[machine], axis=0)
+            means, stds = self.get_medians(machine)
             s += "Machine = {}:\nMean Var Normalizer.\n".format(machine)
             s += "means: {}\nstds: {}".format(means, stds)
         return s
@@ -256,47 +405,113 @@ class MeanVarNormalizer(Normalizer):
         stats.machine = shot.machine
         return stats
 
+    def extract_stats_from_signal_stats(self, stats, signal_stats):
+        count = np.maximum(signal_stats[:, SIGNAL_STATS_COLUMNS.index("count")], 1)
+        sums = signal_stats[:, SIGNAL_STATS_COLUMNS.index("sum")]
+        stds = signal_stats[:, SIGNAL_STATS_COLUMNS.index("std")]
+        stats.means = np.reshape(sums / count, (1, -1))
+        stats.stds = np.reshape(stds, (1, -1))
+        return stats
+
     def incorporate_stats(self, stats):
         machine = stats.machine
         self.ensure_machine(stats.machine)
         if stats.valid:
-            means = stats.means
-            stds = stats.stds
-            if self.num_processed[machine] == 0:
-                self.means[machine] = means
-                self.stds[machine] = stds
-            else:
-                self.means[machine] = np.concatenate(
-                    (self.means[machine], means), axis=0
-                )
-                self.stds[machine] = np.concatenate((self.stds[machine], stds), axis=0)
+            num_rows = self.num_processed[machine]
+            self.means[machine] = self.append_rows(
+                "means", machine, stats.means, num_rows
+            )
+            self.stds[machine] = self.append_rows("stds", machine, stats.stds, num_rows)
             self.num_processed[machine] = self.num_processed[machine] + 1
             self.num_disruptive[machine] = self.num_disruptive[machine] + (
                 1 if stats.is_disruptive else 0
             )
+            self.unfreeze_stats(machine)
 
-    def apply(self, shot):
-        apply_positivity(shot)
-        m = shot.machine
-        assert (
-            self.means[m] is not None and self.stds[m] is not None
-        ), "self.means or self.stds not initialized"
-        means = np.median(self.means[m], axis=0)
-        stds = np.median(self.stds[m], axis=0)
+    def append_rows(self, name, machine, rows, num_rows):
+        """Append rows to the first num_rows rows of the stats array name
+        ("means" or "stds") of a machine and return a view of the result.
+
+        The rows are written into a buffer of doubling capacity, so training
+        on N shots copies O(N) rows instead of O(N**2).
+        """
+        key = (name, machine)
+        buf = self.buffers.get(key)
+        size = num_rows + rows.shape[0]
+        if buf is None or buf.shape[0] < size or buf.shape[1:] != rows.shape[1:]:
+            new_buf = np.empty((max(16, 2 * size),) + rows.shape[1:], dtype=rows.dtype)
+            if num_rows > 0:
+                new_buf[:num_rows] = getattr(self, name)[machine][:num_rows]
+            buf = new_buf
+            self.buffers[key] = buf
+        buf[num_rows:size] = rows
+        return buf[:size]
+
+    def get_medians(self, machine):
+        """Median means and stds of a machine's shots, with zero stds set to
+        1. Computed once and kept until new stats are incorporated."""
+        medians = self.medians.get(machine)
+        if medians is None:
+            assert (
+                self.means[machine] is not None and self.stds[machine] is not None
+            ), "self.means or self.stds not initialized"
+            means = np.median(self.means[machine], axis=0)
+            stds = np.median(self.stds[machine], axis=0)
+            stds = np.where(stds == 0.0, 1.0, stds)
+            medians = (means, stds)
+            self.medians[machine] = medians
+        return medians
+
+    def get_fingerprint_arrays(self, machine):
+        return self.get_medians(machine)
+
+    def get_plan(self, shot):
+        """NormalizationPlan for the signals of a shot, cached per machine
+        and signal list."""
+        key = (shot.machine, shot.get_registry())
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = self.make_plan(shot)
+            self.plans[key] = plan
+        return plan
+
+    def make_plan(self, shot, subtract_means=True):
+        means, stds = self.get_medians(shot.machine)
+        registry = shot.get_registry()
+        offset = np.zeros(registry.num_channels)
+        scale = np.ones(registry.num_channels)
+        bounded = np.zeros(registry.num_channels, dtype=bool)
+        positive = np.zeros(registry.num_channels, dtype=bool)
         for (i, sig) in enumerate(shot.signals):
+            cols = registry.get_slice(sig)
             if sig.normalize:
-                stds_curr = stds[i]
-                if stds_curr == 0.0:
-                    stds_curr = 1.0
-                shot.signals_dict[sig] = (shot.signals_dict[sig] - means[i]) / stds_curr
-                shot.signals_dict[sig] = np.clip(
-                    shot.signals_dict[sig], -self.bound, self.bound
-                )
+                if subtract_means:
+                    offset[cols] = means[i]
+                scale[cols] = stds[i]
+                bounded[cols] = True
+            # backwards compatibility when this attribute didn't exist
+            if getattr(sig, "is_strictly_positive", False):
+                positive[cols] = True
+        return NormalizationPlan(offset, scale, bounded, positive, self.bound)
 
-        shot.ttd = self.remapper(shot.ttd, self.conf["data"]["T_warning"])
+    def freeze_stats(self):
+        self.invalidate_fingerprint()
+        self.medians = dict()
+        self.plans = dict()
+        for machine in self.means:
+            self.get_medians(machine)
+
+    def unfreeze_stats(self, machine):
+        self.invalidate_fingerprint()
+        self.medians.pop(machine, None)
+        for key in [key for key in self.plans if key[0] == machine]:
+            del self.plans[key]
+
+    def apply(self, shot):
+        # cutting first leaves fewer rows to normalize
         self.cut_end_of_shot(shot)
-        # self.apply_positivity_mask(shot)
-        # self.apply_mask(shot)
+        self.get_plan(shot).apply(shot)
+        shot.ttd = self.remapper(shot.ttd, self.conf["data"]["T_warning"])
 
     def save_stats(self, verbose=False):
         # standard_deviations = dat['standard_deviations']
@@ -322,6 +537,8 @@ class MeanVarNormalizer(Normalizer):
         self.num_processed = dat["num_processed"][()]
         self.num_disruptive = dat["num_disruptive"][()]
         self.machines = dat["machines"][()]
+        self.buffers = dict()
+        self.freeze_stats()
         # for machine in self.means:
         #     g.print_unique('Machine = {}:'.format(machine))
         if verbose:
@@ -329,83 +546,98 @@ class MeanVarNormalizer(Normalizer):
 
 
 class VarNormalizer(MeanVarNormalizer):
-    def apply(self, shot):
-        apply_positivity(shot)
-        assert (
-            self.means is not None and self.stds is not None
-        ), "self.means or self.stds not initialized"
-        m = shot.machine
-        stds = np.median(self.stds[m], axis=0)
-        for (i, sig) in enumerate(shot.signals):
-            if sig.normalize:
-                stds_curr = stds[i]
-                if stds_curr == 0.0:
-                    stds_curr = 1.0
-                shot.signals_dict[sig] = (shot.signals_dict[sig]) / stds_curr
-                shot.signals_dict[sig] = np.clip(
-                    shot.signals_dict[sig], -self.bound, self.bound
-                )
-        shot.ttd = self.remapper(shot.ttd, self.conf["data"]["T_warning"])
-        self.cut_end_of_shot(shot)
+    def make_plan(self, shot):
+        return MeanVarNormalizer.make_plan(self, shot, subtract_means=False)
 
     def applyandprint(self, shot):
-        apply_positivity(shot)
-        assert (
-            self.means is not None and self.stds is not None
-        ), "self.means or self.stds not initialized"
-        m = shot.machine
-        stds = np.median(self.stds[m], axis=0)
+        print("***=============******************* Applying normalization!!!")
+        _, stds = self.get_medians(shot.machine)
         for (i, sig) in enumerate(shot.signals):
-            print("***=============******************* Applying normalization!!!")
-            print("***=============******************* Applying normalization!!!")
-            print("***=============******************* Applying normalization!!!")
             if sig.normalize:
-                stds_curr = stds[i]
-                if stds_curr == 0.0:
-                    stds_curr = 1.0
-                shot.signals_dict[sig] = (shot.signals_dict[sig]) / stds_curr
-                print(sig.description, sig.normalize, stds_curr, self.bound)
-                shot.signals_dict[sig] = np.clip(
-                    shot.signals_dict[sig], -self.bound, self.bound
-                )
-        shot.ttd = self.remapper(shot.ttd, self.conf["data"]["T_warning"])
-        self.cut_end_of_shot(shot)
+                print(sig.description, sig.normalize, stds[i], self.bound)
+        self.apply(shot)
 
     def __str__(self):
         s = ""
         for m in self.stds:
-            stds = np.median(self.stds[m], axis=0)
+            _, stds = self.get_medians(m)
             s += "Machine: {}:\n".format(m)
             s += "Var Normalizer.\nstds: {}\n".format(stds)
         return s
 
 
 class AveragingVarNormalizer(VarNormalizer):
+    """VarNormalizer followed by causal exponential smoothing of the
+    normalized signals. A shot loses its first window_size - 1 timesteps."""
+
+    def __init__(self, conf):
+        VarNormalizer.__init__(self, conf)
+        # per signal registry mask of the smoothed (normalized) columns
+        self.smoothed_columns = dict()
+
+    def get_fingerprint_arrays(self, machine):
+        return list(VarNormalizer.get_fingerprint_arrays(self, machine)) + [
+            self.get_window()
+        ]
+
+    def get_window(self):
+        return get_exponential_window(
+            self.conf["data"]["window_size"], self.conf["data"]["window_decay"]
+        )
+
+    def get_smoothed_columns(self, shot):
+        registry = shot.get_registry()
+        mask = self.smoothed_columns.get(registry)
+        if mask is None:
+            mask = np.zeros(registry.num_channels, dtype=bool)
+            for sig in shot.signals:
+                mask[registry.get_slice(sig)] = sig.normalize
+            self.smoothed_columns[registry] = mask
+        return mask
+
     def apply(self, shot):
-        apply_positivity(shot)
         super(AveragingVarNormalizer, self).apply(shot)
-        window_decay = self.conf["data"]["window_decay"]
-        window_size = self.conf["data"]["window_size"]
-        window = exponential(window_size, 0, window_decay, False)
-        window /= np.sum(window)
-        for (i, sig) in enumerate(shot.signals):
-            if sig.normalize:
-                shot.signals_dict[sig] = np.apply_along_axis(
-                    lambda m: correlate(m, window, "valid"),
-                    axis=0,
-                    arr=shot.signals_dict[sig],
-                )
-                shot.signals_dict[sig] = np.clip(
-                    shot.signals_dict[sig], -self.bound, self.bound
-                )
-        shot.ttd = shot.ttd[-shot.signals.shape[0] :]
+        arr = shot.signals_array
+        mask = self.get_smoothed_columns(shot)
+        out = correlate_valid(arr, self.get_window())
+        T = out.shape[0]
+        # unsmoothed columns keep their values at the same (latest) times
+        out[:, ~mask] = arr[arr.shape[0] - T :, ~mask]
+        out[:, mask] = np.clip(out[:, mask], -self.bound, self.bound)
+        shot.signals_array = out
+        shot.ttd = shot.ttd[shot.ttd.shape[0] - T :]
+
+    def get_output_length(self, length):
+        length = VarNormalizer.get_output_length(self, length)
+        return np.maximum(length - (self.conf["data"]["window_size"] - 1), 0)
+
+    def get_streaming_smoother(self, shot):
+        """StreamingCorrelator for smoothing the normalized rows of a shot
+        one at a time with smooth_step(), e.g. for real-time inference."""
+        return StreamingCorrelator(
+            self.get_window(),
+            shot.get_registry().num_channels,
+            self.conf["data"]["floatx"],
+        )
+
+    def smooth_step(self, shot, smoother, row):
+        """Smooth the next normalized row of a shot's signals array, as
+        apply() does for a whole shot. Returns None until the smoother has
+        seen window_size rows."""
+        smoothed = smoother.step(row)
+        if smoothed is None:
+            return None
+        mask = self.get_smoothed_columns(shot)
+        smoothed[~mask] = row[~mask]
+        smoothed[mask] = np.clip(smoothed[mask], -self.bound, self.bound)
+        return smoothed
 
     def __str__(self):
         window_decay = self.conf["data"]["window_decay"]
         window_size = self.conf["data"]["window_size"]
         s = ""
         for m in self.stds:
-            stds = np.median(self.stds[m], axis=0)
+            _, stds = self.get_medians(m)
             s += "Machine: {}:\n".format(m)
             s += "Averaging Var Normalizer.\nstds: "
             s += " {}\nWindow size: {}, Window decay: {}".format(
@@ -443,6 +675,14 @@ class MinMaxNormalizer(Normalizer):
         stats.machine = shot.machine
         return stats
 
+    def get_fingerprint_arrays(self, machine):
+        return [self.minimums[machine], self.maximums[machine]]
+
+    def extract_stats_from_signal_stats(self, stats, signal_stats):
+        stats.minimums = signal_stats[:, SIGNAL_STATS_COLUMNS.index("min")]
+        stats.maximums = signal_stats[:, SIGNAL_STATS_COLUMNS.index("max")]
+        return stats
+
     def incorporate_stats(self, stats):
         self.ensure_machine(stats.machine)
         if stats.valid:
@@ -463,6 +703,7 @@ class MinMaxNormalizer(Normalizer):
             self.num_disruptive[m] = self.num_disruptive[m] + (
                 1 if stats.is_disruptive else 0
             )
+            self.invalidate_fingerprint()
 
     def apply(self, shot):
         apply_positivity(shot)
@@ -509,12 +750,361 @@ class MinMaxNormalizer(Normalizer):
         self.num_processed = dat["num_processed"][()]
         self.num_disruptive = dat["num_disruptive"][()]
         self.machines = dat["machines"][()]
+        self.invalidate_fingerprint()
         # for machine in self.means:
         #     g.print_unique('Machine {}:'.format(machine))
         if verbose:
             self.print_summary()
 
 
+class QuantileSketch(object):
+    """Mergeable approximate quantiles of a stream of values.
+
+    The values are summarized by weighted centroids, merged with the k1 scale
+    function of the t-digest: a compression of C keeps about C / 2 centroids,
+    small near the extreme quantiles and large around the median. Sketches
+    built from disjoint parts of a stream merge into a sketch of the whole.
+    """
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.min = np.inf
+        self.max = -np.inf
+        self.num_compressed = 0
+
+    def __len__(self):
+        return len(self.means)
+
+    def count(self):
+        return np.sum(self.weights)
+
+    def add(self, values, weights=None):
+        values = np.ravel(np.asarray(values, dtype=np.float64))
+        if weights is None:
+            weights = np.ones_like(values)
+        mask = np.isfinite(values)
+        if not np.any(mask):
+            return
+        values, weights = values[mask], np.ravel(weights)[mask]
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+        self.means = np.concatenate([self.means, values])
+        self.weights = np.concatenate([self.weights, weights])
+        if len(self.means) > self.num_compressed + 5 * self.compression:
+            self.compress()
+
+    def merge(self, other):
+        self.add(other.means, other.weights)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def compress(self):
+        if len(self.means) > 0:
+            order = np.argsort(self.means, kind="mergesort")
+            means, weights = self.means[order], self.weights[order]
+            q_left = (np.cumsum(weights) - weights) / np.sum(weights)
+            # every centroid spans at most about one unit of the scale k
+            k = self.compression / (2 * np.pi) * np.arcsin(2 * q_left - 1)
+            bins = np.floor(k + self.compression / 4.0)
+            starts = np.flatnonzero(np.diff(bins, prepend=-1) > 0)
+            self.weights = np.add.reduceat(weights, starts)
+            self.means = np.add.reduceat(weights * means, starts) / self.weights
+        self.num_compressed = len(self.means)
+
+    def quantile(self, q):
+        if len(self.means) > self.num_compressed:
+            self.compress()
+        if len(self.means) == 0:
+            return np.nan
+        # centroid i covers the weights around its center cum_i - w_i / 2
+        total = np.sum(self.weights)
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return np.interp(
+            np.asarray(q) * total,
+            np.concatenate([[0], centers, [total]]),
+            np.concatenate([[self.min], self.means, [self.max]]),
+        )
+
+    def get_state(self):
+        self.compress()
+        return {
+            "compression": self.compression,
+            "centroids": np.stack([self.means, self.weights]),
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @staticmethod
+    def from_state(state):
+        sketch = QuantileSketch(state["compression"])
+        sketch.means, sketch.weights = state["centroids"]
+        sketch.min = state["min"]
+        sketch.max = state["max"]
+        sketch.num_compressed = len(sketch.means)
+        return sketch
+
+
+class SignalSketches(object):
+    """Streaming statistics of the signals of one machine: quantile sketches
+    of the per-shot means and stds of every signal, and the pooled count,
+    mean and sum of squared deviations of all their samples (combined with
+    the parallel update of Chan et al.)."""
+
+    def __init__(self, num_signals, compression=100):
+        self.num_shots = 0
+        self.num_disruptive = 0
+        self.count = np.zeros(num_signals)
+        self.mean = np.zeros(num_signals)
+        self.m2 = np.zeros(num_signals)
+        self.shot_means = [QuantileSketch(compression) for _ in range(num_signals)]
+        self.shot_stds = [QuantileSketch(compression) for _ in range(num_signals)]
+        # per-shot means and stds not yet added to the sketches
+        self.pending = []
+
+    def add_shot(self, means, stds, counts, is_disruptive):
+        self.num_shots += 1
+        self.num_disruptive += 1 if is_disruptive else 0
+        self.add_moments(counts, means, np.square(stds) * counts)
+        self.pending.append(np.concatenate([means, stds]))
+        if len(self.pending) >= self.shot_means[0].compression:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            pending = np.array(self.pending)
+            self.pending = []
+            for (i, sketch) in enumerate(self.shot_means + self.shot_stds):
+                sketch.add(pending[:, i])
+
+    def add_moments(self, count, mean, m2):
+        total = self.count + count
+        frac = np.divide(count, total, out=np.zeros_like(total), where=total > 0)
+        delta = mean - self.mean
+        self.mean = self.mean + delta * frac
+        self.m2 = self.m2 + m2 + np.square(delta) * self.count * frac
+        self.count = total
+
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        self.num_shots += other.num_shots
+        self.num_disruptive += other.num_disruptive
+        self.add_moments(other.count, other.mean, other.m2)
+        for (sketch, other_sketch) in zip(
+            self.shot_means + self.shot_stds, other.shot_means + other.shot_stds
+        ):
+            sketch.merge(other_sketch)
+
+    def get_medians(self):
+        self.flush()
+        means = np.array([sketch.quantile(0.5) for sketch in self.shot_means])
+        stds = np.array([sketch.quantile(0.5) for sketch in self.shot_stds])
+        return means, stds
+
+    def get_pooled_moments(self):
+        count = np.maximum(self.count, 1)
+        return self.mean, np.sqrt(self.m2 / count)
+
+    def get_state(self):
+        self.flush()
+        return {
+            "num_shots": self.num_shots,
+            "num_disruptive": self.num_disruptive,
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self.m2,
+            "shot_means": [sketch.get_state() for sketch in self.shot_means],
+            "shot_stds": [sketch.get_state() for sketch in self.shot_stds],
+        }
+
+    @staticmethod
+    def from_state(state):
+        sketches = SignalSketches(len(state["count"]))
+        sketches.num_shots = state["num_shots"]
+        sketches.num_disruptive = state["num_disruptive"]
+        sketches.count = state["count"]
+        sketches.mean = state["mean"]
+        sketches.m2 = state["m2"]
+        sketches.shot_means = [
+            QuantileSketch.from_state(s) for s in state["shot_means"]
+        ]
+        sketches.shot_stds = [QuantileSketch.from_state(s) for s in state["shot_stds"]]
+        return sketches
+
+
+class QuantileNormalizer(MeanVarNormalizer):
+    """Like MeanVarNormalizer, but the medians of the per-shot means and stds
+    are estimated from streaming quantile sketches of every training shot
+    instead of a random subset, so its memory does not grow with the number
+    of shots. Training runs in one parallel pass whose partial sketches are
+    merged across pool workers and, if initialized, MPI ranks. Machines that
+    are missing from a saved normalizer are added incrementally."""
+
+    compression = 200
+
+    def __init__(self, conf):
+        MeanVarNormalizer.__init__(self, conf)
+        # per machine SignalSketches
+        self.sketches = dict()
+
+    def __str__(self):
+        s = ""
+        for machine in self.sketches:
+            means, stds = self.get_medians(machine)
+            pooled_means, pooled_stds = self.sketches[machine].get_pooled_moments()
+            s += "Machine = {}:\nQuantile Normalizer.\n".format(machine)
+            s += "means: {}\nstds: {}\n".format(means, stds)
+            s += "pooled means: {}\npooled stds: {}\n".format(pooled_means, pooled_stds)
+        return s
+
+    def ensure_machine(self, machine):
+        if machine not in self.num_processed:
+            self.num_processed[machine] = 0
+            self.num_disruptive[machine] = 0
+
+    def extract_stats(self, shot):
+        stats = MeanVarNormalizer.extract_stats(self, shot)
+        if shot.valid:
+            stats.counts = np.array(
+                [sig.size for sig in shot.get_individual_signal_arrays()]
+            )
+        return stats
+
+    def extract_stats_from_signal_stats(self, stats, signal_stats):
+        MeanVarNormalizer.extract_stats_from_signal_stats(self, stats, signal_stats)
+        stats.counts = signal_stats[:, SIGNAL_STATS_COLUMNS.index("count")]
+        return stats
+
+    def incorporate_stats(self, stats):
+        self.incorporate_sketches({stats.machine: self.sketch_stats([stats])})
+
+    def incorporate_sketches(self, sketches):
+        for (machine, machine_sketches) in sketches.items():
+            if machine_sketches is None:
+                continue
+            if machine in self.sketches:
+                self.sketches[machine].merge(machine_sketches)
+            else:
+                self.sketches[machine] = machine_sketches
+            self.num_processed[machine] = self.sketches[machine].num_shots
+            self.num_disruptive[machine] = self.sketches[machine].num_disruptive
+            self.machines.add(machine)
+            self.unfreeze_stats(machine)
+
+    def sketch_stats(self, list_of_stats):
+        sketches = None
+        for stats in list_of_stats:
+            if stats.valid:
+                if sketches is None:
+                    sketches = SignalSketches(stats.means.shape[1], self.compression)
+                sketches.add_shot(
+                    stats.means[0], stats.stds[0], stats.counts, stats.is_disruptive
+                )
+        return sketches
+
+    def sketch_shots(self, shots):
+        """Per machine SignalSketches of a chunk of shots."""
+        stats_by_machine = dict()
+        for shot in shots:
+            stats = self.extract_saved_stats(shot)
+            if stats is None:
+                stats = self.train_on_single_shot(shot)
+            stats_by_machine.setdefault(stats.machine, []).append(stats)
+        return {m: self.sketch_stats(s) for (m, s) in stats_by_machine.items()}
+
+    def train_on_files(self, shot_files, use_shots, all_machines, verbose=False):
+        """Train on all shots of shot_files; use_shots is ignored."""
+        conf = self.conf
+        all_signals = conf["paths"]["all_signals"]
+        shot_list = ShotList()
+        shot_list.load_from_shot_list_files_objects(shot_files, all_signals)
+
+        previously_saved, machines_saved = self.previously_saved_stats()
+        machines_to_compute = all_machines - machines_saved
+        if conf["data"]["recompute_normalization"]:
+            machines_to_compute = all_machines
+        elif previously_saved:
+            self.load_stats(verbose=verbose)
+        if len(machines_to_compute) > 0:
+            print("computing normalization for machines {}".format(machines_to_compute))
+            start_time = time.time()
+            shots = [s for s in shot_list if s.machine in machines_to_compute]
+            if g.comm is not None:
+                shots = shots[g.task_index :: g.num_workers]
+            use_cores = max(1, mp.cpu_count() - 2)
+            chunks = [
+                [shots[i] for i in idx]
+                for idx in np.array_split(np.arange(len(shots)), 4 * use_cores)
+                if len(idx) > 0
+            ]
+            pool = mp.Pool(use_cores)
+            print("running in parallel on {} processes".format(pool._processes))
+            sketches = []
+            for (i, chunk_sketches) in enumerate(
+                pool.imap_unordered(self.sketch_shots, chunks)
+            ):
+                sketches.append(chunk_sketches)
+                sys.stdout.write("\r" + "{}/{}".format(i, len(chunks)))
+            pool.close()
+            pool.join()
+            if g.comm is not None:
+                sketches = sum(g.comm.allgather(sketches), [])
+            for chunk_sketches in sketches:
+                self.incorporate_sketches(chunk_sketches)
+            print(
+                "\nFinished Training Normalizer on ",
+                "{} files in {} seconds".format(len(shots), time.time() - start_time),
+            )
+            if g.task_index == 0:
+                self.save_stats(verbose=True)
+        self.freeze_stats()
+        if verbose:
+            g.print_unique(self)
+
+    def get_medians(self, machine):
+        medians = self.medians.get(machine)
+        if medians is None:
+            means, stds = self.sketches[machine].get_medians()
+            stds = np.where(stds == 0.0, 1.0, stds)
+            medians = (means, stds)
+            self.medians[machine] = medians
+        return medians
+
+    def freeze_stats(self):
+        self.invalidate_fingerprint()
+        self.medians = dict()
+        self.plans = dict()
+        for machine in self.sketches:
+            self.get_medians(machine)
+
+    def save_stats(self, verbose=False):
+        self.ensure_save_directory()
+        np.savez(
+            self.path,
+            sketches={m: s.get_state() for (m, s) in self.sketches.items()},
+            num_processed=self.num_processed,
+            num_disruptive=self.num_disruptive,
+            machines=self.machines,
+        )
+        if verbose:
+            self.print_summary(action="saved")
+
+    def load_stats(self, verbose=False):
+        assert self.previously_saved_stats()[0], "stats not saved before"
+        dat = np.load(self.path, encoding="latin1", allow_pickle=True)
+        self.sketches = {
+            m: SignalSketches.from_state(s) for (m, s) in dat["sketches"][()].items()
+        }
+        self.num_processed = dat["num_processed"][()]
+        self.num_disruptive = dat["num_disruptive"][()]
+        self.machines = dat["machines"][()]
+        self.freeze_stats()
+        if verbose:
+            self.print_summary()
+
+
 def get_individual_shot_file(prepath, shot_num, ext=".txt"):
     return prepath + str(shot_num) + ext
 
@@ -449,8 +449,19 @@ class PerformanceAnalyzer:
         self.pred_test = dat["y_prime_test"]
         self.truth_test = dat["y_gold_test"]
         self.disruptive_test = dat["disruptive_test"]
-        self.shot_list_test = ShotList(dat["shot_list_test"][()])
-        self.shot_list_train = ShotList(dat["shot_list_train"][()])
+        if "shot_list_test_rows" in dat.files:
+            machines = self.conf["paths"]["all_machines"]
+            signals = self.conf["paths"]["all_signals"]
+            self.shot_list_test = ShotList.from_arrays(
+                dat, "shot_list_test", machines, signals
+            )
+            self.shot_list_train = ShotList.from_arrays(
+                dat, "shot_list_train", machines, signals
+            )
+        else:
+            # saved by an earlier version, with pickled shot lists
+            self.shot_list_test = ShotList(dat["shot_list_test"][()])
+            self.shot_list_train = ShotList(dat["shot_list_train"][()])
         self.saved_conf = dat["conf"][()]
         # all files must agree on T_warning due to output of truth vs.
         # normalized shot ttd.
@@ -471,11 +482,12 @@ class PerformanceAnalyzer:
     def assert_same_lists(self, shot_list, truth_arr, disr_arr):
         assert len(shot_list) == len(truth_arr)
         for i in range(len(shot_list)):
-            shot_list.shots[i].restore("/tigress/jk7/processed_shots/")
-            s = shot_list.shots[i].ttd
+            shot = shot_list[i]
+            shot.restore("/tigress/jk7/processed_shots/")
+            s = shot.ttd
             if not truth_arr[i].shape[0] == s.shape[0] - 30:
                 print(i)
-                print(shot_list.shots[i].number)
+                print(shot.number)
                 print((s.shape, truth_arr[i].shape, disr_arr[i]))
             assert truth_arr[i].shape[0] == s.shape[0] - 30
         print("Same shape!")
@@ -806,7 +818,7 @@ class PerformanceAnalyzer:
             t = truth[i]
             p = pred[i]
             is_disr = is_disruptive[i]
-            shot = shot_list.shots[i]
+            shot = shot_list[i]
             TP, FP, FN, TN, early, late = self.get_shot_prediction_stats(
                 P_thresh_opt, p, t, is_disr
             )
@@ -1170,7 +1182,7 @@ class PerformanceAnalyzer:
         t = truth[i]
         p = pred[i]
         is_disr = is_disruptive[i]
-        shot = shot_list.shots[i]
+        shot = shot_list[i]
         return p, t, is_disr
 
     def save_shot(self, shot, P_thresh_opt=0, extra_filename=""):
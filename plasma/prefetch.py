@@ -0,0 +1,149 @@
+"""
+#########################################################
+This file contains a multi-process batch prefetcher. Worker processes run
+batch generators and write the arrays of every batch into one of a bounded
+ring of preallocated shared-memory slots. The consumer reads the batches as
+views of the slots, so batch arrays are never pickled.
+#########################################################
+"""
+
+from __future__ import print_function
+import random
+import time
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+
+
+class BatchPrefetcher(object):
+    """Iterate over the batches of num_workers generators running in worker
+    processes.
+
+    Argument list:
+      - generator_fn: callable run in every worker as
+        generator_fn(worker_id, num_workers), returning the worker's batch
+        generator. Batches are tuples.
+      - array_specs: dict mapping the position of an array in the batch
+        tuples to (capacity, dtype), where capacity is the maximum number of
+        elements of that array. These arrays are passed through the shared
+        memory slots; all other batch items are sent through a queue.
+      - num_workers: number of worker processes
+      - depth: number of slots, i.e. the maximum number of batches that are
+        prefetched or held by the consumer
+      - seed: worker i seeds np.random and random with seed + i
+
+    The arrays of a batch are views of its slot. The consumer owns the slot
+    until it draws the next batch, which hands the slot back to the workers.
+    wait_time accumulates the seconds spent waiting for batches.
+    """
+
+    def __init__(self, generator_fn, array_specs, num_workers=1, depth=4, seed=0):
+        assert depth >= 2, "prefetching needs at least two slots"
+        self.array_specs = dict(
+            (pos, (int(capacity), np.dtype(dtype)))
+            for (pos, (capacity, dtype)) in array_specs.items()
+        )
+        self.slots = [
+            dict(
+                (pos, mp.RawArray("b", max(1, capacity * dtype.itemsize)))
+                for (pos, (capacity, dtype)) in self.array_specs.items()
+            )
+            for _ in range(depth)
+        ]
+        self.free_slots = mp.Queue()
+        for slot in range(depth):
+            self.free_slots.put(slot)
+        self.ready_slots = mp.Queue()
+        self.held_slot = None
+        self.wait_time = 0.0
+        self.num_batches = 0
+        self.procs = [
+            mp.Process(
+                target=prefetch_worker,
+                args=(
+                    generator_fn,
+                    worker_id,
+                    num_workers,
+                    seed + worker_id,
+                    self.slots,
+                    self.array_specs,
+                    self.free_slots,
+                    self.ready_slots,
+                ),
+            )
+            for worker_id in range(num_workers)
+        ]
+        for proc in self.procs:
+            proc.daemon = True
+            proc.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.held_slot is not None:
+            self.free_slots.put(self.held_slot)
+            self.held_slot = None
+        t0 = time.time()
+        slot, shapes, items = self.ready_slots.get(True)
+        self.wait_time += time.time() - t0
+        if slot is None:
+            self.close()
+            raise RuntimeError("batch prefetching worker failed:\n" + items)
+        for (pos, shape) in shapes.items():
+            _, dtype = self.array_specs[pos]
+            items[pos] = get_slot_view(self.slots[slot][pos], dtype, shape)
+        self.held_slot = slot
+        self.num_batches += 1
+        return tuple(items)
+
+    def next(self):
+        return self.__next__()
+
+    def close(self):
+        for proc in self.procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self.procs:
+            proc.join()
+        self.procs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def get_slot_view(buf, dtype, shape):
+    count = int(np.prod(shape))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+
+def prefetch_worker(
+    generator_fn, worker_id, num_workers, seed, slots, specs, free_slots, ready_slots
+):
+    np.random.seed(seed)
+    random.seed(seed)
+    try:
+        generator = generator_fn(worker_id, num_workers)
+        while True:
+            # the next batch is prepared while all slots are in use
+            batch = next(generator)
+            slot = free_slots.get(True)
+            items = list(batch)
+            shapes = dict()
+            for (pos, (capacity, dtype)) in specs.items():
+                arr = np.asarray(items[pos])
+                assert arr.size <= capacity, "batch item {} overflows".format(pos)
+                get_slot_view(slots[slot][pos], dtype, arr.shape)[...] = arr
+                shapes[pos] = arr.shape
+                items[pos] = None
+            ready_slots.put((slot, shapes, items))
+            # release the batch, so that the generator can reuse its buffers
+            del batch
+    except BaseException:
+        ready_slots.put(
+            (None, None, "worker {}: {}".format(worker_id, traceback.format_exc()))
+        )
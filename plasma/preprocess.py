@@ -13,15 +13,25 @@ import global_vars as g
 from os import listdir  # , remove
 import time
 import sys
+import itertools
 import os
 
 import numpy as np
 import multiprocessing as mp
 
 from processing import append_to_filename
-from shots import ShotList
+from sampling import draw_without_replacement
+from shots import (
+    ShotList,
+    get_processed_store,
+    get_processed_signal_store,
+    get_processed_stats_store,
+)
 from downloading import mkdirdepth
 
+# names of the shot lists in the saved shot list file
+SHOT_LIST_NAMES = ["shot_list_train", "shot_list_validate", "shot_list_test"]
+
 
 class Preprocessor(object):
     def __init__(self, conf):
@@ -88,25 +98,57 @@ class Preprocessor(object):
         # TODO(KGF): generalize the follwowing line to perform well on
         # architecutres other than CPUs, e.g. KNLs
         # min( <desired-maximum-process-count>, max(1,mp.cpu_count()-2) )
-        use_cores = max(1, mp.cpu_count() - 2)
-        pool = mp.Pool(use_cores)
+        use_cores = self.conf["data"]["preprocess_cores"]
+        if use_cores <= 0:
+            use_cores = max(1, mp.cpu_count() - 2)
+        chunksize = self.conf["data"]["preprocess_chunksize"]
+        # conf and the shots reach every worker once; tasks and results are
+        # shot indices and compact tuples
+        shots = shot_list_picked.as_list()
+        pool = mp.Pool(
+            use_cores, initializer=init_preprocess_worker, initargs=(self.conf, shots)
+        )
         print("Running in parallel on {} processes".format(pool._processes))
         start_time = time.time()
-        for (i, shot) in enumerate(
-            pool.imap_unordered(self.preprocess_single_file, shot_list_picked)
+        num_timesteps = 0
+        for (i, (idx, valid, is_disruptive, length)) in enumerate(
+            pool.imap_unordered(
+                preprocess_shot_in_worker, range(len(shots)), chunksize=chunksize
+            )
         ):
-            # for (i,shot) in
-            # enumerate(map(self.preprocess_single_file,shot_list_picked)):
             sys.stdout.write("\r{}/{}".format(i, len(shot_list_picked)))
-            used_shots.append_if_valid(shot)
+            shot = shots[idx]
+            shot.valid = valid
+            shot.is_disruptive = is_disruptive
+            shot.make_light()
+            if used_shots.append_if_valid(shot, length):
+                num_timesteps += length
 
         pool.close()
         pool.join()
+        # merge the shards written by the workers into one contiguous array
+        processed_prepath = self.conf["paths"]["processed_prepath"]
+        processed_signal_prepath = self.conf["paths"]["processed_signal_prepath"]
+        for machine in set([f.machine for f in shot_files]):
+            get_processed_store(
+                processed_prepath, machine, self.conf["data"]["floatx"]
+            ).compact()
+            get_processed_stats_store(processed_prepath, machine).compact()
+            for signal in all_signals:
+                if signal.is_defined_on_machine(machine):
+                    get_processed_signal_store(
+                        processed_signal_prepath,
+                        machine,
+                        signal,
+                        self.conf["data"]["dt"],
+                        self.conf["data"]["floatx"],
+                    ).consolidate()
         print(
             "Finished Preprocessing {} files in {} seconds".format(
                 len(shot_list_picked), time.time() - start_time
             )
         )
+        print("{} timesteps in the valid shots".format(num_timesteps))
         print(
             "Omitted {} shots of {} total.".format(
                 len(shot_list_picked) - len(used_shots), len(shot_list_picked)
@@ -129,17 +171,22 @@ class Preprocessor(object):
     def preprocess_single_file(self, shot):
         processed_prepath = self.conf["paths"]["processed_prepath"]
         recompute = self.conf["data"]["recompute"]
+        floatx = self.conf["data"]["floatx"]
         # print('({}/{}): '.format(num_processed,use_shots))
-        if recompute or not shot.previously_saved(processed_prepath):
+        if recompute or not shot.previously_saved(processed_prepath, floatx):
             shot.preprocess(self.conf)
-            shot.save(processed_prepath)
+            shot.save(processed_prepath, floatx)
         else:
             try:
-                shot.restore(processed_prepath, light=True)
+                shot.restore(processed_prepath, light=True, dtype=floatx)
+                if shot.valid and shot.restore_signal_stats(processed_prepath) is None:
+                    # saved before signal stats were kept with the shots
+                    shot.restore(processed_prepath, dtype=floatx)
+                    shot.save_signal_stats(processed_prepath)
                 sys.stdout.write("\r{} exists.".format(shot.number))
             except BaseException:
                 shot.preprocess(self.conf)
-                shot.save(processed_prepath)
+                shot.save(processed_prepath, floatx)
                 sys.stdout.write(
                     "\r{} exists but corrupted, resaved.".format(shot.number)
                 )
@@ -154,6 +201,15 @@ class Preprocessor(object):
 
     def load_shotlists(self):
         path = self.get_shot_list_path()
+        data = np.load(path)
+        if "shot_list_train_rows" in data.files:
+            machines = self.conf["paths"]["all_machines"]
+            signals = self.conf["paths"]["all_signals"]
+            return tuple(
+                ShotList.from_arrays(data, name, machines, signals)
+                for name in SHOT_LIST_NAMES
+            )
+        # saved by an earlier version, with pickled shot lists
         data = np.load(path, encoding="latin1", allow_pickle=True)
         shot_list_train = data["shot_list_train"][()]
         shot_list_validate = data["shot_list_validate"][()]
@@ -170,12 +226,36 @@ class Preprocessor(object):
     def save_shotlists(self, shot_list_train, shot_list_validate, shot_list_test):
         path = self.get_shot_list_path()
         mkdirdepth(path)
-        np.savez(
-            path,
-            shot_list_train=shot_list_train,
-            shot_list_validate=shot_list_validate,
-            shot_list_test=shot_list_test,
+        arrays = dict()
+        for (name, shot_list) in zip(
+            SHOT_LIST_NAMES, [shot_list_train, shot_list_validate, shot_list_test]
+        ):
+            arrays.update(shot_list.get_arrays(name))
+        np.savez(path, **arrays)
+
+
+# state of a preprocessing worker process, set once by its initializer
+_worker_preprocessor = None
+_worker_shots = None
+
+
+def init_preprocess_worker(conf, shots):
+    global _worker_preprocessor, _worker_shots
+    _worker_preprocessor = Preprocessor(conf)
+    _worker_shots = shots
+
+
+def preprocess_shot_in_worker(idx):
+    """Preprocess the idx-th shot of the worker's shots and return the
+    compact result (idx, valid, is_disruptive, processed length)."""
+    shot = _worker_preprocessor.preprocess_single_file(_worker_shots[idx])
+    length = 0
+    if shot.valid:
+        conf = _worker_preprocessor.conf
+        length = shot.num_timesteps(
+            conf["paths"]["processed_prepath"], conf["data"]["floatx"]
         )
+    return idx, bool(shot.valid), bool(shot.is_disruptive), length
 
 
 def apply_bleed_in(conf, shot_list_train, shot_list_validate, shot_list_test):
@@ -193,11 +273,18 @@ def apply_bleed_in(conf, shot_list_train, shot_list_validate, shot_list_test):
         ), "Not enough disruptive shots {} to cover bleed in {}".format(num_d, num)
         num_sampled_d = 0
         num_sampled_nd = 0
+        if conf["data"]["bleed_in_remove_from_test"]:
+            # sampled shots are removed from the test set, so no shot is
+            # drawn twice
+            order = draw_without_replacement(
+                np.ones(len(shot_list_test)), len(shot_list_test)
+            )
+            draws = (shot_list_test[i] for i in order)
+        else:
+            draws = (shot_list_test.sample_shot() for _ in itertools.count())
         while num_sampled_d < num:
-            s = shot_list_test.sample_shot()
+            s = next(draws)
             shot_list_bleed.append(s)
-            if conf["data"]["bleed_in_remove_from_test"]:
-                shot_list_test.remove(s)
             if s.is_disruptive:
                 num_sampled_d += 1
             else:
@@ -213,6 +300,8 @@ def apply_bleed_in(conf, shot_list_train, shot_list_validate, shot_list_test):
             )
         )
         assert num_sampled_d == num
+        if conf["data"]["bleed_in_remove_from_test"]:
+            shot_list_test.remove_all(shot_list_bleed)
         # add bleed-in shots to training and validation set repeatedly
         if conf["data"]["bleed_in_equalize_sets"]:
             print("Applying equalized bleed in")
@@ -12,6 +12,7 @@ from __future__ import print_function
 import itertools
 
 import numpy as np
+from scipy.signal import fftconvolve
 
 # from scipy.interpolate import UnivariateSpline
 
@@ -59,6 +60,170 @@ def cut_and_resample_signal(t, sig, tmin, tmax, dt, precision_str):
     return resample_signal(t, sig, tmin, tmax, dt, precision_str)
 
 
+def get_resampling_indices(t, tt, tmin, tmax):
+    """Indices into t of the latest sample at or before each time in tt.
+
+    Only samples within [tmin, tmax] are used, as if t had been cut with
+    cut_signal first; times before the first such sample map to it, as in
+    time_sensitive_interp. t is only sorted (stably) if it is not monotone.
+    """
+    if np.all(t[1:] >= t[:-1]):
+        order = None
+        t_sorted = t
+    else:
+        order = np.argsort(t, kind="mergesort")
+        t_sorted = t[order]
+    lo = np.searchsorted(t_sorted, tmin, side="left")
+    hi = np.searchsorted(t_sorted, tmax, side="right")
+    assert hi > lo, "no samples between t_min {} and t_max {}".format(tmin, tmax)
+    indices = np.searchsorted(t_sorted, tt, side="right") - 1
+    np.clip(indices, lo, hi - 1, out=indices)
+    if order is not None:
+        indices = order[indices]
+    return indices
+
+
+def resample_signals(
+    time_arrays, signal_arrays, tmin, tmax, dt, precision_str, tt=None
+):
+    """Cut and resample several signals onto one common time grid.
+
+    Equivalent to calling cut_and_resample_signal for every signal, but the
+    grid is built once, the resampling indices are computed once per distinct
+    time base and all channels are gathered into one (T, total_channels)
+    array, with the columns of the signals in the given order. A grid other
+    than np.arange(tmin, tmax, dt) can be passed as tt.
+    """
+    if tt is None:
+        tt = np.arange(tmin, tmax, dt, dtype=precision_str)
+    num_channels = sum([sig.shape[1] for sig in signal_arrays])
+    sig_interp = np.empty((len(tt), num_channels), dtype=precision_str)
+    # time bases seen so far and their indices, by (length, first, last) time
+    time_bases = {}
+    curr_idx = 0
+    for (t, sig) in zip(time_arrays, signal_arrays):
+        candidates = time_bases.setdefault((len(t), t[0], t[-1]), [])
+        for (t_other, indices) in candidates:
+            if t_other is t or np.array_equal(t_other, t):
+                break
+        else:
+            indices = get_resampling_indices(t, tt, tmin, tmax)
+            candidates.append((t, indices))
+        sig_interp[:, curr_idx : curr_idx + sig.shape[1]] = sig[indices]
+        curr_idx += sig.shape[1]
+    if np.any(np.isnan(sig_interp)):
+        print("signal contains nan")
+    return tt, sig_interp
+
+
+def remap_profiles(mapping, sig, remapping):
+    """Piecewise linear interpolation of every row of a profile signal.
+
+    Row i of sig, given at the (possibly unsorted or repeated) coordinates
+    mapping[i, :], is evaluated at the coordinates remapping, holding the
+    boundary values outside of the mapped range. This matches a linear
+    UnivariateSpline(s=0, k=1, ext=3) through the unique points of each row,
+    where a repeated coordinate takes the value of its first occurrence.
+    Returns None if some row has two or fewer unique points.
+    """
+    T, M = mapping.shape
+    # a stable sort keeps the first occurrence of a coordinate first
+    order = np.argsort(mapping, axis=1, kind="mergesort")
+    xs = np.take_along_axis(mapping, order, axis=1)
+    ys = np.take_along_axis(sig, order, axis=1)
+    is_new = np.ones((T, M), dtype=bool)
+    is_new[:, 1:] = xs[:, 1:] != xs[:, :-1]
+    if np.any(is_new.sum(axis=1) <= 2):
+        return None
+    # give every repeated coordinate the value of its first occurrence
+    first = np.where(is_new, np.arange(M), 0)
+    np.maximum.accumulate(first, axis=1, out=first)
+    ys = np.take_along_axis(ys, first, axis=1)
+
+    rows = np.arange(T)
+    sig_interp = np.empty((T, len(remapping)))
+    for (j, x) in enumerate(remapping):
+        # index of the last coordinate <= x, kept within the first and
+        # last segment. Outside of the mapped range the weight is clipped,
+        # which holds the boundary value.
+        idx = np.clip((xs <= x).sum(axis=1) - 1, 0, M - 2)
+        x0 = xs[rows, idx]
+        dx = xs[rows, idx + 1] - x0
+        y0 = ys[rows, idx]
+        dy = ys[rows, idx + 1] - y0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            w = np.where(dx > 0, (x - x0) / dx, 1.0)
+        sig_interp[:, j] = y0 + np.clip(w, 0.0, 1.0) * dy
+    return sig_interp
+
+
+# windows longer than this are correlated with FFTs instead of shifted slices
+MAX_DIRECT_WINDOW_SIZE = 64
+_exponential_windows = dict()
+
+
+def get_exponential_window(window_size, window_decay):
+    """Return the (per process cached) normalized window
+    exp(-n / window_decay), n = 0..window_size-1, i.e. the normalized
+    scipy.signal.exponential(window_size, 0, window_decay, False)."""
+    key = (window_size, window_decay)
+    window = _exponential_windows.get(key)
+    if window is None:
+        window = np.exp(-np.arange(window_size) / float(window_decay))
+        window /= np.sum(window)
+        window.flags.writeable = False
+        _exponential_windows[key] = window
+    return window
+
+
+def correlate_valid(x, window):
+    """scipy.signal.correlate(x[:, c], window, "valid") for all columns c of
+    the 2D array x at once. Row i of the result, of length T - W + 1, only
+    depends on the rows i..i+W-1 of x, so it is causal when aligned with the
+    last of them."""
+    W = len(window)
+    T = max(x.shape[0] - W + 1, 0)
+    window = window.astype(x.dtype, copy=False)
+    if W > MAX_DIRECT_WINDOW_SIZE and T > 0:
+        out = fftconvolve(x, window[::-1, np.newaxis], mode="valid", axes=0)
+        return out.astype(x.dtype, copy=False)
+    out = np.multiply(x[:T], window[0])
+    for j in range(1, W):
+        out += window[j] * x[j : j + T]
+    return out
+
+
+class StreamingCorrelator(object):
+    """Stateful counterpart of correlate_valid for one new row at a time.
+
+    step(x) takes the next row of C channels and returns the correlation of
+    the window with the last W rows, or None until W rows were seen.
+    """
+
+    def __init__(self, window, num_channels, dtype="float32"):
+        self.window = np.asarray(window, dtype=dtype)
+        self.W = len(window)
+        # every row is written twice, so the last W rows are always the
+        # contiguous slice buffer[pos + 1 : pos + 1 + W]
+        self.buffer = np.zeros((2 * self.W, num_channels), dtype=dtype)
+        self.pos = self.W - 1
+        self.num_seen = 0
+
+    def reset(self):
+        self.buffer[:] = 0
+        self.pos = self.W - 1
+        self.num_seen = 0
+
+    def step(self, x):
+        self.pos = (self.pos + 1) % self.W
+        self.buffer[self.pos] = x
+        self.buffer[self.pos + self.W] = x
+        self.num_seen += 1
+        if self.num_seen < self.W:
+            return None
+        return np.dot(self.window, self.buffer[self.pos + 1 : self.pos + 1 + self.W])
+
+
 def get_individual_shot_file(prepath, shot_num, ext=".txt"):
     return prepath + str(shot_num) + ext
 
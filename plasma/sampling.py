@@ -0,0 +1,100 @@
+"""
+#########################################################
+This file contains samplers drawing shots from a list with given weights in
+O(1) per draw. The weights are preprocessed once, and draws are made in
+batches of a whole epoch.
+#########################################################
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+
+class AliasTable(object):
+    """Walker's alias table of a discrete distribution over
+    range(len(weights)), with probabilities proportional to weights."""
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        assert np.all(weights >= 0) and np.sum(weights) > 0
+        n = len(weights)
+        prob = weights * (n / np.sum(weights))
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        small = list(np.where(prob < 1.0)[0])
+        large = list(np.where(prob >= 1.0)[0])
+        while len(small) > 0 and len(large) > 0:
+            s = small.pop()
+            g = large.pop()
+            self.prob[s] = prob[s]
+            self.alias[s] = g
+            prob[g] -= 1.0 - prob[s]
+            if prob[g] < 1.0:
+                small.append(g)
+            else:
+                large.append(g)
+        # the remaining columns are full up to rounding errors
+
+    def draw(self, num):
+        """num indices drawn independently."""
+        idx = np.random.randint(len(self.prob), size=num)
+        accept = np.random.random_sample(num) < self.prob[idx]
+        return np.where(accept, idx, self.alias[idx])
+
+
+def draw_systematic(weights, num):
+    """num indices in random order, in which every index occurs
+    floor(num * p) or ceil(num * p) times, where p is its probability.
+
+    This is as close to sampling without replacement as the weights allow;
+    with equal weights and num == len(weights) it is a random permutation.
+    """
+    cumulative = np.cumsum(np.asarray(weights, dtype=np.float64))
+    positions = (np.random.random_sample() + np.arange(num)) * (cumulative[-1] / num)
+    idx = np.searchsorted(cumulative, positions, side="right")
+    return np.random.permutation(np.minimum(idx, len(cumulative) - 1))
+
+
+def draw_without_replacement(weights, num):
+    """num distinct indices drawn one after the other with probabilities
+    proportional to the weights of the indices not drawn yet, using the keys
+    of Efraimidis and Spirakis. Indices with zero weight are never drawn."""
+    weights = np.asarray(weights, dtype=np.float64)
+    positive = np.where(weights > 0)[0]
+    assert num <= len(positive), "cannot draw {} of {} indices".format(
+        num, len(positive)
+    )
+    keys = np.log(np.random.random_sample(len(positive))) / weights[positive]
+    return positive[np.argsort(-keys, kind="stable")[:num]]
+
+
+class ShotSampler(object):
+    """Draws of indices of shots with probabilities proportional to weights,
+    made in batches of len(weights) draws, i.e. one epoch of training.
+
+    With replace, the indices of a batch are drawn independently from an
+    alias table. Otherwise, every index appears as often in a batch as its
+    weight warrants, up to rounding (see draw_systematic), so every epoch
+    covers the shots evenly instead of repeating some and missing others.
+    """
+
+    def __init__(self, weights, replace=True):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.replace = replace
+        self.table = AliasTable(self.weights) if replace else None
+        self.draws = np.zeros(0, dtype=np.int64)
+        self.num_drawn = 0
+
+    def draw_epoch(self):
+        if self.replace:
+            return self.table.draw(len(self.weights))
+        return draw_systematic(self.weights, len(self.weights))
+
+    def sample(self):
+        if self.num_drawn == len(self.draws):
+            self.draws = self.draw_epoch()
+            self.num_drawn = 0
+        idx = int(self.draws[self.num_drawn])
+        self.num_drawn += 1
+        return idx
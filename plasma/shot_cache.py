@@ -0,0 +1,209 @@
+"""
+#########################################################
+This file contains caches of the normalized (ttd, signal) arrays of shots,
+which spare the Loader restoring and normalizing a shot on every access.
+
+Shots are cached under keys (machine, number, inference_mode). ShotCache
+keeps the arrays in the memory of one process; SharedShotCache keeps them in
+normalized shot stores in shared memory, which all processes of a node map.
+#########################################################
+"""
+
+from __future__ import print_function
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from hashing import myhash
+from storage import close_store
+
+# per-shot fields of a normalized shot store index: the block of a shot holds
+# num_targets columns of ttd followed by the columns of use_signals
+NORMALIZED_SHOT_FIELDS = [("num_targets", "i8")]
+
+SHM_PREPATH = "/dev/shm"
+INDEX_REFRESH_SECONDS = 10.0
+
+
+class ShotCache(object):
+    """In-memory cache of normalized shots with least recently used eviction
+    once the cached arrays take up more than max_bytes.
+
+    Every caller of get() receives the same arrays, so they are made
+    read-only when they are cached.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.arrays = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        arrays = self.arrays.get(key)
+        if arrays is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.arrays.move_to_end(key)
+        return arrays
+
+    def put(self, key, ttd, signal):
+        nbytes = ttd.nbytes + signal.nbytes
+        if key in self.arrays or nbytes > self.max_bytes:
+            return
+        ttd.flags.writeable = False
+        signal.flags.writeable = False
+        self.arrays[key] = (ttd, signal)
+        self.resident_bytes += nbytes
+        while self.resident_bytes > self.max_bytes:
+            _, (old_ttd, old_signal) = self.arrays.popitem(last=False)
+            self.resident_bytes -= old_ttd.nbytes + old_signal.nbytes
+
+    def get_resident_bytes(self):
+        return self.resident_bytes
+
+    def get_hit_rate(self):
+        return self.hits / max(1, self.hits + self.misses)
+
+    def close(self):
+        self.arrays = OrderedDict()
+        self.resident_bytes = 0
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def __str__(self):
+        return "{}: {} shots, {:.1f} MB resident, {:.1%} hits ({}/{})".format(
+            self.__class__.__name__,
+            len(self),
+            self.get_resident_bytes() / 2 ** 20,
+            self.get_hit_rate(),
+            self.hits,
+            self.hits + self.misses,
+        )
+
+
+class SharedShotCache(ShotCache):
+    """ShotCache kept in normalized shot stores in SHM_PREPATH, so that all
+    processes of a node, e.g. prefetch workers and the trainer, map a single
+    copy of every cached shot.
+
+    get_store(machine, prepath) returns the store of a machine for the
+    current normalizer, config and inference mode below prepath. The stores
+    are append-only, so shots are added until the stores hold max_bytes and
+    never evicted. A miss re-reads the index of a store at most every
+    INDEX_REFRESH_SECONDS, to pick up the shots added by other processes.
+
+    The stores belong to the run of the process that creates the cache:
+    processes forked from it share them, close() in that process removes
+    them, and the stores of runs whose process is gone are removed when a
+    new cache is created.
+    """
+
+    def __init__(self, max_bytes, get_store, processed_prepath):
+        ShotCache.__init__(self, max_bytes)
+        self.get_store = get_store
+        self.owner_pid = os.getpid()
+        base = "plasma_{}_".format(myhash(os.path.abspath(processed_prepath)))
+        remove_stale_shm_prepaths(base)
+        self.prepath = os.path.join(SHM_PREPATH, base + str(self.owner_pid))
+        self.stores = dict()
+        # bytes of the shots in every store, as of the last index refresh
+        # plus the shots appended by this process since
+        self.store_bytes = dict()
+        self.refresh_times = dict()
+
+    def get_machine_store(self, machine):
+        store = self.get_store(machine, self.prepath)
+        if store.prepath not in self.stores:
+            self.stores[store.prepath] = store
+            self.store_bytes[store.prepath] = get_store_bytes(store)
+        return store
+
+    def get(self, key):
+        machine, number, _ = key
+        store = self.get_machine_store(machine)
+        arrays = read_normalized_arrays(store, number)
+        now = time.time()
+        if arrays is None and now > self.refresh_times.get(store.prepath, 0.0):
+            store.invalidate()
+            self.refresh_times[store.prepath] = now + INDEX_REFRESH_SECONDS
+            self.store_bytes[store.prepath] = get_store_bytes(store)
+            arrays = read_normalized_arrays(store, number)
+        if arrays is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return arrays
+
+    def put(self, key, ttd, signal):
+        machine, number, _ = key
+        store = self.get_machine_store(machine)
+        nbytes = ttd.nbytes + signal.nbytes
+        if self.get_resident_bytes() + nbytes <= self.max_bytes:
+            append_normalized_arrays(store, number, ttd, signal)
+            self.store_bytes[store.prepath] += nbytes
+            ttd.flags.writeable = False
+            signal.flags.writeable = False
+
+    def get_resident_bytes(self):
+        return sum(self.store_bytes.values())
+
+    def __len__(self):
+        return sum(len(store) for store in self.stores.values())
+
+    def close(self):
+        """Remove the stores of the run, if this process created them."""
+        for prepath in self.stores:
+            close_store(prepath)
+        self.stores = dict()
+        self.store_bytes = dict()
+        if os.getpid() == self.owner_pid:
+            shutil.rmtree(self.prepath, ignore_errors=True)
+
+
+def remove_stale_shm_prepaths(base):
+    """Remove the stores in SHM_PREPATH/<base><pid> of the shot caches of
+    processes that are no longer running."""
+    if not os.path.isdir(SHM_PREPATH):
+        return
+    for name in os.listdir(SHM_PREPATH):
+        pid = name[len(base) :]
+        if name.startswith(base) and pid.isdigit() and not is_running(int(pid)):
+            shutil.rmtree(os.path.join(SHM_PREPATH, name), ignore_errors=True)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_normalized_arrays(store, number):
+    """ttd and signal arrays of a shot in a normalized shot store, as
+    read-only views of its memory map, or None if the shot is not stored."""
+    record = store.get_record(number)
+    if record is None:
+        return None
+    block = store.get_block(record)
+    num_targets = int(record["num_targets"])
+    return block[:, :num_targets], block[:, num_targets:]
+
+
+def append_normalized_arrays(store, number, ttd, signal):
+    ttd = np.reshape(ttd, (ttd.shape[0], -1))
+    store.append(number, np.column_stack([ttd, signal]), num_targets=ttd.shape[1])
+
+
+def get_store_bytes(store):
+    records = store.records()
+    return int(np.sum(records["nrows"] * records["ncols"])) * store.dtype.itemsize
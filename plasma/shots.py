@@ -11,13 +11,60 @@ This work was supported by the DOE CSGF program.
 from __future__ import print_function
 import os
 import os.path
+import json
 import sys
 import random as rnd
 
 import numpy as np
 
-from processing import train_test_split, cut_and_resample_signal
-from downloading import makedirs_process_safe
+from processing import resample_signals
+from storage import open_store
+from hashing import myhash
+from data import get_signal_registry
+from sampling import ShotSampler
+
+# per-shot fields of the processed shot store index. Together with the key
+# (shot number) and nrows (processed length) of every record they form the
+# shot metadata index, which is held in memory once the store is opened.
+# Bit i of signals_available is set if raw data of the shot's i-th signal was
+# found during preprocessing.
+PROCESSED_SHOT_FIELDS = [
+    ("valid", "?"),
+    ("is_disruptive", "?"),
+    ("t_disrupt", "f8"),
+    ("signals_available", "u8"),
+]
+# version of the layout of the processed shot store, part of its path. Bump
+# it when PROCESSED_SHOT_FIELDS change, so that stores of an earlier layout
+# are rebuilt instead of appended to.
+PROCESSED_SHOT_STORE_VERSION = 2
+# columns of the per-signal summary statistics saved with every processed
+# shot, one row per signal in the order of shot.signals. They are sufficient
+# for training the normalizers without restoring the shots.
+SIGNAL_STATS_COLUMNS = ["count", "sum", "sumsq", "min", "max", "std"]
+# per-shot fields of a processed signal store index: the block of a valid
+# signal holds its values at the times (start + i) * dt, resampled from raw
+# data spanning [t_min, t_max]
+PROCESSED_SIGNAL_FIELDS = [
+    ("valid", "?"),
+    ("start", "i8"),
+    ("t_min", "f8"),
+    ("t_max", "f8"),
+    ("num_channels", "i8"),
+]
+# fields of the rows of a ShotList. machine_id and signals_id index its
+# machines and signal_sets tables. Unknown values are stored as NaN
+# (t_disrupt) or -1 (valid, is_disruptive and the processed length).
+SHOT_LIST_FIELDS = [
+    ("number", "i8"),
+    ("machine_id", "i4"),
+    ("signals_id", "i4"),
+    ("t_disrupt", "f8"),
+    ("valid", "i1"),
+    ("is_disruptive", "i1"),
+    ("weight", "f8"),
+    ("length", "i8"),
+]
 
 
 class ShotListFiles(object):
@@ -61,22 +108,135 @@ class ShotListFiles(object):
 
 class ShotList(object):
     """
-    A wrapper class around list of Shot objects, providing utilities to
-    extract, load and transform Shots before passing them to an estimator.
+    A list of shots, providing utilities to extract, load and transform
+    Shots before passing them to an estimator.
 
     During distributed training, shot lists are split into sublists.
     A sublist is a ShotList object having num_at_once shots. The ShotList
     contains an entire dataset as specified in the configuration file.
+
+    The shots are stored as rows of a structured array with the fields of
+    SHOT_LIST_FIELDS, so that filtering, splitting, shuffling and sampling
+    are vectorized and a list of many shots takes a few tens of bytes per
+    shot. Machines and signal lists are stored once, in the tables machines
+    and signal_sets, which the rows refer to by index. Indexing and iterating
+    return Shot objects created on demand from the rows; changing such a Shot
+    does not change the list.
     """
 
     def __init__(self, shots=None):
-        """
-        A ShotList is a list of 2D Numpy arrays.
-        """
-        self.shots = []
+        self.machines = []
+        self.signal_sets = []
+        self.set_rows(np.zeros(0, dtype=SHOT_LIST_FIELDS))
         if shots is not None:
-            assert all([isinstance(shot, Shot) for shot in shots])
-            self.shots = [shot for shot in shots]
+            if isinstance(shots, ShotList):
+                self.extend(shots)
+            else:
+                for shot in shots:
+                    self.append(shot)
+
+    @staticmethod
+    def from_arrays(arrays, prefix, machines, signals):
+        """ShotList saved by get_arrays(prefix) in arrays, e.g. a loaded npz
+        file. Machine names and signal descriptions are mapped back to the
+        given machines and signals, e.g. conf['paths']['all_machines'] and
+        conf['paths']['all_signals']."""
+        machines_by_name = dict((m.name, m) for m in machines)
+        signals_by_description = dict((s.description, s) for s in signals)
+        shot_list = ShotList()
+        shot_list.machines = [
+            machines_by_name[name] for name in arrays[prefix + "_machines"]
+        ]
+        for signal_set in arrays[prefix + "_signal_sets"]:
+            descriptions = json.loads(str(signal_set))
+            if descriptions is not None:
+                descriptions = [signals_by_description[d] for d in descriptions]
+            shot_list.signal_sets.append(descriptions)
+        shot_list.set_rows(np.array(arrays[prefix + "_rows"], dtype=SHOT_LIST_FIELDS))
+        return shot_list
+
+    def get_arrays(self, prefix):
+        """Arrays describing the list without pickled objects, keyed by
+        prefix + suffix, to be saved with np.savez and read with from_arrays."""
+        signal_sets = [
+            None if signals is None else [s.description for s in signals]
+            for signals in self.signal_sets
+        ]
+        return {
+            prefix + "_rows": self.rows,
+            prefix + "_machines": np.array([m.name for m in self.machines], dtype=str),
+            prefix
+            + "_signal_sets": np.array([json.dumps(s) for s in signal_sets], dtype=str),
+        }
+
+    def set_rows(self, rows):
+        self.all_rows = rows
+        self.num_rows = len(rows)
+        self.invalidate_index()
+
+    @property
+    def rows(self):
+        return self.all_rows[: self.num_rows]
+
+    def append_rows(self, rows):
+        """Append rows, growing the row array geometrically so that
+        appending shots one at a time takes amortized constant time."""
+        num = self.num_rows + len(rows)
+        if num > len(self.all_rows):
+            all_rows = np.zeros(max(num, 2 * len(self.all_rows)), SHOT_LIST_FIELDS)
+            all_rows[: self.num_rows] = self.rows
+            self.all_rows = all_rows
+        self.all_rows[self.num_rows : num] = rows
+        self.num_rows = num
+        self.invalidate_index()
+
+    def take(self, idx):
+        """ShotList of the rows selected by idx (indices or a boolean mask),
+        in that order."""
+        shot_list = ShotList()
+        shot_list.machines = list(self.machines)
+        shot_list.signal_sets = list(self.signal_sets)
+        shot_list.set_rows(self.rows[idx])
+        return shot_list
+
+    def get_machine_id(self, machine, add=True):
+        for (i, m) in enumerate(self.machines):
+            if m is machine or m == machine:
+                return i
+        if not add:
+            return -1
+        self.machines.append(machine)
+        return len(self.machines) - 1
+
+    def get_signals_id(self, signals):
+        for (i, s) in enumerate(self.signal_sets):
+            if s is signals or (s is not None and signals is not None and s == signals):
+                return i
+        self.signal_sets.append(None if signals is None else list(signals))
+        return len(self.signal_sets) - 1
+
+    def get_index(self):
+        """Dict mapping (machine id, shot number) to the first row of the shot,
+        built on first use after the rows change."""
+        index = self.__dict__.get("_index")
+        if index is None:
+            keys = zip(
+                self.rows["machine_id"][::-1].tolist(),
+                self.rows["number"][::-1].tolist(),
+            )
+            rows = range(self.num_rows - 1, -1, -1)
+            index = dict(zip(keys, rows))
+            self._index = index
+        return index
+
+    def invalidate_index(self):
+        self.__dict__.pop("_index", None)
+        self.invalidate_samplers()
+
+    def find(self, shot):
+        """Row of the first occurrence of shot, or -1."""
+        machine_id = self.get_machine_id(shot.machine, add=False)
+        return self.get_index().get((machine_id, int(shot.number)), -1)
 
     def load_from_shot_list_files_object(self, shot_list_files_object, signals):
         machine = shot_list_files_object.machine
@@ -84,15 +244,20 @@ class ShotList(object):
             shot_numbers,
             disruption_times,
         ) = shot_list_files_object.get_shot_numbers_and_disruption_times()
-        for number, t in list(zip(shot_numbers, disruption_times)):
-            self.append(
-                Shot(
-                    number=number,
-                    t_disrupt=t,
-                    machine=machine,
-                    signals=[s for s in signals if s.is_defined_on_machine(machine)],
-                )
-            )
+        rows = np.zeros(len(shot_numbers), dtype=SHOT_LIST_FIELDS)
+        rows["number"] = shot_numbers
+        rows["machine_id"] = self.get_machine_id(machine)
+        rows["signals_id"] = self.get_signals_id(
+            [s for s in signals if s.is_defined_on_machine(machine)]
+        )
+        rows["t_disrupt"] = disruption_times
+        rows["valid"] = -1
+        rows["is_disruptive"] = Shot.is_disruptive_given_disruption_time(
+            disruption_times
+        )
+        rows["weight"] = 1.0
+        rows["length"] = -1
+        self.append_rows(rows)
 
     def load_from_shot_list_files_objects(self, shot_list_files_objects, signals):
         for obj in shot_list_files_objects:
@@ -110,8 +275,8 @@ class ShotList(object):
         use_shots_train = int(round(train_frac * use_shots))
         use_shots_test = int(round((1 - train_frac) * use_shots))
         if len(shot_files_test) == 0:
-            shot_list_train, shot_list_test = train_test_split(
-                self.shots, train_frac, shuffle_training
+            shot_list_train, shot_list_test = self.split_direct(
+                train_frac, shuffle_training
             )
         # train and test list given
         else:
@@ -123,8 +288,8 @@ class ShotList(object):
                 shot_files_test, all_signals
             )
 
-        shot_numbers_train = [shot.number for shot in shot_list_train]
-        shot_numbers_test = [shot.number for shot in shot_list_test]
+        shot_numbers_train = shot_list_train.rows["number"]
+        shot_numbers_test = shot_list_test.rows["number"]
         print(len(shot_numbers_train), len(shot_numbers_test))
         # make sure we only use pre-filtered valid shots
         shots_train = self.filter_by_number(shot_numbers_train)
@@ -135,58 +300,63 @@ class ShotList(object):
         )
 
     def split_direct(self, frac, do_shuffle=True):
-        shot_list_one, shot_list_two = train_test_split(self.shots, frac, do_shuffle)
-        return ShotList(shot_list_one), ShotList(shot_list_two)
+        mask = np.arange(len(self)) < frac * len(self)
+        if do_shuffle:
+            np.random.shuffle(mask)
+        return self.take(mask), self.take(~mask)
 
     def filter_by_number(self, numbers):
-        new_shot_list = ShotList()
-        numbers = set(numbers)
-        for shot in self.shots:
-            if shot.number in numbers:
-                new_shot_list.append(shot)
-        return new_shot_list
+        numbers = np.fromiter(numbers, dtype=np.int64)
+        return self.take(np.isin(self.rows["number"], numbers))
 
     def set_weights(self, weights):
-        assert len(weights) == len(self.shots)
-        for (i, w) in enumerate(weights):
-            self.shots[i].weight = w
+        assert len(weights) == len(self)
+        self.rows["weight"] = weights
+        self.invalidate_samplers()
 
     def sample_weighted_given_arr(self, p):
         p = p / np.sum(p)
-        idx = np.random.choice(range(len(self.shots)), p=p)
-        return self.shots[idx]
+        idx = np.random.choice(range(len(self)), p=p)
+        return self[idx]
 
-    def sample_shot(self):
-        idx = np.random.choice(range(len(self.shots)))
-        return self.shots[idx]
+    def sample_shot(self, replace=True):
+        return self[self.get_sampler("uniform", replace).sample()]
 
-    def sample_weighted(self):
-        p = np.array([shot.weight for shot in self.shots])
-        return self.sample_weighted_given_arr(p)
+    def sample_weighted(self, replace=True):
+        return self[self.get_sampler("weighted", replace).sample()]
 
     def sample_single_class(self, disruptive):
-        weights_d = 0.0
-        weights_nd = 1.0
-        if disruptive:
-            weights_d = 1.0
-            weights_nd = 0.0
-        p = np.array(
-            [
-                weights_d if shot.is_disruptive_shot() else weights_nd
-                for shot in self.shots
-            ]
-        )
-        return self.sample_weighted_given_arr(p)
-
-    def sample_equal_classes(self):
-        weights_d, weights_nd = self.get_weights_d_nd()
-        p = np.array(
-            [
-                weights_d if shot.is_disruptive_shot() else weights_nd
-                for shot in self.shots
-            ]
-        )
-        return self.sample_weighted_given_arr(p)
+        p = (self.rows["is_disruptive"] == 1) == disruptive
+        return self.sample_weighted_given_arr(p.astype(np.float64))
+
+    def sample_equal_classes(self, replace=True):
+        return self[self.get_sampler("equal_classes", replace).sample()]
+
+    def get_sampler(self, kind, replace=True):
+        """ShotSampler of the rows with the weights of get_sampling_weights(kind),
+        kept until the rows or their weights change."""
+        samplers = self.__dict__.setdefault("_samplers", dict())
+        sampler = samplers.get((kind, replace))
+        if sampler is None:
+            sampler = ShotSampler(self.get_sampling_weights(kind), replace)
+            samplers[(kind, replace)] = sampler
+        return sampler
+
+    def invalidate_samplers(self):
+        self.__dict__.pop("_samplers", None)
+
+    def get_sampling_weights(self, kind):
+        """Sampling weights of the shots: 1 for "uniform", the weight column
+        (e.g. the difficulty set with set_weights) for "weighted", and weights
+        balancing disruptive and nondisruptive shots for "equal_classes"."""
+        if kind == "weighted":
+            return np.array(self.rows["weight"])
+        if kind == "equal_classes":
+            weights_d, weights_nd = self.get_weights_d_nd()
+            disruptive = self.rows["is_disruptive"] == 1
+            return np.where(disruptive, weights_d, weights_nd)
+        assert kind == "uniform"
+        return np.ones(len(self))
 
     def get_weights_d_nd(self):
         num_total = len(self)
@@ -201,80 +371,170 @@ class ShotList(object):
         max_weight = np.maximum(weights_d, weights_nd)
         return weights_d / max_weight, weights_nd / max_weight
 
-    def num_timesteps(self, prepath):
-        ls = [shot.num_timesteps(prepath) for shot in self.shots]
-        timesteps_total = sum(ls)
-        timesteps_d = sum(
-            [ts for (i, ts) in enumerate(ls) if self.shots[i].is_disruptive_shot()]
-        )
+    def num_timesteps(self, prepath, dtype=None):
+        ls = self.get_lengths(prepath, dtype)
+        timesteps_total = int(np.sum(ls))
+        timesteps_d = int(np.sum(ls[self.rows["is_disruptive"] == 1]))
         timesteps_nd = timesteps_total - timesteps_d
         return timesteps_total, timesteps_d, timesteps_nd
 
+    def get_lengths(self, prepath, dtype=None):
+        """Processed lengths of all shots. Lengths that are not known yet are
+        looked up in the metadata index and kept in the length column."""
+        for i in np.where(self.rows["length"] < 0)[0]:
+            self.rows["length"][i] = self[i].num_timesteps(prepath, dtype)
+        return np.array(self.rows["length"])
+
     def num_disruptive(self):
-        return len([shot for shot in self.shots if shot.is_disruptive_shot()])
+        return int(np.sum(self.rows["is_disruptive"] == 1))
 
     def __len__(self):
-        return len(self.shots)
+        return self.num_rows
 
     def __str__(self):
-        return str([s.number for s in self.shots])
+        return str(self.rows["number"].tolist())
 
     def __iter__(self):
-        return self.shots.__iter__()
+        return (self.get_shot(i) for i in range(len(self)))
 
     def next(self):
         return self.__iter__().next()
 
     def __add__(self, other_list):
-        return ShotList(self.shots + other_list.shots)
+        shot_list = ShotList()
+        shot_list.extend(self)
+        shot_list.extend(other_list)
+        return shot_list
+
+    def __contains__(self, shot):
+        return self.find(shot) >= 0
 
     def index(self, item):
-        return self.shots.index(item)
+        row = self.find(item)
+        if row < 0:
+            raise ValueError("{} is not in list".format(item.get_id_str()))
+        return row
 
     def __getitem__(self, key):
-        return self.shots[key]
+        if isinstance(key, (int, np.integer)):
+            return self.get_shot(key)
+        return self.take(key)
+
+    def get_shot(self, i):
+        row = self.rows[i]
+        t_disrupt = float(row["t_disrupt"])
+        shot = Shot(
+            number=int(row["number"]),
+            machine=self.machines[row["machine_id"]],
+            signals=self.signal_sets[row["signals_id"]],
+            valid=None if row["valid"] < 0 else bool(row["valid"]),
+            t_disrupt=None if np.isnan(t_disrupt) else t_disrupt,
+        )
+        shot.is_disruptive = (
+            None if row["is_disruptive"] < 0 else bool(row["is_disruptive"])
+        )
+        shot.weight = float(row["weight"])
+        return shot
+
+    @property
+    def shots(self):
+        return self.as_list()
 
     def random_sublist(self, num):
         num = min(num, len(self))
-        shots_picked = np.random.choice(self.shots, size=num, replace=False)
-        return ShotList(shots_picked)
+        return self.take(np.random.choice(len(self), size=num, replace=False))
 
     def sublists(self, num, do_shuffle=True, equal_size=False):
         lists = []
         if do_shuffle:
             self.shuffle()
         for i in range(0, len(self), num):
-            subl = self.shots[i : i + num]
-            while equal_size and len(subl) < num:
-                subl.append(rnd.choice(self.shots))
-            lists.append(subl)
-        return [ShotList(l) for l in lists]
+            idx = list(range(i, min(i + num, len(self))))
+            while equal_size and len(idx) < num:
+                idx.append(rnd.choice(range(len(self))))
+            lists.append(self.take(idx))
+        return lists
 
     def shuffle(self):
-        np.random.shuffle(self.shots)
+        self.set_rows(self.rows[np.random.permutation(len(self))])
 
     def sort(self):
-        self.shots.sort()  # will sort based on machine and number
+        # by machine and number, as Shot.__lt__ compares them
+        names = np.array([str(m) for m in self.machines], dtype=str)
+        keys = np.char.add(
+            np.char.add(names[self.rows["machine_id"]], " : "),
+            self.rows["number"].astype(str),
+        )
+        self.set_rows(self.rows[np.argsort(keys, kind="stable")])
 
     def as_list(self):
-        return self.shots
+        return list(self)
 
-    def append(self, shot):
+    def append(self, shot, length=-1):
         assert isinstance(shot, Shot)
-        self.shots.append(shot)
+        row = np.zeros(1, dtype=SHOT_LIST_FIELDS)
+        row["number"] = shot.number
+        row["machine_id"] = self.get_machine_id(shot.machine)
+        row["signals_id"] = self.get_signals_id(shot.signals)
+        row["t_disrupt"] = np.nan if shot.t_disrupt is None else shot.t_disrupt
+        row["valid"] = -1 if shot.valid is None else shot.valid
+        row["is_disruptive"] = -1 if shot.is_disruptive is None else shot.is_disruptive
+        row["weight"] = shot.weight
+        row["length"] = length
+        self.append_rows(row)
+
+    def extend(self, other_list):
+        rows = np.array(other_list.rows)
+        if len(rows) > 0:
+            machine_ids = np.array(
+                [self.get_machine_id(m) for m in other_list.machines]
+            )
+            signals_ids = np.array(
+                [self.get_signals_id(s) for s in other_list.signal_sets]
+            )
+            rows["machine_id"] = machine_ids[rows["machine_id"]]
+            rows["signals_id"] = signals_ids[rows["signals_id"]]
+        self.append_rows(rows)
 
     def remove(self, shot):
-        assert shot in self.shots
-        self.shots.remove(shot)
-        assert shot not in self.shots
+        row = self.find(shot)
+        assert row >= 0
+        self.set_rows(np.delete(self.rows, row))
+        assert shot not in self
+
+    def remove_all(self, shots):
+        if not isinstance(shots, ShotList):
+            shots = ShotList(shots)
+        removed = np.zeros(len(self), dtype=bool)
+        for (i, machine) in enumerate(shots.machines):
+            machine_id = self.get_machine_id(machine, add=False)
+            numbers = shots.rows["number"][shots.rows["machine_id"] == i]
+            removed |= (self.rows["machine_id"] == machine_id) & np.isin(
+                self.rows["number"], numbers
+            )
+        self.set_rows(self.rows[~removed])
 
     def make_light(self):
-        for shot in self.shots:
-            shot.make_light()
+        # the shots of the list hold no signal data
+        pass
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_samplers", None)
+        state.pop("_index", None)
+        state["all_rows"] = self.rows
+        return state
+
+    def __setstate__(self, state):
+        if "shots" in state:
+            # pickled by an earlier version, as a list of Shot objects
+            self.__init__(state["shots"])
+        else:
+            self.__dict__.update(state)
 
-    def append_if_valid(self, shot):
+    def append_if_valid(self, shot, length=-1):
         if shot.valid:
-            self.append(shot)
+            self.append(shot, length)
             return True
         else:
             # print('Warning: shot {} not valid, omitting'.format(shot.number))
@@ -289,8 +549,25 @@ class Shot(object):
 
     For 0D data, each shot is modeled as a 2D Numpy array - time vs a plasma
     property.
+
+    Shots are created in large numbers as views of the rows of a ShotList,
+    so their attributes are kept in slots rather than a dict.
     """
 
+    __slots__ = [
+        "number",
+        "machine",
+        "signals",
+        "signals_array",
+        "ttd",
+        "valid",
+        "is_disruptive",
+        "t_disrupt",
+        "signals_available",
+        "weight",
+        "augmentation_fn",
+    ]
+
     def __init__(
         self,
         number=None,
@@ -318,11 +595,14 @@ class Shot(object):
         self.number = number  # Shot number
         self.machine = machine  # machine on which it is defined
         self.signals = signals
+        # dense (T, num_channels) array of all signals, see signals_dict
+        self.signals_array = None
         self.signals_dict = signals_dict
         self.ttd = ttd
         self.valid = valid
         self.is_disruptive = is_disruptive
         self.t_disrupt = t_disrupt
+        self.signals_available = None
         self.weight = 1.0
         self.augmentation_fn = None
         if t_disrupt is not None:
@@ -339,13 +619,65 @@ class Shot(object):
     def __lt__(self, other):
         return self.get_id_str().__lt__(other.get_id_str())
 
+    def get_key(self):
+        """(machine name, number), which identifies a shot."""
+        return (self.machine.name, self.number)
+
     def __eq__(self, other):
-        return self.get_id_str().__eq__(other.get_id_str())
+        if not isinstance(other, Shot):
+            return NotImplemented
+        return self.get_key() == other.get_key()
 
     def __hash__(self):
-        import hashlib
+        return hash(self.get_key())
+
+    def get_registry(self):
+        return get_signal_registry(self.signals)
+
+    @property
+    def signals_dict(self):
+        """Dict-like view of the signals, keyed by Signal, or None."""
+        if getattr(self, "signals_array", None) is None:
+            return None
+        return ShotSignals(self)
+
+    @signals_dict.setter
+    def signals_dict(self, signals_dict):
+        if signals_dict is None:
+            self.signals_array = None
+        elif isinstance(signals_dict, ShotSignals):
+            self.signals_array = signals_dict.shot.signals_array
+        else:
+            # e.g. a dict restored from an npz file of an earlier version
+            self.signals_array = np.column_stack(
+                [signals_dict[sig] for sig in self.signals]
+            )
 
-        return int(hashlib.md5(self.get_id_str().encode("utf-8")).hexdigest(), 16)
+    def __getstate__(self):
+        return dict(
+            (name, getattr(self, name))
+            for name in Shot.__slots__
+            if hasattr(self, name)
+        )
+
+    def __setstate__(self, state):
+        # also accepts the __dict__ of a Shot pickled by an earlier version
+        self.signals_array = None
+        self.signals_available = None
+        self.weight = 1.0
+        self.augmentation_fn = None
+        for name in Shot.__slots__:
+            if name in state:
+                setattr(self, name, state[name])
+        if state.get("signals_dict") is not None:
+            self.signals_dict = state["signals_dict"]
+
+    def get_writable_signals_array(self):
+        # restored signals are read-only views of the shot store; they are
+        # copied on the first write
+        if not self.signals_array.flags.writeable:
+            self.signals_array = np.array(self.signals_array)
+        return self.signals_array
 
     def __str__(self):
         string = "number: {}\n".format(self.number)
@@ -358,8 +690,12 @@ class Shot(object):
         string += "t_disrupt: {}\n".format(self.t_disrupt)
         return string
 
-    def num_timesteps(self, prepath):
-        self.restore(prepath)
+    def num_timesteps(self, prepath, dtype=None):
+        store = get_processed_store(prepath, self.machine, dtype)
+        record = store.get_record(self.number)
+        if record is not None:
+            return int(record["nrows"])
+        self.restore(prepath, dtype=dtype)
         ts = self.ttd.shape[0]
         self.make_light()
         return ts
@@ -377,30 +713,24 @@ class Shot(object):
         return self.is_disruptive
 
     def get_data_arrays(self, use_signals, dtype="float32"):
+        """Return ttd and the columns of use_signals. The signal array is a
+        view of the shot's signals if use_signals are contiguous in it and
+        already have the requested dtype."""
         t_array = self.ttd
-        signal_array = np.zeros(
-            (len(t_array), sum([sig.num_channels for sig in use_signals])), dtype=dtype
-        )
-        curr_idx = 0
-        for sig in use_signals:
-            signal_array[:, curr_idx : curr_idx + sig.num_channels] = self.signals_dict[
-                sig
-            ]
-            curr_idx += sig.num_channels
-        return t_array, signal_array
+        columns = self.get_registry().get_columns(use_signals)
+        if isinstance(columns, slice):
+            signal_array = self.signals_array[:, columns]
+        else:
+            signal_array = np.take(self.signals_array, columns, axis=1)
+        return t_array, signal_array.astype(dtype, copy=False)
 
     def get_data_arrays_contaminate(
         self, use_signals, dtype="float32", contaminate_description=None, cvalue=0.0
     ):
-        t_array = self.ttd
-        signal_array = np.zeros(
-            (len(t_array), sum([sig.num_channels for sig in use_signals])), dtype=dtype
-        )
+        t_array, signal_array = self.get_data_arrays(use_signals, dtype)
+        signal_array = np.array(signal_array)
         curr_idx = 0
         for sig in use_signals:
-            signal_array[:, curr_idx : curr_idx + sig.num_channels] = self.signals_dict[
-                sig
-            ]
             if sig.description == contaminate_description:
                 print(
                     "Contaminating ",
@@ -412,6 +742,15 @@ class Shot(object):
             curr_idx += sig.num_channels
         return t_array, signal_array
 
+    def get_available_signals(self):
+        if self.signals_available is None:
+            return None
+        return [
+            sig
+            for (i, sig) in enumerate(self.signals)
+            if (int(self.signals_available) >> i) & 1
+        ]
+
     def get_individual_signal_arrays(self):
         # guarantee ordering
         return [self.signals_dict[sig] for sig in self.signals]
@@ -419,75 +758,132 @@ class Shot(object):
     def preprocess(self, conf):
         sys.stdout.write("\rrecomputing {}".format(self.number))
         sys.stdout.flush()
+        if self.number in [127613, 129423, 125726, 126662, 165910]:
+            self.valid = False
+            self.signals_available = 0
+            return
+        # resampled signals, computed only for signals not processed before
+        signal_records = [
+            self.get_processed_signal(signal, conf) for signal in self.signals
+        ]
         # get minmax times
-        (
-            time_arrays,
-            signal_arrays,
-            t_min,
-            t_max,
-            valid,
-        ) = self.get_signals_and_times_from_file(conf)
+        t_min, t_max, valid, signals_available, zero_fill = self.get_time_window(
+            signal_records, conf
+        )
         self.valid = valid
+        self.signals_available = signals_available
         print("shot NUMBER", self.number, "valid==", valid, "......................")
-        # cut and resample
+        # cut to the common window
         if self.valid:
-            self.cut_and_resample_signals(
-                time_arrays, signal_arrays, t_min, t_max, conf
+            self.assemble_signals(signal_records, t_min, t_max, conf, zero_fill)
+
+    def load_signal(self, signal, conf):
+        signal_prepath = conf["paths"]["signal_prepath"]
+        if isinstance(signal_prepath, list):
+            for prepath in signal_prepath:
+                t, sig, valid_signal = signal.load_data(
+                    prepath, self, conf["data"]["floatx"]
+                )
+                if valid_signal:
+                    break
+        else:
+            t, sig, valid_signal = signal.load_data(
+                signal_prepath, self, conf["data"]["floatx"]
             )
+        return t, sig, valid_signal
+
+    def get_processed_signal(self, signal, conf):
+        """Return the store and record of one signal of this shot, resampled
+        with the conf's dt and saved by a previous run if possible.
 
-    def get_signals_and_times_from_file(self, conf):
+        The signal is resampled over its own time range, extended by its data
+        availability tolerance, on the grid k * dt common to all signals, so
+        that shots can be assembled from any combination of signals.
+        """
+        dt = conf["data"]["dt"]
+        store = get_processed_signal_store(
+            conf["paths"]["processed_signal_prepath"],
+            self.machine,
+            signal,
+            dt,
+            conf["data"]["floatx"],
+        )
+        record = store.get_record(self.number)
+        if record is not None and not conf["data"]["recompute"]:
+            return store, record
+        t, sig, valid_signal = self.load_signal(signal, conf)
+        if not valid_signal:
+            # the number of channels of garbage data is still needed
+            num_channels = -1 if sig is None else sig[1]
+            record = store.append(
+                self.number,
+                np.zeros((0, 0)),
+                valid=False,
+                num_channels=num_channels,
+            )
+            return store, record
+        assert len(sig.shape) == 2
+        assert len(t.shape) == 1
+        assert len(t) > 1
+        t_min_signal = np.min(t)
+        t_max_signal = np.max(t)
+        start = int(np.ceil(t_min_signal / dt))
+        end = int(
+            np.ceil((t_max_signal + signal.get_data_avail_tolerance(self.machine)) / dt)
+        )
+        tt = np.arange(start, max(end, start + 1)) * dt
+        _, sigr = resample_signals(
+            [t], [sig], t_min_signal, t_max_signal, dt, conf["data"]["floatx"], tt=tt
+        )
+        record = store.append(
+            self.number,
+            sigr,
+            valid=True,
+            start=start,
+            t_min=t_min_signal,
+            t_max=t_max_signal,
+            num_channels=sigr.shape[1],
+        )
+        return store, record
+
+    def get_time_window(self, signal_records, conf):
+        """Time window [t_min, t_max] of the shot, its validity, the bits of
+        the signals with data and a mask of the signals to be filled with
+        zeros. In garbage mode, a signal of a disruptive shot that ends too
+        long before the disruption is zeroed, so that no data close to the
+        disruption can be peeked from it."""
         valid = True
-        t_min = -np.Inf
-        t_max = np.Inf
-        # t_thresh = -1
-        signal_arrays = []
-        time_arrays = []
+        t_min = -np.inf
+        t_max = np.inf
         garbage = False
         # disruptive = self.t_disrupt >= 0
         if conf["paths"]["data"] == "d3d_data_garbage":
             garbage = True
         non_valid_signals = 0
-        signal_prepath = conf["paths"]["signal_prepath"]
-        if self.number in [127613, 129423, 125726, 126662, 165910]:
-            return None, None, None, None, False
-        for (i, signal) in enumerate(self.signals):
-            if isinstance(signal_prepath, list):
-                for prepath in signal_prepath:
-                    t, sig, valid_signal = signal.load_data(
-                        prepath, self, conf["data"]["floatx"]
-                    )
-                    if valid_signal:
-                        break
-            else:
-                t, sig, valid_signal = signal.load_data(
-                    signal_prepath, self, conf["data"]["floatx"]
-                )
-            if not valid_signal:
+        signals_available = 0
+        zero_fill = np.zeros(len(self.signals), dtype=bool)
+        for (i, (signal, (_, record))) in enumerate(zip(self.signals, signal_records)):
+            if not record["valid"]:
                 if (
                     signal.is_ip
                     or ("q95" in signal.description)
                     or garbage is False
-                    or sig is None
+                    or record["num_channels"] < 0
                 ):
                     # Not allow a shot if it is missing plasma current information,
                     # or if q95 is missing
-                    return None, None, None, None, False
+                    return None, None, False, signals_available, zero_fill
                 else:
-                    t = np.arange(0, 20, 0.001)
-                    sig = np.zeros((t.shape[0], sig[1]))
+                    # filled with zeros when the signals are assembled
                     non_valid_signals += 1
-                    signal_arrays.append(sig)
-                    time_arrays.append(t)
+                    zero_fill[i] = True
             else:
-                assert len(sig.shape) == 2
-                assert len(t.shape) == 1
-                assert len(t) > 1
-                t_min = max(t_min, np.min(t))
-                signal_arrays.append(sig)
-                time_arrays.append(t)
-
-                if self.is_disruptive and self.t_disrupt > np.max(t):
-                    t_max_total = np.max(t) + signal.get_data_avail_tolerance(
+                signals_available |= 1 << i
+                t_min = max(t_min, record["t_min"])
+                t_max_signal = record["t_max"]
+
+                if self.is_disruptive and self.t_disrupt > t_max_signal:
+                    t_max_total = t_max_signal + signal.get_data_avail_tolerance(
                         self.machine
                     )
                     if self.t_disrupt > t_max_total:
@@ -496,22 +892,21 @@ class Shot(object):
                                 "Shot {}: disruption event ".format(self.number),
                                 "is not contained in valid time region of ",
                                 "signal {} by {}s, omitting.".format(
-                                    self.number, signal, self.t_disrupt - np.max(t)
+                                    signal, self.t_disrupt - t_max_signal
                                 ),
                             )
                             valid = False
                         else:
+                            # set the entire channel to zero to prevent any
+                            # peeking into possible disruptions from this
+                            # early ended channel
                             non_valid_signals += 1
-                            t = np.arange(0, 20, 0.001)
-                            sig = np.zeros((t.shape[0], sig.shape[1]))
-                            # Setting the entire channel to zero to prevent any peeking
-                            # into possible disruptions from this early ended channel
+                            zero_fill[i] = True
+                            signals_available &= ~(1 << i)
                     else:
-                        t_max = np.max(t) + signal.get_data_avail_tolerance(
-                            self.machine
-                        )
+                        t_max = t_max_total
                 else:
-                    t_max = min(t_max, np.max(t))
+                    t_max = min(t_max, t_max_signal)
 
         # make sure the shot is long enough.
         dt = conf["data"]["dt"]
@@ -535,32 +930,32 @@ class Shot(object):
             # Omit a shot if more than 3 channels are bad channels....
             valid = False
 
-        return time_arrays, signal_arrays, t_min, t_max, valid
+        return t_min, t_max, valid, signals_available, zero_fill
 
-    def cut_and_resample_signals(self, time_arrays, signal_arrays, t_min, t_max, conf):
+    def assemble_signals(self, signal_records, t_min, t_max, conf, zero_fill=None):
+        """Cut the resampled signals to the shot's time window.
+
+        The window covers the times k * dt in [t_min, t_max). Signals that
+        are not valid (garbage data) or are set in zero_fill are filled with
+        zeros.
+        """
         dt = conf["data"]["dt"]
-        signals_dict = dict()
-        print("resampling..", self.number)
-        # resample signals
-        assert (len(signal_arrays) == len(time_arrays) == len(self.signals)) and len(
-            signal_arrays
-        ) > 0
-        tr = 0
-        for (i, signal) in enumerate(self.signals):
-            print(signal)
-            tr, sigr = cut_and_resample_signal(
-                time_arrays[i],
-                signal_arrays[i],
-                t_min,
-                t_max,
-                dt,
-                conf["data"]["floatx"],
-            )
-            signals_dict[signal] = sigr
+        start = int(np.ceil(t_min / dt))
+        end = max(int(np.ceil(t_max / dt)), start + 1)
+        k = np.arange(start, end)
+        registry = self.get_registry()
+        sigr = np.zeros((len(k), registry.num_channels), dtype=conf["data"]["floatx"])
+        for (i, (signal, (store, record))) in enumerate(
+            zip(self.signals, signal_records)
+        ):
+            if record["valid"] and (zero_fill is None or not zero_fill[i]):
+                # hold the last value where the window extends past the signal
+                rows = np.clip(k - record["start"], 0, record["nrows"] - 1)
+                sigr[:, registry.get_slice(signal)] = store.get_block(record)[rows]
 
-        ttd = self.convert_to_ttd(tr, conf)
-        self.signals_dict = signals_dict
-        self.ttd = ttd
+        tr = (k * dt).astype(conf["data"]["floatx"])
+        self.signals_array = sigr
+        self.ttd = self.convert_to_ttd(tr, conf)
 
     def convert_to_ttd(self, tr, conf):
         T_max = conf["data"]["T_max"]
@@ -573,22 +968,94 @@ class Shot(object):
         ttd = np.log10(ttd + 1.0 * dt / 10)
         return ttd
 
-    def save(self, prepath):
-        makedirs_process_safe(prepath)
-        save_path = self.get_save_path(prepath)
-        np.savez(
-            save_path,
-            valid=self.valid,
-            is_disruptive=self.is_disruptive,
-            signals_dict=self.signals_dict,
-            ttd=self.ttd,
+    def save(self, prepath, dtype="float32"):
+        """Append the processed shot to the signal group's shot store as one
+        (T, 1 + num_channels) block: ttd in column 0, then the signals in the
+        order of self.signals. Invalid shots are stored as empty blocks."""
+        assert len(self.signals) <= 64, "signal availability mask holds 64 signals"
+        store = get_processed_store(prepath, self.machine, dtype)
+        store.append(
+            self.number,
+            self.get_block(),
+            valid=bool(self.valid),
+            is_disruptive=bool(self.is_disruptive),
+            t_disrupt=-1.0 if self.t_disrupt is None else self.t_disrupt,
+            signals_available=self.signals_available or 0,
         )
+        self.save_signal_stats(prepath)
         print("...saved shot {}".format(self.number))
 
+    def get_signal_stats(self):
+        """Summary statistics of every signal of a valid, restored shot as
+        a (num_signals, len(SIGNAL_STATS_COLUMNS)) float64 array."""
+        registry = self.get_registry()
+        stats = np.zeros((len(self.signals), len(SIGNAL_STATS_COLUMNS)))
+        for (i, sig) in enumerate(self.signals):
+            x = self.signals_array[:, registry.get_slice(sig)]
+            if x.size == 0:
+                continue
+            stats[i] = [
+                x.size,
+                np.sum(x, dtype=np.float64),
+                np.sum(np.square(x, dtype=np.float64)),
+                np.min(x),
+                np.max(x),
+                np.std(x, dtype=np.float64),
+            ]
+        return stats
+
+    def save_signal_stats(self, prepath):
+        """Append the signal stats of the shot to its stats store. Invalid
+        shots are stored as empty blocks."""
+        if not self.valid or self.signals_array is None:
+            stats = np.zeros((0, len(SIGNAL_STATS_COLUMNS)))
+        else:
+            stats = self.get_signal_stats()
+        get_processed_stats_store(prepath, self.machine).append(self.number, stats)
+
+    def restore_signal_stats(self, prepath):
+        """Signal stats saved by save_signal_stats(), None if the shot is
+        invalid or its stats were never saved."""
+        stats = get_processed_stats_store(prepath, self.machine).get(self.number)
+        if stats is None or stats.shape != (
+            len(self.signals),
+            len(SIGNAL_STATS_COLUMNS),
+        ):
+            return None
+        return stats
+
+    def get_block(self):
+        num_channels = self.get_registry().num_channels
+        if not self.valid or self.signals_array is None:
+            return np.zeros((0, 1 + num_channels))
+        return np.column_stack([self.ttd, self.signals_array])
+
     def get_save_path(self, prepath):
         return get_individual_shot_file(prepath, self.number, ".npz")
 
-    def restore(self, prepath, light=False):
+    def restore(self, prepath, light=False, dtype=None):
+        store = get_processed_store(prepath, self.machine, dtype)
+        record = store.get_record(self.number)
+        if record is None:
+            self.restore_from_npz(prepath, light)
+            return
+        self.valid = bool(record["valid"])
+        self.is_disruptive = bool(record["is_disruptive"])
+        self.signals_available = int(record["signals_available"])
+        if light or not self.valid:
+            self.signals_array = None
+            self.ttd = None
+        else:
+            # signals are a zero-copy, read-only view of the memory map. The
+            # targets' remappers modify ttd in place, so it is copied.
+            block = store.get_block(record)
+            num_channels = self.get_registry().num_channels
+            assert block.shape[1] == 1 + num_channels, "stored shot layout differs"
+            self.signals_array = block[:, 1:]
+            self.ttd = np.array(block[:, 0])
+
+    def restore_from_npz(self, prepath, light=False):
+        """Restore a shot saved by earlier versions as a pickled npz file."""
         assert self.previously_saved(prepath), "shot was never saved"
         save_path = self.get_save_path(prepath)
         dat = np.load(save_path, encoding="latin1", allow_pickle=True)
@@ -603,12 +1070,14 @@ class Shot(object):
             self.signals_dict = dat["signals_dict"][()]
             self.ttd = dat["ttd"]
 
-    def previously_saved(self, prepath):
+    def previously_saved(self, prepath, dtype=None):
+        if self.number in get_processed_store(prepath, self.machine, dtype):
+            return True
         save_path = self.get_save_path(prepath)
         return os.path.isfile(save_path)
 
     def make_light(self):
-        self.signals_dict = None
+        self.signals_array = None
         self.ttd = None
 
     @staticmethod
@@ -616,8 +1085,91 @@ class Shot(object):
         return t >= 0
 
 
+class ShotSignals(object):
+    """Dict-like view of a shot's signals, keyed by Signal.
+
+    Values are column views of shot.signals_array. Assigning an array to a
+    signal writes it into that signal's columns; a read-only signals array
+    (e.g. a view of the shot store) is copied first.
+    """
+
+    def __init__(self, shot):
+        self.shot = shot
+
+    def __getitem__(self, sig):
+        return self.shot.signals_array[:, self.shot.get_registry().get_slice(sig)]
+
+    def __setitem__(self, sig, value):
+        columns = self.shot.get_registry().get_slice(sig)
+        signals_array = self.shot.get_writable_signals_array()
+        assert np.shape(value) in [
+            (),
+            signals_array[:, columns].shape,
+        ], "signal {} must keep the shape of the other signals".format(sig)
+        signals_array[:, columns] = value
+
+    def __contains__(self, sig):
+        return sig in self.shot.get_registry().ids
+
+    def __iter__(self):
+        return iter(self.shot.signals)
+
+    def __len__(self):
+        return len(self.shot.signals)
+
+    def keys(self):
+        return list(self.shot.signals)
+
+    def values(self):
+        return [self[sig] for sig in self.shot.signals]
+
+    def items(self):
+        return [(sig, self[sig]) for sig in self.shot.signals]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 # it used to be in utilities, but can't import globals in multiprocessing
 
 
 def get_individual_shot_file(prepath, shot_num, ext=".txt"):
     return prepath + str(shot_num) + ext
+
+
+def get_processed_signal_store(prepath, machine, signal, dt, dtype="float32"):
+    """The store of one signal of one machine, resampled with time step dt,
+    within processed_signal_prepath. The signal is identified by its
+    description, paths and the settings that change its processed data."""
+    signal_id = myhash(
+        "{} {} {} {}".format(
+            signal.description_plus_paths(),
+            signal.get_causal_shift(machine),
+            signal.num_channels,
+            getattr(signal, "mapping_range", None),
+        )
+    )
+    return open_store(
+        os.path.join(prepath, machine.name, "signal_{}_dt_{}".format(signal_id, dt)),
+        dtype=dtype,
+        extra_fields=PROCESSED_SIGNAL_FIELDS,
+    )
+
+
+def get_processed_store(prepath, machine, dtype=None):
+    """The store of processed shots of one machine within processed_prepath.
+    dtype, e.g. conf['data']['floatx'], is checked against the store's (see
+    open_store)."""
+    return open_store(
+        os.path.join(
+            prepath, machine.name, "shots_v{}".format(PROCESSED_SHOT_STORE_VERSION)
+        ),
+        dtype=dtype,
+        extra_fields=PROCESSED_SHOT_FIELDS,
+    )
+
+
+def get_processed_stats_store(prepath, machine):
+    """The store of per-shot signal stats of one machine, kept next to the
+    processed shots within processed_prepath."""
+    return open_store(os.path.join(prepath, machine.name, "signal_stats"), dtype="f8")
@@ -0,0 +1,499 @@
+"""
+#########################################################
+This file contains an append-only, sharded array store used to pack many
+small per-shot arrays into a few large memory-mapped files.
+
+A store is a directory holding:
+ - shard_<id>.bin: raw row-major blocks of a single dtype
+ - shard_<id>.idx: fixed-size index records appended by the shard's writer
+ - index.npy: consolidated index records (optional)
+ - store.json: dtype of the blocks and layout of the index records
+
+Every writing process appends to its own shard, so parallel workers never
+contend for a file. Readers merge the index records (latest record for a key
+wins) and slice blocks straight out of np.memmap views of the shards.
+#########################################################
+"""
+
+from __future__ import print_function
+import json
+import os
+import sys
+import time
+import uuid
+import multiprocessing as mp
+
+import numpy as np
+
+from downloading import makedirs_process_safe
+
+RECORD_FIELDS = [
+    ("key", "i8"),
+    ("shard", "i8"),
+    ("offset", "i8"),
+    ("nrows", "i8"),
+    ("ncols", "i8"),
+    ("ndim", "i8"),
+    ("stamp", "f8"),
+]
+HEADER_FILE = "store.json"
+INDEX_FILE = "index.npy"
+DEFAULT_SHARD_BYTES = 2 ** 30
+
+
+class ShardedArrayStore(object):
+    """Map integer keys (e.g. shot numbers) to arrays of one dtype and up to
+    two dimensions.
+
+    Argument list:
+      - prepath: directory of the store, created on first write
+      - dtype: dtype of the stored blocks. Ignored when opening a store that
+        already exists; the dtype recorded in its header is used instead
+      - extra_fields: list of (name, dtype) pairs added to every index
+        record, e.g. per-shot metadata that should be queryable without
+        touching the blocks
+      - shard_bytes: size after which a writer starts a new shard
+    """
+
+    def __init__(self, prepath, dtype="float32", extra_fields=None, shard_bytes=None):
+        self.prepath = prepath
+        self.shard_bytes = shard_bytes or DEFAULT_SHARD_BYTES
+        self.dtype = np.dtype(dtype)
+        self.record_dtype = np.dtype(RECORD_FIELDS + list(extra_fields or []))
+        self.read_layout()
+        self.invalidate()
+        self._maps = dict()
+        self._writer = None
+
+    def __str__(self):
+        return "ShardedArrayStore({}, {} keys)".format(self.prepath, len(self))
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __len__(self):
+        return len(self.get_index())
+
+    def __contains__(self, key):
+        return int(key) in self.get_index()
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.prepath, HEADER_FILE))
+
+    def read_header(self):
+        path = os.path.join(self.prepath, HEADER_FILE)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def read_layout(self):
+        # a store created by another process since this object was made
+        # dictates the layout
+        header = self.read_header()
+        if header is not None:
+            self.dtype = np.dtype(header["dtype"])
+            self.record_dtype = np.dtype(
+                [(str(name), str(fmt)) for name, fmt in header["record"]]
+            )
+
+    def write_header(self):
+        if self.exists():
+            return
+        makedirs_process_safe(self.prepath)
+        header = {
+            "dtype": self.dtype.str,
+            "record": [[name, fmt] for name, fmt in self.record_dtype.descr],
+        }
+        # several workers may race to create the header; the contents are
+        # identical, so an atomic rename of a private copy is sufficient
+        tmp_path = os.path.join(
+            self.prepath, "{}.{}.tmp".format(HEADER_FILE, os.getpid())
+        )
+        with open(tmp_path, "w") as f:
+            json.dump(header, f)
+        os.replace(tmp_path, os.path.join(self.prepath, HEADER_FILE))
+
+    #################
+    #    READING    #
+    #################
+    def invalidate(self):
+        """Drop the cached index so that it is re-read on the next access."""
+        self._records = None
+        self._index = None
+
+    def read_all_records(self):
+        if not os.path.isdir(self.prepath):
+            return np.zeros(0, dtype=self.record_dtype)
+        parts = []
+        index_path = os.path.join(self.prepath, INDEX_FILE)
+        if os.path.isfile(index_path):
+            parts.append(np.load(index_path))
+        for f in sorted(os.listdir(self.prepath)):
+            if f.startswith("shard_") and f.endswith(".idx"):
+                path = os.path.join(self.prepath, f)
+                # ignore a trailing partial record left by an interrupted write
+                count = os.path.getsize(path) // self.record_dtype.itemsize
+                parts.append(np.fromfile(path, dtype=self.record_dtype, count=count))
+        if len(parts) == 0:
+            return np.zeros(0, dtype=self.record_dtype)
+        return np.concatenate(parts).astype(self.record_dtype, copy=False)
+
+    def load_index(self):
+        self.read_layout()
+        records = self.read_all_records()
+        # the latest record written for a key supersedes older ones
+        records = records[np.argsort(records["stamp"], kind="mergesort")]
+        _, last = np.unique(records["key"][::-1], return_index=True)
+        records = records[np.sort(len(records) - 1 - last)]
+        self._records = records
+        self._index = dict(zip(records["key"].tolist(), records))
+
+    def get_index(self):
+        if self._index is None:
+            self.load_index()
+        return self._index
+
+    def records(self):
+        """Structured array of the live index records, one per key."""
+        index = self.get_index()
+        if self._records is None:
+            self._records = np.array(list(index.values()), dtype=self.record_dtype)
+        return self._records
+
+    def keys(self):
+        return self.records()["key"]
+
+    def get_record(self, key):
+        return self.get_index().get(int(key))
+
+    def get(self, key):
+        """Return the array stored under key as a read-only view, or None."""
+        record = self.get_record(key)
+        if record is None:
+            return None
+        return self.get_block(record)
+
+    def get_block(self, record):
+        nrows, ncols = int(record["nrows"]), int(record["ncols"])
+        size = nrows * ncols
+        if size == 0:
+            block = np.zeros((nrows, ncols), dtype=self.dtype)
+        else:
+            offset = int(record["offset"])
+            mm = self.get_map(int(record["shard"]), offset + size)
+            block = mm[offset : offset + size].reshape((nrows, ncols))
+        if record["ndim"] < 2:
+            block = block.reshape((-1,) if record["ndim"] == 1 else ())
+        return block
+
+    def get_map(self, shard, min_size):
+        mm = self._maps.get(shard)
+        # shards are append-only, so a map only goes stale by being too short
+        if mm is None or mm.shape[0] < min_size:
+            mm = np.memmap(self.get_shard_path(shard), dtype=self.dtype, mode="r")
+            # hand out plain ndarray views; the memmap stays alive as their base
+            mm = mm.view(np.ndarray)
+            self._maps[shard] = mm
+        return mm
+
+    def get_shard_path(self, shard, ext=".bin"):
+        return os.path.join(self.prepath, "shard_{:016x}{}".format(shard, ext))
+
+    #################
+    #    WRITING    #
+    #################
+    def append(self, key, arr, **fields):
+        """Append arr under key; later appends of the same key supersede it.
+
+        Extra keyword arguments fill the extra_fields of the index record.
+        """
+        arr = np.asarray(arr)
+        assert arr.ndim <= 2, "only 0D, 1D and 2D arrays can be stored"
+        arr = np.ascontiguousarray(arr, dtype=self.dtype)
+        writer = self.get_writer()
+        offset = writer["position"] // self.dtype.itemsize
+        writer["data"].write(arr.tobytes())
+        writer["data"].flush()
+        writer["position"] += arr.nbytes
+
+        record = np.zeros(1, dtype=self.record_dtype)
+        record["key"] = key
+        record["shard"] = writer["shard"]
+        record["offset"] = offset
+        record["nrows"] = 1 if arr.ndim == 0 else arr.shape[0]
+        record["ncols"] = 1 if arr.ndim < 2 else arr.shape[1]
+        record["ndim"] = arr.ndim
+        record["stamp"] = time.time()
+        for name, value in fields.items():
+            record[name] = value
+        # the record is only written once its block is on disk
+        writer["index"].write(record.tobytes())
+        writer["index"].flush()
+        # keep a loaded index current without re-reading every index file
+        if self._index is not None:
+            self._index[int(key)] = record[0]
+            self._records = None
+        return record[0]
+
+    def get_writer(self):
+        writer = self._writer
+        # processes forked from a writer must not share its shard
+        if (
+            writer is None
+            or writer["pid"] != os.getpid()
+            or writer["position"] >= self.shard_bytes
+        ):
+            self.close_writer()
+            self.write_header()
+            shard = uuid.uuid4().int >> 65
+            writer = {
+                "pid": os.getpid(),
+                "shard": shard,
+                "data": open(self.get_shard_path(shard), "ab"),
+                "index": open(self.get_shard_path(shard, ".idx"), "ab"),
+                "position": 0,
+            }
+            self._writer = writer
+        return writer
+
+    def close_writer(self):
+        writer = self._writer
+        self._writer = None
+        if writer is not None and writer["pid"] == os.getpid():
+            writer["data"].close()
+            writer["index"].close()
+
+    def get_shard_files(self, ext):
+        if not os.path.isdir(self.prepath):
+            return []
+        return [
+            f
+            for f in os.listdir(self.prepath)
+            if f.startswith("shard_") and f.endswith(ext)
+        ]
+
+    def consolidate(self):
+        """Merge all shard index files into a single index.npy. Does nothing
+        if no blocks were appended since the last consolidate() or compact().
+
+        Must not run concurrently with writers of the same store.
+        """
+        self.close_writer()
+        if len(self.get_shard_files(".idx")) == 0:
+            return
+        self.invalidate()
+        records = self.records()
+        tmp_path = os.path.join(self.prepath, "index.{}.tmp.npy".format(os.getpid()))
+        np.save(tmp_path, records)
+        os.replace(tmp_path, os.path.join(self.prepath, INDEX_FILE))
+        for f in os.listdir(self.prepath):
+            if f.startswith("shard_") and f.endswith(".idx"):
+                os.remove(os.path.join(self.prepath, f))
+        self.invalidate()
+
+    def compact(self):
+        """Rewrite the live blocks, ordered by key, into a single contiguous
+        shard and drop superseded blocks and all other shards. Does nothing
+        if the store already is a single shard without appended blocks.
+
+        Must not run concurrently with writers of the same store.
+        """
+        self.close_writer()
+        if not self.exists():
+            return
+        if (
+            len(self.get_shard_files(".idx")) == 0
+            and len(self.get_shard_files(".bin")) <= 1
+        ):
+            return
+        self.invalidate()
+        records = np.sort(self.records(), order="key")
+        old_files = [f for f in os.listdir(self.prepath) if f.startswith("shard_")]
+        shard = uuid.uuid4().int >> 65
+        new_records = records.copy()
+        new_records["shard"] = shard
+        new_records["stamp"] = time.time()
+        position = 0
+        with open(self.get_shard_path(shard), "wb") as f:
+            for (i, record) in enumerate(records):
+                block = self.get_block(record)
+                new_records[i]["offset"] = position // self.dtype.itemsize
+                f.write(np.ascontiguousarray(block).tobytes())
+                position += block.nbytes
+        tmp_path = os.path.join(self.prepath, "index.{}.tmp.npy".format(os.getpid()))
+        np.save(tmp_path, new_records)
+        os.replace(tmp_path, os.path.join(self.prepath, INDEX_FILE))
+        self._maps = dict()
+        for f in old_files:
+            os.remove(os.path.join(self.prepath, f))
+        self.invalidate()
+
+    def __getstate__(self):
+        # open files and memory maps are per process
+        state = self.__dict__.copy()
+        state["_maps"] = dict()
+        state["_writer"] = None
+        return state
+
+
+_open_stores = dict()
+
+
+def open_store(prepath, dtype=None, **kwargs):
+    """Return a per-process cached ShardedArrayStore for prepath.
+
+    dtype, if given, must be the dtype of the store. A store that was not
+    written yet takes it on; otherwise a mismatch raises a ValueError rather
+    than silently storing or reading arrays of another dtype. So does an
+    existing store whose index lacks some of the given extra_fields.
+    """
+    store = _open_stores.get(prepath)
+    if store is None:
+        store = ShardedArrayStore(prepath, dtype=dtype or "float32", **kwargs)
+        # e.g. a store written before extra_fields were added
+        missing = [
+            name
+            for (name, _) in kwargs.get("extra_fields") or []
+            if name not in store.record_dtype.names
+        ]
+        if len(missing) > 0:
+            raise ValueError(
+                "store {} has no index fields {}; remove it or use another "
+                "prepath".format(prepath, missing)
+            )
+        _open_stores[prepath] = store
+    if dtype is not None and np.dtype(dtype) != store.dtype:
+        store.read_layout()
+        if store.exists():
+            raise ValueError(
+                "store {} holds {} arrays, not {}; remove it or use "
+                "another prepath".format(prepath, store.dtype, np.dtype(dtype))
+            )
+        store.dtype = np.dtype(dtype)
+    return store
+
+
+def open_existing_store(prepath):
+    """Like open_store(), but return None if no store exists at prepath."""
+    store = _open_stores.get(prepath)
+    if store is None and os.path.isfile(os.path.join(prepath, HEADER_FILE)):
+        store = open_store(prepath)
+    return store
+
+
+def close_store(prepath):
+    """Close the writer and memory maps of the cached store for prepath, if
+    any, and forget it, e.g. before its files are removed."""
+    store = _open_stores.pop(prepath, None)
+    if store is not None:
+        store.close_writer()
+        store._maps = dict()
+        store.invalidate()
+
+
+#######################
+# PACKED RAW SIGNALS  #
+#######################
+def get_packed_signal_prepath(signal_prepath):
+    """Location of the packed copy of a signal_prepath text tree."""
+    return os.path.join(signal_prepath, "packed_signals")
+
+
+def pack_text_directory(txt_dir, packed_dir, dtype="float32", overwrite=False):
+    """Pack every <shot>.txt file of txt_dir into a store at packed_dir.
+
+    Files that were packed before are skipped, unless they were modified
+    since, e.g. downloaded again. Files that are empty or cannot be parsed
+    are left for the text fallback of Signal.load_data_from_txt_safe to
+    report and remove.
+    """
+    store = ShardedArrayStore(packed_dir, dtype=dtype)
+    records = store.records()
+    packed_stamps = dict() if overwrite else dict(zip(records["key"], records["stamp"]))
+    num_packed = 0
+    for f in sorted(os.listdir(txt_dir)):
+        stem, ext = os.path.splitext(f)
+        if ext != ".txt" or not stem.isdigit():
+            continue
+        file_path = os.path.join(txt_dir, f)
+        stamp = packed_stamps.get(int(stem))
+        if stamp is not None and os.path.getmtime(file_path) <= stamp:
+            continue
+        if os.path.getsize(file_path) == 0:
+            continue
+        try:
+            data = np.loadtxt(file_path, dtype=dtype)
+        except Exception as e:
+            print("Couldnt pack {}: {}".format(file_path, e))
+            continue
+        store.append(int(stem), data)
+        num_packed += 1
+    store.consolidate()
+    return txt_dir, num_packed
+
+
+def pack_signal_prepath(conf, overwrite=False, verbose=True):
+    """Convert the signal_prepath text tree(s) of conf into packed stores.
+
+    One store is written per (machine, signal) directory, next to the text
+    tree under get_packed_signal_prepath(). Conversion is incremental: shots
+    that are already packed and unchanged since are skipped unless overwrite
+    is set.
+    """
+    signal_prepaths = conf["paths"]["signal_prepath"]
+    if not isinstance(signal_prepaths, list):
+        signal_prepaths = [signal_prepaths]
+    machines = conf["paths"]["all_machines"]
+    dirs = []
+    for prepath in signal_prepaths:
+        packed_prepath = get_packed_signal_prepath(prepath)
+        for signal in conf["paths"]["all_signals"]:
+            for machine in machines:
+                if not signal.is_defined_on_machine(machine):
+                    continue
+                txt_dir = os.path.dirname(signal.get_file_path(prepath, machine, 0))
+                if os.path.isdir(txt_dir):
+                    packed_dir = os.path.dirname(
+                        signal.get_file_path(packed_prepath, machine, 0)
+                    )
+                    dirs.append((txt_dir, packed_dir))
+
+    use_cores = max(1, min(len(dirs), mp.cpu_count() - 2))
+    pool = mp.Pool(use_cores)
+    if verbose:
+        print(
+            "Packing {} signal directories on {} processes".format(len(dirs), use_cores)
+        )
+    start_time = time.time()
+    num_total = 0
+    for (i, (txt_dir, num_packed)) in enumerate(
+        pool.imap_unordered(
+            _pack_text_directory_star, [d + ("float32", overwrite) for d in dirs]
+        )
+    ):
+        num_total += num_packed
+        if verbose:
+            sys.stdout.write(
+                "\r{}/{}: packed {} files from {}".format(
+                    i + 1, len(dirs), num_packed, txt_dir
+                )
+            )
+    pool.close()
+    pool.join()
+    if verbose:
+        print(
+            "\nFinished packing {} files in {} seconds".format(
+                num_total, time.time() - start_time
+            )
+        )
+
+
+def _pack_text_directory_star(args):
+    return pack_text_directory(*args)
+
+
+if __name__ == "__main__":
+    from conf import conf
+
+    pack_signal_prepath(conf)
@@ -0,0 +1,149 @@
+"""
+#########################################################
+This file contains torch.utils.data adapters of ShotList and Loader, so that
+the Torch runner can load and normalize shots with DataLoader worker
+processes, pinned memory and persistent workers.
+#########################################################
+"""
+
+from __future__ import print_function
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
+
+
+class ShotDataset(Dataset):
+    """Map-style dataset of the normalized shots of a ShotList, in order.
+
+    Item i is (signal, ttd, is_disruptive) of the i-th shot, as returned by
+    Loader.get_signal_result_from_shot.
+    """
+
+    def __init__(self, shot_list, loader):
+        self.shot_list = shot_list
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.shot_list)
+
+    def __getitem__(self, i):
+        return self.loader.get_signal_result_from_shot(
+            self.shot_list[i], prediction_mode=True
+        )
+
+
+class ShuffledShotDataset(IterableDataset):
+    """Iterable dataset yielding one epoch of training shots per iteration,
+    drawn like Loader.training_batch_generator_full_shot_partial_reset does.
+
+    Every epoch shuffles the shot order with the seed seed + epoch, which is
+    the same in all DataLoader workers, and worker k of n yields every n-th
+    shot of it starting at k. Items are (signal, ttd, is_disruptive).
+    """
+
+    def __init__(self, shot_list, loader, seed=0):
+        self.shot_list = shot_list
+        self.loader = loader
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.shot_list)
+
+    def __iter__(self):
+        order = np.random.RandomState(self.seed + self.epoch).permutation(
+            len(self.shot_list)
+        )
+        self.epoch += 1
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            order = order[worker_info.id :: worker_info.num_workers]
+        for idx in order:
+            shot = self.loader.sample_shot_from_list_given_index(self.shot_list, idx)
+            yield self.loader.get_signal_result_from_shot(shot, prediction_mode=True)
+
+
+def collate_shots(samples):
+    """Pad (signal, ttd, is_disruptive) samples with zeros to the longest
+    shot of the batch.
+
+    Returns tensors X (B, T, num_signals), Y and mask (B, T, num_targets),
+    disruptive (B,) and lengths (B,). The mask is True where Y holds data.
+    """
+    lengths = np.array([res.shape[0] for (_, res, _) in samples], dtype=np.int64)
+    max_len = np.max(lengths)
+    sig0, res0, _ = samples[0]
+    X = np.zeros((len(samples), max_len, sig0.shape[1]), dtype=sig0.dtype)
+    Y = np.zeros((len(samples), max_len, res0.shape[1]), dtype=sig0.dtype)
+    mask = np.zeros((len(samples), max_len, res0.shape[1]), dtype=bool)
+    for (i, (sig, res, _)) in enumerate(samples):
+        X[i, : lengths[i]] = sig
+        Y[i, : lengths[i]] = res
+        mask[i, : lengths[i]] = True
+    disruptive = np.array([disr for (_, _, disr) in samples], dtype=bool)
+    return (
+        torch.from_numpy(X),
+        torch.from_numpy(Y),
+        torch.from_numpy(mask),
+        torch.from_numpy(disruptive),
+        torch.from_numpy(lengths),
+    )
+
+
+def seed_worker(worker_id):
+    # torch seeds every worker differently; make numpy and random follow it
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def get_data_loader(dataset, batch_size, num_workers):
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        collate_fn=collate_shots,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=num_workers > 0,
+        worker_init_fn=seed_worker,
+    )
+
+
+def training_batch_generator(conf, shot_list, loader):
+    """DataLoader counterpart of
+    Loader.training_batch_generator_full_shot_partial_reset, with
+    conf['training']['dataloader_workers'] worker processes. Yields
+    (X, Y, mask, num_so_far, num_total) with X, Y and mask as tensors.
+    """
+    batch_size = conf["training"]["batch_size"]
+    dataset = ShuffledShotDataset(shot_list, loader, seed=np.random.randint(2 ** 31))
+    data_loader = get_data_loader(
+        dataset, batch_size, conf["training"]["dataloader_workers"]
+    )
+    num_total = len(shot_list)
+    num_so_far = 0
+    while True:
+        for (X, Y, mask, _, _) in data_loader:
+            num_so_far += X.shape[0]
+            yield X, Y, mask, num_so_far, num_total
+
+
+def inference_batch_generator(conf, shot_list, loader):
+    """DataLoader counterpart of Loader.inference_batch_generator_full_shot.
+    Yields (X, Y, mask, disruptive, lengths, num_so_far, num_total) as numpy
+    arrays, cycling through shot_list in order."""
+    dataset = ShotDataset(shot_list, loader)
+    data_loader = get_data_loader(
+        dataset,
+        conf["model"]["pred_batch_size"],
+        conf["training"]["dataloader_workers"],
+    )
+    num_total = len(shot_list)
+    num_so_far = 0
+    while True:
+        for batch in data_loader:
+            num_so_far += batch[0].shape[0]
+            yield tuple(t.numpy() for t in batch) + (num_so_far, num_total)
@@ -49,6 +49,8 @@ elif conf["data"]["normalizer"] == "var":
 elif conf["data"]["normalizer"] == "averagevar":
     # performs !much better than minmaxnormalizer
     from normalize import AveragingVarNormalizer as Normalizer
+elif conf["data"]["normalizer"] == "quantile":
+    from normalize import QuantileNormalizer as Normalizer
 else:
     print("unkown normalizer. exiting")
     exit(1)
@@ -168,6 +170,14 @@ shot_list_validate.make_light()
 shot_list_test.make_light()
 shot_list_train.make_light()
 
+shot_list_arrays = dict()
+for (name, shot_list) in [
+    ("shot_list_validate", shot_list_validate),
+    ("shot_list_train", shot_list_train),
+    ("shot_list_test", shot_list_test),
+]:
+    shot_list_arrays.update(shot_list.get_arrays(name))
+
 save_str = "results_" + datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
 result_base_path = conf["paths"]["results_prepath"]
 if not os.path.exists(result_base_path):
@@ -183,10 +193,9 @@ np.savez(
     disruptive=disruptive,
     disruptive_train=disruptive_train,
     disruptive_test=disruptive_test,
-    shot_list_validate=shot_list_validate,
-    shot_list_train=shot_list_train,
-    shot_list_test=shot_list_test,
     conf=conf,
+    **shot_list_arrays,
 )
+loader.close()
 
 print("finished.")
@@ -23,6 +23,7 @@ from torch.autograd import Variable
 import torch.optim as opt
 from torch.nn.utils import weight_norm
 from convlstmnet import ConvLSTMNet
+import torch_dataset
 
 model_filename = "torch_model.pt"
 
@@ -456,16 +457,26 @@ def apply_model_to_np(model, x, device=None):
     #     return model(Variable(torch.from_numpy(x).float()).unsqueeze(0)).
     #                        squeeze(0).data.numpy()
     return (
-        model(Variable(torch.from_numpy(x).float()).to(device))
+        model(Variable(torch.as_tensor(x)).to(device, torch.float, non_blocking=True))
         .to(torch.device("cpu"))
         .data.numpy()
     )
 
 
+def pinned_empty(size, dtype):
+    """Flat array of size elements in pinned host memory, from which tensors
+    are copied to the device asynchronously."""
+    dtype = torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+    return torch.empty(size, dtype=dtype, pin_memory=True).numpy()
+
+
 def make_predictions(
     conf, shot_list, loader, custom_path=None, inference_model=None, device=None
 ):
-    generator = loader.inference_batch_generator_full_shot(shot_list)
+    if conf["training"]["dataloader_workers"] > 0:
+        generator = torch_dataset.inference_batch_generator(conf, shot_list, loader)
+    else:
+        generator = loader.inference_batch_generator_full_shot(shot_list)
     if inference_model is None:
         if custom_path is None:
             model_path = get_model_path(conf)
@@ -490,7 +501,8 @@ def make_predictions(
         for batch_idx in range(x.shape[0]):
             curr_length = lengths[batch_idx]
             y_prime += [output[batch_idx, :curr_length, 0]]
-            y_gold += [y[batch_idx, :curr_length, 0]]
+            # copied, since a view would keep the batch slot of y in use
+            y_gold += [np.array(y[batch_idx, :curr_length, 0])]
             disruptive += [disr[batch_idx]]
         if len(disruptive) >= num_shots:
             y_prime = y_prime[:num_shots]
@@ -541,17 +553,21 @@ def train_epoch(model, data_gen, optimizer, loss_fn, device=None):
     loss = 0
     total_loss = 0
     num_so_far = 0
+    # time spent waiting for the data generator, e.g. on shot I/O and
+    # normalization that prefetching did not hide
+    t_wait = time.time()
     x_, y_, mask_, num_so_far_start, num_total = next(data_gen)
+    t_wait = time.time() - t_wait
+    total_wait = t_wait
     num_so_far = num_so_far_start
     step = 0
     t2 = t1 = t0 = 0.0
     while True:
         x, y, mask = (
-            Variable(torch.from_numpy(x_).float()).to(device),
-            Variable(torch.from_numpy(y_).float()).to(device),
-            Variable(torch.from_numpy(mask_).byte()).to(device),
+            Variable(torch.as_tensor(x_)).to(device, torch.float, non_blocking=True),
+            Variable(torch.as_tensor(y_)).to(device, torch.float, non_blocking=True),
+            Variable(torch.as_tensor(mask_)).to(device, torch.bool, non_blocking=True),
         )
-        mask = mask.bool()
         optimizer.zero_grad()
         t0 = time.time()
         output = model(x)
@@ -582,10 +598,18 @@ def train_epoch(model, data_gen, optimizer, loss_fn, device=None):
                 total_loss / step,
             )
         )
-        print(write_str_0)
+        print(write_str_0 + "[{:.2E} data wait]".format(t_wait))
         if num_so_far - num_so_far_start >= num_total:
             break
+        t_wait = time.time()
         x_, y_, mask_, num_so_far, num_total = next(data_gen)
+        t_wait = time.time() - t_wait
+        total_wait += t_wait
+    print(
+        "data wait: {:.2E} sec total, {:.2E} sec/batch".format(
+            total_wait, total_wait / step
+        )
+    )
     return step, loss.data.item(), total_loss, num_so_far, 1.0 * num_so_far / num_total
 
 
@@ -593,13 +617,20 @@ def train(conf, shot_list_train, shot_list_validate, loader):
     np.random.seed(1)
     # use_cuda = True  # False
     device = torch.device("cuda")
-
-    # data_gen = ProcessGenerator(partial(
-    # loader.training_batch_generator_full_shot_partial_reset,shot_list=shot_list_train)()
-    data_gen = partial(
-        loader.training_batch_generator_full_shot_partial_reset,
-        shot_list=shot_list_train,
-    )()
+    if torch.cuda.is_available():
+        loader.set_buffer_allocator(pinned_empty)
+
+    if conf["training"]["dataloader_workers"] > 0:
+        data_gen = torch_dataset.training_batch_generator(conf, shot_list_train, loader)
+    elif conf["training"]["prefetch_workers"] > 0:
+        data_gen = loader.training_batch_generator_prefetched(shot_list_train)
+    elif conf["training"]["bucket_batches"] > 0:
+        data_gen = loader.training_batch_generator_full_shot_bucketed(shot_list_train)
+    else:
+        data_gen = partial(
+            loader.training_batch_generator_full_shot_partial_reset,
+            shot_list=shot_list_train,
+        )()
 
     loader.set_inference_mode(False)
 
@@ -673,6 +704,8 @@ def train(conf, shot_list_train, shot_list_validate, loader):
         print("Training Loss numpy: {:.3e}".format(ave_loss))
         print("Validation Loss: {:.3e}".format(loss))
         print("Validation ROC: {:.4f}".format(roc_area))
+        if loader.shot_cache is not None:
+            print(loader.shot_cache)
         epochlog = open("epoch_train_log.txt", "a")
         epochlog.write(
             str(e)